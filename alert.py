@@ -0,0 +1,359 @@
+"""計測値の監視と通知.
+
+収集側(power_consumption.py)で計測するたびにルールを評価し、条件を満たしたときにすぐ通知する。
+ルールは ini ファイルの [alert.<名前>] セクションに書く。
+
+* threshold: 値が above より大きい、または below より小さい
+* rate: 1分あたりの変化量の絶対値が rate 以上
+* ewma: 指数移動平均と指数移動分散から求めた偏差(何σ離れているか)が score 以上
+
+通知(hooks)は zabbix(zabbix_sender)、command(任意のコマンド)、webhook(JSON を POST)から選ぶ。
+通知は別スレッドで発生した順に行うので、計測のループは止まらない。
+"""
+
+import abc
+import configparser
+import datetime
+import json
+import math
+import os
+import queue
+import subprocess
+import threading
+import typing as typ
+
+
+class Rule(abc.ABC):
+    """ルールの基底クラス."""
+
+    def __init__(self, name: str, value: str) -> None:
+        """初期化.
+
+        Args:
+            name: ルール名
+            value: 監視する値の名前
+        """
+        self.name: str = name
+        self.value: str = value
+
+    @abc.abstractmethod
+    def check(self, value: float, now: datetime.datetime) -> typ.Optional[str]:
+        """値を評価する.
+
+        Args:
+            value: 値
+            now: 時刻
+
+        Returns:
+            条件を満たしたときはその説明、満たさないときはNone
+        """
+
+
+class ThresholdRule(Rule):
+    """しきい値."""
+
+    def __init__(self, name: str, value: str, above: typ.Optional[float], below: typ.Optional[float]) -> None:
+        """初期化.
+
+        Args:
+            name: ルール名
+            value: 監視する値の名前
+            above: 上限(これより大きいと通知する)
+            below: 下限(これより小さいと通知する)
+        """
+        super().__init__(name, value)
+        self.above: typ.Optional[float] = above
+        self.below: typ.Optional[float] = below
+
+    def check(self, value: float, now: datetime.datetime) -> typ.Optional[str]:
+        """値を評価する.
+
+        Args:
+            value: 値
+            now: 時刻
+
+        Returns:
+            条件を満たしたときはその説明、満たさないときはNone
+        """
+        if self.above is not None and value > self.above:
+            return f"{self.value}={value:g} > {self.above:g}"
+        if self.below is not None and value < self.below:
+            return f"{self.value}={value:g} < {self.below:g}"
+        return None
+
+
+class RateRule(Rule):
+    """変化率."""
+
+    def __init__(self, name: str, value: str, rate: float) -> None:
+        """初期化.
+
+        Args:
+            name: ルール名
+            value: 監視する値の名前
+            rate: 1分あたりの変化量の上限(絶対値)
+        """
+        super().__init__(name, value)
+        self.rate: float = rate
+        self.last: typ.Optional[typ.Tuple[datetime.datetime, float]] = None
+
+    def check(self, value: float, now: datetime.datetime) -> typ.Optional[str]:
+        """値を評価する.
+
+        Args:
+            value: 値
+            now: 時刻
+
+        Returns:
+            条件を満たしたときはその説明、満たさないときはNone
+        """
+        last: typ.Optional[typ.Tuple[datetime.datetime, float]] = self.last
+        self.last = (now, value)
+        if last is None or now <= last[0]:
+            return None
+        rate: float = (value - last[1]) / ((now - last[0]) / datetime.timedelta(minutes=1))
+        if abs(rate) >= self.rate:
+            return f"{self.value}={value:g} ({rate:+g}/min)"
+        return None
+
+
+class EwmaRule(Rule):
+    """指数移動平均からの外れ値."""
+
+    def __init__(self, name: str, value: str, alpha: float, score: float, warmup: int) -> None:
+        """初期化.
+
+        Args:
+            name: ルール名
+            value: 監視する値の名前
+            alpha: 平滑化係数(0〜1。大きいほど最近の値を重視する)
+            score: 通知する偏差(何σ離れているか)
+            warmup: 評価を始めるまでのサンプル数
+        """
+        super().__init__(name, value)
+        self.alpha: float = alpha
+        self.score: float = score
+        self.warmup: int = warmup
+        self.count: int = 0
+        self.mean: float = 0.0
+        self.var: float = 0.0
+
+    def check(self, value: float, now: datetime.datetime) -> typ.Optional[str]:
+        """値を評価する(評価してから、その値で平均と分散を更新する).
+
+        Args:
+            value: 値
+            now: 時刻
+
+        Returns:
+            条件を満たしたときはその説明、満たさないときはNone
+        """
+        result: typ.Optional[str] = None
+        if self.count == 0:
+            self.mean = value
+        else:
+            diff: float = value - self.mean
+            if self.count >= self.warmup and self.var > 0:
+                score: float = abs(diff) / math.sqrt(self.var)
+                if score >= self.score:
+                    result = f"{self.value}={value:g} (mean {self.mean:g}, {score:.1f}σ)"
+            self.mean += self.alpha * diff
+            self.var = (1 - self.alpha) * (self.var + self.alpha * diff * diff)
+        self.count += 1
+        return result
+
+
+Hook = typ.Callable[[typ.Dict], None]
+
+
+def command_hook(command: str) -> Hook:
+    """コマンドを実行する通知を作る.
+
+    イベントの内容は環境変数(ALERT_RULE, ALERT_STATE, ALERT_VALUE, ALERT_MESSAGE)で渡す。
+
+    Args:
+        command: コマンド(シェルで実行する)
+
+    Returns:
+        通知
+    """
+
+    def hook(event: typ.Dict) -> None:
+        env: typ.Dict[str, str] = dict(os.environ)
+        env.update({f"ALERT_{key.upper()}": str(value) for key, value in event.items()})
+        subprocess.run(command, shell=True, env=env, timeout=60)
+
+    return hook
+
+
+def webhook_hook(url: str) -> Hook:
+    """JSON を POST する通知を作る.
+
+    Args:
+        url: URL
+
+    Returns:
+        通知
+    """
+
+    def hook(event: typ.Dict) -> None:
+        import urllib.request  # 使うときだけ import する
+
+        request: urllib.request.Request = urllib.request.Request(
+            url,
+            data=json.dumps(event, default=str, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+    return hook
+
+
+def zabbix_hook(server: str, port: int, host: str, key_prefix: str) -> Hook:
+    """zabbix_sender で送る通知を作る.
+
+    キーは <key_prefix>.alert.<ルール名> で、値は発生中が1、復旧が0。
+
+    Args:
+        server: Zabbix server
+        port: Zabbix port
+        host: Zabbix host
+        key_prefix: キーのプレフィックス
+
+    Returns:
+        通知
+    """
+
+    def hook(event: typ.Dict) -> None:
+        value: str = "1" if event["state"] == "alert" else "0"
+        command: typ.List[str] = ["zabbix_sender", "-z", server, "-p", f"{port}", "-s", host]
+        command.extend(["-k", f"{key_prefix}.alert.{event['rule']}", "-o", value])
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+
+    return hook
+
+
+class AlertEngine:
+    """ルールを評価して通知する."""
+
+    def __init__(self, rules: typ.List[typ.Tuple[Rule, typ.List[Hook], datetime.timedelta]]) -> None:
+        """初期化.
+
+        Args:
+            rules: (ルール, 通知のリスト, 再通知までの時間)のリスト
+        """
+        self.rules: typ.List[typ.Tuple[Rule, typ.List[Hook], datetime.timedelta]] = rules
+        self.active: typ.Dict[str, datetime.datetime] = {}  # 発生中のルールと最後に通知した時刻
+        self.queue: "queue.Queue[typ.Tuple[Hook, typ.Dict]]" = queue.Queue()
+        self.worker: typ.Optional[threading.Thread] = None
+
+    @property
+    def values(self) -> typ.Set[str]:
+        """監視している値の名前."""
+        return {rule.value for rule, _, _ in self.rules}
+
+    def evaluate(
+        self, values: typ.Mapping[str, typ.Optional[float]], now: typ.Optional[datetime.datetime] = None
+    ) -> None:
+        """計測値を評価する.
+
+        発生したとき、発生中に再通知までの時間が過ぎたとき、復旧したときに通知する。
+
+        Args:
+            values: 値の名前と値(Noneの値は評価しない)
+            now: 時刻(省略したときは現在時刻)
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        for rule, hooks, cooldown in self.rules:
+            value: typ.Optional[float] = values.get(rule.value)
+            if value is None:
+                continue
+            message: typ.Optional[str] = rule.check(value, now)
+            last: typ.Optional[datetime.datetime] = self.active.get(rule.name)
+            if message is not None:
+                if last is None or now - last >= cooldown:
+                    self.active[rule.name] = now
+                    self.fire(hooks, {"rule": rule.name, "state": "alert", "value": value, "message": message})
+            elif last is not None:
+                del self.active[rule.name]
+                self.fire(
+                    hooks, {"rule": rule.name, "state": "ok", "value": value, "message": f"{rule.value}={value:g}"}
+                )
+
+    def fire(self, hooks: typ.List[Hook], event: typ.Dict) -> None:
+        """通知する(通知用のスレッドで、発生した順に実行する).
+
+        Args:
+            hooks: 通知のリスト
+            event: イベント
+        """
+        print(f"ALERT [{event['state']}] {event['rule']}: {event['message']}", flush=True)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run_hooks, daemon=True)
+            self.worker.start()
+        for hook in hooks:
+            self.queue.put((hook, event))
+
+    def run_hooks(self) -> None:
+        """通知を順に実行する(失敗しても計測は続ける)."""
+        while True:
+            hook, event = self.queue.get()
+            try:
+                hook(event)
+            except Exception as e:
+                print(f"通知エラー: {event['rule']}: {e}", flush=True)
+
+
+def load_rules(inifile: configparser.ConfigParser) -> AlertEngine:
+    """設定ファイルからルールを読み込む.
+
+    Args:
+        inifile: ini ファイル
+
+    Returns:
+        ルールを設定した AlertEngine
+    """
+    rules: typ.List[typ.Tuple[Rule, typ.List[Hook], datetime.timedelta]] = []
+    for section in inifile.sections():
+        if not section.startswith("alert."):
+            continue
+        name: str = section[len("alert.") :]
+        value: str = inifile.get(section, "value")
+        kind: str = inifile.get(section, "type", fallback="threshold")
+        rule: Rule
+        if kind == "threshold":
+            above: typ.Optional[float] = inifile.getfloat(section, "above", fallback=None)
+            below: typ.Optional[float] = inifile.getfloat(section, "below", fallback=None)
+            rule = ThresholdRule(name, value, above, below)
+        elif kind == "rate":
+            rule = RateRule(name, value, inifile.getfloat(section, "rate"))
+        elif kind == "ewma":
+            alpha: float = inifile.getfloat(section, "alpha", fallback=0.1)
+            score: float = inifile.getfloat(section, "score", fallback=4.0)
+            warmup: int = inifile.getint(section, "warmup", fallback=30)
+            rule = EwmaRule(name, value, alpha, score, warmup)
+        else:
+            raise ValueError(f"[{section}] unknown type: {kind}")
+        hooks: typ.List[Hook] = []
+        for hook_name in inifile.get(section, "hooks", fallback="").split(","):
+            hook_name = hook_name.strip()
+            if hook_name in ("command", "webhook"):
+                # ルールのセクションになければ、[alert] セクションの設定を使う
+                target: str = inifile.get(section if inifile.has_option(section, hook_name) else "alert", hook_name)
+                hooks.append(command_hook(target) if hook_name == "command" else webhook_hook(target))
+            elif hook_name == "zabbix":
+                hooks.append(
+                    zabbix_hook(
+                        inifile.get("zabbix", "server"),
+                        inifile.getint("zabbix", "port", fallback=10051),
+                        inifile.get("zabbix", "host"),
+                        inifile.get("zabbix", "key_prefix", fallback="pc"),
+                    )
+                )
+            elif hook_name != "":
+                raise ValueError(f"[{section}] unknown hook: {hook_name}")
+        cooldown: datetime.timedelta = datetime.timedelta(seconds=inifile.getfloat(section, "cooldown", fallback=600))
+        rules.append((rule, hooks, cooldown))
+    return AlertEngine(rules)
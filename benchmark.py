@@ -0,0 +1,492 @@
+"""ベンチマーク.
+
+DB やセンサーがなくても動くように、ダミーデータを生成して計測する。
+`python benchmark.py -h` でサブコマンドの一覧が出ます。
+"""
+
+import argparse
+import datetime
+import random
+import statistics
+import time
+import typing as typ
+
+
+def make_power_rows(days: int) -> typ.List[typ.Dict]:
+    """power_log 相当のダミーデータを作る(1分間隔).
+
+    Args:
+        days: 日数
+
+    Returns:
+        ダミーデータ
+    """
+    rows: typ.List[typ.Dict] = []
+    積算電力量: int = 0
+    timestamp: datetime.datetime = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    timestamp -= datetime.timedelta(days=days)
+    timedelta: datetime.timedelta = datetime.timedelta(minutes=1)
+    rnd: random.Random = random.Random(0)
+    for idx in range(days * 24 * 60):
+        積算電力量 += rnd.randint(0, 10)
+        rows.append(
+            {
+                "id": idx,
+                "係数": 1,
+                "積算電力量": 積算電力量,
+                "電力量単位": 0x02,
+                "瞬時電力": rnd.randint(0, 3000),
+                "瞬時電流_r": rnd.randint(0, 300),
+                "瞬時電流_t": rnd.randint(0, 300),
+                "created_at": timestamp,
+            }
+        )
+        timestamp += timedelta
+    return rows
+
+
+def make_env_rows(days: int) -> typ.List[typ.Dict]:
+    """select_bucketed_log(1分単位)で取得した環境データ相当のダミーデータを作る.
+
+    Args:
+        days: 日数
+
+    Returns:
+        ダミーデータ
+    """
+    rows: typ.List[typ.Dict] = []
+    timestamp: datetime.datetime = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    timestamp -= datetime.timedelta(days=days)
+    rnd: random.Random = random.Random(0)
+    for idx in range(days * 24 * 60):
+        rows.append(
+            {
+                "time": timestamp,
+                "temp": rnd.uniform(40, 50),
+                "co2": rnd.uniform(400, 1500),
+                "temp2": 20.0,
+                "temp3": rnd.uniform(15, 30),
+                "pressure": rnd.uniform(990, 1020),
+                "humidity": rnd.uniform(30, 70),
+                "illuminance": rnd.uniform(100, 300) if (idx // 90) % 3 == 0 else rnd.uniform(0, 20),
+            }
+        )
+        timestamp += datetime.timedelta(minutes=1)
+    return rows
+
+
+def measure(func: typ.Callable[[], typ.Any], repeat: int) -> typ.Tuple[float, typ.Any]:
+    """実行時間を計測する.
+
+    Args:
+        func: 計測する処理
+        repeat: 繰り返し回数
+
+    Returns:
+        最短の実行時間[秒], 最後の実行結果
+    """
+    best: float = float("inf")
+    result: typ.Any = None
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def legacy_power_columns(data: typ.List, window: int) -> typ.Dict[str, typ.List]:
+    """ベクトル化前の power_graph の集計処理(比較用).
+
+    Args:
+        data: power_logのデータ
+        window: 移動平均のサンプル数
+
+    Returns:
+        列ごとのデータ
+    """
+    import echonet
+
+    datadict: typ.Dict[str, typ.List] = {
+        col: [] for col in ("電力量", "電力", "電流R", "電流T", "MA電力", "MA電流R", "MA電流T")
+    }
+    for row in data:
+        datadict["電力量"].append(row["係数"] * row["積算電力量"] * echonet.積算電力量単位.get(row["電力量単位"], 1.0))
+        datadict["電力"].append(row["瞬時電力"])
+        datadict["電流R"].append(row["瞬時電流_r"] / 10.0)
+        datadict["電流T"].append(row["瞬時電流_t"] / 10.0)
+        datadict["MA電力"].append(statistics.mean(datadict["電力"][-window:]))
+        datadict["MA電流T"].append(statistics.mean(datadict["電流T"][-window:]))
+        datadict["MA電流R"].append(statistics.mean(datadict["電流R"][-window:]))
+    return datadict
+
+
+def bench_power_graph(args: argparse.Namespace) -> None:
+    """power_graph の集計処理を計測する.
+
+    Args:
+        args: コマンドライン引数
+    """
+    import numpy as np
+    import power_graph
+
+    rows: typ.List[typ.Dict] = make_power_rows(args.days)
+    print(f"rows: {len(rows)}, window: {args.window}")
+    legacy_time, legacy = measure(lambda: legacy_power_columns(rows, args.window), args.repeat)
+    new_time, df = measure(lambda: power_graph.make_power_dataframe(rows, args.window), args.repeat)
+    for col, values in legacy.items():
+        if not np.allclose(df[col].to_numpy(), np.asarray(values, dtype=np.float64), rtol=1e-12, atol=1e-9):
+            raise SystemExit(f"mismatch: {col}")
+    print(f"legacy: {legacy_time * 1000:10.1f} [ms]")
+    print(f"vector: {new_time * 1000:10.1f} [ms] (x{legacy_time / new_time:.1f})")
+
+
+def bench_temp_graph(args: argparse.Namespace) -> None:
+    """temp_graph の集計処理を計測する.
+
+    Args:
+        args: コマンドライン引数
+    """
+    import temp_graph
+
+    rows: typ.List[typ.Dict] = make_env_rows(args.days)
+    print(f"rows: {len(rows)}")
+    frame_time, df = measure(lambda: temp_graph.make_temp_dataframe(rows), args.repeat)
+    light_time, (left, right) = measure(lambda: temp_graph.light_intervals(df), args.repeat)
+    print(f"frame: {frame_time * 1000:10.1f} [ms]")
+    print(f"light: {light_time * 1000:10.1f} [ms] ({len(left)} intervals)")
+
+
+def bench_power_cost(args: argparse.Namespace) -> None:
+    """power_cost の料金計算を計測する.
+
+    Args:
+        args: コマンドライン引数
+    """
+    import configparser
+    import numpy as np
+    import power_cost
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read_dict(
+        {
+            "tariff": {
+                "base": "1144",
+                "adjustment": "3.5",
+                "time_of_use": "23:00-07:00 27.86, 07:00-23:00 35.76",
+                "weekend_time_of_use": "00:00-24:00 27.86",
+                "tiers": "0 0, 120 2, 300 5",
+            }
+        }
+    )
+    tariff: power_cost.Tariff = power_cost.Tariff.from_config(inifile)
+    rows: typ.List[typ.Dict] = make_power_rows(args.days)
+    # 最初の30分は、30分ごとのデータでは差の基準になるので除く
+    start_time: datetime.datetime = rows[0]["created_at"] + power_cost.SLOT
+    end_time: datetime.datetime = rows[-1]["created_at"]
+    # select_power_counter 相当(30分ごとの最後の計測値)
+    slots: typ.Dict[datetime.datetime, typ.Dict] = {}
+    for row in rows:
+        slot: datetime.datetime = row["created_at"].replace(minute=row["created_at"].minute // 30 * 30)
+        slots[slot] = dict(row, time=slot)
+    counter_rows: typ.List[typ.Dict] = list(slots.values())
+    print(f"rows: {len(rows)}, slots: {len(counter_rows)}")
+
+    def compute(data: typ.List[typ.Dict], key: str) -> typ.Any:
+        energy = power_cost.slot_energy(power_cost.make_counter_frame(data, key))
+        return power_cost.make_report(energy, tariff, start_time, end_time, "month")
+
+    raw_time, raw_report = measure(lambda: compute(rows, "created_at"), args.repeat)
+    slot_time, report = measure(lambda: compute(counter_rows, "time"), args.repeat)
+    if not np.allclose(raw_report["使用量"].to_numpy(), report["使用量"].to_numpy()):
+        raise SystemExit("mismatch")
+    print(report.to_string(float_format=lambda value: f"{value:,.2f}"))
+    print(f"power_log: {raw_time * 1000:10.1f} [ms]")
+    print(f"30min:     {slot_time * 1000:10.1f} [ms]")
+
+
+def bench_page_size(args: argparse.Namespace) -> None:
+    """グラフのページの大きさと読み込み時間を、リストと型付き配列で比べる.
+
+    ブラウザでの読み込み時間の代わりに、埋め込まれたドキュメント(JSON)のパース時間を計測する。
+
+    Args:
+        args: コマンドライン引数
+    """
+    import gzip
+    import json
+    import re
+    import bokeh.embed
+    import bokeh.plotting as bp
+    import bokeh.resources
+    import graph_output
+    import power_graph
+
+    df = power_graph.make_power_dataframe(make_power_rows(args.days), 30)
+    print(f"rows: {len(df)}")
+    sources: typ.Dict[str, typ.Dict] = {
+        "list": {col: df[col].tolist() for col in power_graph.COLUMNS},
+        "typed": graph_output.to_column_data(df, precise=["電力量"]),
+    }
+    for name, data in sources.items():
+
+        def render() -> str:
+            fig: bp.figure = bp.figure(x_axis_type="datetime")
+            source: bp.ColumnDataSource = bp.ColumnDataSource(data)
+            for col in power_graph.COLUMNS[1:]:
+                fig.line("time", col, source=source)
+            return bokeh.embed.file_html(fig, bokeh.resources.CDN)
+
+        render_time, html = measure(render, args.repeat)
+        match: typ.Optional[re.Match] = re.search(
+            r'<script type="application/json" id="\d+">\s*(.*?)\s*</script>', html, re.S
+        )
+        if match is None:
+            raise SystemExit("document not found")
+        doc_json: str = match.group(1)
+        parse_time, _ = measure(lambda: json.loads(doc_json), args.repeat)
+        size: int = len(html.encode("utf-8"))
+        gzip_size: int = len(gzip.compress(html.encode("utf-8"), compresslevel=9))
+        print(
+            f"{name:5}: {size / 1024:10.1f} [KiB] gzip {gzip_size / 1024:10.1f} [KiB]"
+            f" render {render_time * 1000:8.1f} [ms] parse {parse_time * 1000:8.1f} [ms]"
+        )
+
+
+def bench_i2c(args: argparse.Namespace) -> None:
+    """センサーの読み込み1回あたりの I²C の転送回数・バイト数・時間を、FakeSMBus で計測する.
+
+    近いレジスタの読み込みを1回にまとめたとき(coalesced)と、まとめないとき(separate)を比べる。
+
+    Args:
+        args: コマンドライン引数
+    """
+    import bme280
+    import i2c_bus
+    import tsl2572
+
+    cases: typ.Dict[str, typ.Callable[[], typ.Any]] = {
+        "bme280 normal": lambda: bme280.BME280(0),
+        "bme280 forced": lambda: bme280.BME280(0, osrs_h=1, osrs_t=1, osrs_p=1, mode=1, filter=0),
+        "tsl2572 one-shot": lambda: tsl2572.TSL2572(0),
+        "tsl2572 continuous": lambda: tsl2572.TSL2572(0, continuous=True),
+    }
+    max_gap: int = i2c_bus.MAX_GAP
+    for name, make in cases.items():
+        for mode, gap in (("coalesced", max_gap), ("separate", -1)):
+            i2c_bus.MAX_GAP = gap
+            fake: i2c_bus.FakeSMBus = i2c_bus.FakeSMBus(
+                {0x76: i2c_bus.FakeBME280(), 0x39: i2c_bus.FakeTSL2572()}, latency=args.latency / 1e6
+            )
+            bus: i2c_bus.I2CBus = i2c_bus.set_backend(0, fake)
+            sensor: typ.Any = make()
+            sensor.read()  # 連続測定の開始などを除く
+            bus.stats.clear()
+            start: float = time.perf_counter()
+            for _ in range(args.count):
+                sensor.read()
+            elapsed: float = time.perf_counter() - start
+            stats: i2c_bus.TransferStats = next(iter(bus.stats.values()))
+            print(
+                f"{name:18} {mode:9}: {stats.transfers / args.count:5.1f} transfers"
+                f" {stats.bytes / args.count:6.1f} [bytes] bus {stats.seconds / args.count * 1000:8.3f} [ms]"
+                f" total {elapsed / args.count * 1000:8.3f} [ms]"
+            )
+    i2c_bus.MAX_GAP = max_gap
+
+
+def bench_oled(args: argparse.Namespace) -> None:
+    """OLED の画面更新1回あたりの CPU 時間と I²C の転送量を、FakeSSD1306 で計測する.
+
+    毎回 PIL で画面全体を描いて全部送るとき(full)と、キャッシュした文字で描いて変わった部分だけを送るとき(diff)を比べる。
+
+    Args:
+        args: コマンドライン引数
+    """
+    import i2c_bus
+    import oled_ssd1306
+    from PIL import Image, ImageDraw, ImageFont  # type: ignore
+
+    rng: random.Random = random.Random(0)
+    values: typ.List[typ.Tuple[int, float, float, float]] = []
+    co2, temp, hum, pres = 800, 20.0, 50.0, 1013.0
+    for _ in range(args.count):
+        co2 += rng.randint(-5, 5)
+        temp += rng.choice([-0.1, 0.0, 0.0, 0.1])
+        hum += rng.choice([-0.3, 0.0, 0.3])
+        pres += rng.choice([-0.1, 0.0, 0.1])
+        values.append((co2, temp, hum, pres))
+    font: ImageFont.FreeTypeFont = ImageFont.truetype(args.font, oled_ssd1306.FONT_SIZE)
+
+    def full(display: oled_ssd1306.Display, co2: int, temp: float, hum: float, pres: float) -> None:
+        image: Image.Image = Image.new("1", (oled_ssd1306.WIDTH, oled_ssd1306.HEIGHT))
+        draw: ImageDraw.ImageDraw = ImageDraw.Draw(image)
+        draw.text((0, 0), f"CO₂  {co2:6.1f} ppm", font=font, fill=255)
+        draw.text((0, 16), f"気温 {temp:6.1f} ℃", font=font, fill=255)
+        draw.text((0, 32), f"湿度 {hum:6.1f} %", font=font, fill=255)
+        draw.text((0, 48), f"気圧 {pres:6.1f} hPa", font=font, fill=255)
+        display.frame[:] = b"".join(oled_ssd1306.to_pages(image))
+        display.sent = None
+        display.flush()
+
+    def diff(display: oled_ssd1306.Display, co2: int, temp: float, hum: float, pres: float) -> None:
+        display.update(co2, temp, hum, pres)
+        display.redraw()
+
+    for mode, func in (("full", full), ("diff", diff)):
+        fake: oled_ssd1306.FakeSSD1306 = oled_ssd1306.FakeSSD1306()
+        display: oled_ssd1306.Display = oled_ssd1306.Display(0x3C, 1, oled=fake, font_path=args.font)
+        func(display, *values[0])  # キャッシュと最初の画面を除く
+        display.stats = i2c_bus.TransferStats()
+        start: float = time.process_time()
+        for v in values:
+            func(display, *v)
+        elapsed: float = time.process_time() - start
+        stats: i2c_bus.TransferStats = display.stats
+        bus_ms: float = stats.bytes * 9 / (args.clock * 1000) * 1000  # 1バイトは ACK を含めて9クロック
+        print(
+            f"{mode:4}: cpu {elapsed / args.count * 1000:7.3f} [ms] {stats.transfers / args.count:5.1f} transfers"
+            f" {stats.bytes / args.count:7.1f} [bytes] bus {bus_ms / args.count:6.2f} [ms] at {args.clock:g} kHz"
+        )
+
+
+# importtime で計測するエントリポイント(モジュール名: (予算[ms], 起動時に import してはいけないモジュール))
+# 予算は開発機での目安(Raspberry Pi などでは --scale で倍率を指定する)
+IMPORT_BUDGETS: typ.Dict[str, typ.Tuple[float, typ.List[str]]] = {
+    "power_consumption": (150, ["display_channel", "bme280", "tsl2572", "mh_z19", "latest_server", "bokeh", "pandas"]),
+    "power_graph": (700, ["bokeh"]),
+    "temp_graph": (700, ["bokeh"]),
+    "latest_html": (150, ["bokeh", "pandas"]),
+    "power_cost": (800, ["bokeh"]),
+    "heatmap": (1300, []),
+    "live_power": (1500, ["pandas"]),
+    "bme280_recompensate": (400, ["pandas", "bokeh"]),
+    "display_controller": (300, ["pandas", "bokeh"]),
+}
+
+
+def parse_importtime(stderr: str) -> typ.Dict[str, int]:
+    """`python -X importtime` の出力を解析する.
+
+    Args:
+        stderr: 標準エラー出力
+
+    Returns:
+        モジュール名と累積の import 時間[us]
+    """
+    result: typ.Dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields: typ.List[str] = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # 見出しの行
+        result[fields[2].strip()] = int(fields[1])
+    return result
+
+
+def bench_importtime(args: argparse.Namespace) -> None:
+    """エントリポイントの import 時間を計測して、予算と比べる.
+
+    `python -X importtime -c "import <module>"` を別プロセスで実行して、累積時間の最小値を使う。
+    依存するパッケージがなくて import できないエントリポイントは飛ばす。
+
+    Args:
+        args: コマンドライン引数
+    """
+    import os
+    import subprocess
+    import sys
+
+    over: typ.List[str] = []
+    for module, (budget, forbidden) in IMPORT_BUDGETS.items():
+        if args.module and module not in args.module:
+            continue
+        best: float = float("inf")
+        times: typ.Dict[str, int] = {}
+        error: str = ""
+        for _ in range(args.repeat):
+            result: subprocess.CompletedProcess = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode != 0:
+                error = result.stderr.strip().splitlines()[-1]
+                break
+            times = parse_importtime(result.stderr)
+            best = min(best, times.get(module, 0) / 1000)
+        if error:
+            print(f"{module:20}: skipped ({error})")
+            continue
+        loaded: typ.List[str] = [name for name in forbidden if name in times]
+        limit: float = budget * args.scale
+        status: str = "ok" if best <= limit and len(loaded) == 0 else "NG"
+        if status == "NG":
+            over.append(module)
+        print(f"{module:20}: {best:8.1f} [ms] (budget {limit:8.1f} [ms]) {status}")
+        if len(loaded) > 0:
+            print(f"{'':20}  imported at startup: {', '.join(loaded)}")
+        if args.verbose:
+            top: typ.List[typ.Tuple[str, int]] = sorted(
+                ((name, value) for name, value in times.items() if name != module and "." not in name),
+                key=lambda item: -item[1],
+            )
+            for name, value in top[:5]:
+                print(f"{'':20}  {name:30} {value / 1000:8.1f} [ms]")
+    if len(over) > 0:
+        raise SystemExit(f"over budget: {', '.join(over)}")
+
+
+def main() -> None:
+    """メイン処理."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    power_parser: argparse.ArgumentParser = subparsers.add_parser("power_graph", help="power_graph data transform")
+    power_parser.add_argument("-d", "--days", type=int, help="days of dummy data", default=90)
+    power_parser.add_argument("-w", "--window", type=int, help="window size of moving average", default=30)
+    power_parser.add_argument("-r", "--repeat", type=int, help="repeat count", default=3)
+    power_parser.set_defaults(func=bench_power_graph)
+
+    temp_parser: argparse.ArgumentParser = subparsers.add_parser("temp_graph", help="temp_graph data transform")
+    temp_parser.add_argument("-d", "--days", type=int, help="days of dummy data", default=28)
+    temp_parser.add_argument("-r", "--repeat", type=int, help="repeat count", default=3)
+    temp_parser.set_defaults(func=bench_temp_graph)
+
+    cost_parser: argparse.ArgumentParser = subparsers.add_parser("power_cost", help="power_cost bill computation")
+    cost_parser.add_argument("-d", "--days", type=int, help="days of dummy data", default=365)
+    cost_parser.add_argument("-r", "--repeat", type=int, help="repeat count", default=3)
+    cost_parser.set_defaults(func=bench_power_cost)
+
+    page_parser: argparse.ArgumentParser = subparsers.add_parser("page_size", help="graph page size and load time")
+    page_parser.add_argument("-d", "--days", type=int, help="days of dummy data", default=7)
+    page_parser.add_argument("-r", "--repeat", type=int, help="repeat count", default=3)
+    page_parser.set_defaults(func=bench_page_size)
+
+    i2c_parser: argparse.ArgumentParser = subparsers.add_parser("i2c", help="I2C transfers per sensor read")
+    i2c_parser.add_argument("-n", "--count", type=int, help="number of reads", default=100)
+    i2c_parser.add_argument("-l", "--latency", type=float, help="simulated latency per transfer [us]", default=300)
+    i2c_parser.set_defaults(func=bench_i2c)
+
+    oled_parser: argparse.ArgumentParser = subparsers.add_parser("oled", help="OLED update cost")
+    oled_parser.add_argument("-n", "--count", type=int, help="number of updates", default=100)
+    oled_parser.add_argument(
+        "-f", "--font", help="TrueType font", default="/usr/share/fonts/truetype/horai-umefont/ume-tmo3.ttf"
+    )
+    oled_parser.add_argument("-c", "--clock", type=float, help="I2C clock [kHz]", default=400)
+    oled_parser.set_defaults(func=bench_oled)
+
+    import_parser: argparse.ArgumentParser = subparsers.add_parser("importtime", help="startup import time")
+    import_parser.add_argument("module", nargs="*", help="entry point modules (default: all)")
+    import_parser.add_argument("-r", "--repeat", type=int, help="repeat count", default=3)
+    import_parser.add_argument("-s", "--scale", type=float, help="scale factor of budgets", default=1.0)
+    import_parser.add_argument("-v", "--verbose", action="store_true", help="show the slowest imports")
+    import_parser.set_defaults(func=bench_importtime)
+
+    args: argparse.Namespace = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
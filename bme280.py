@@ -1,8 +1,9 @@
 """access BME280 via I2C."""
 
 import struct
+import time
 import typing as typ
-import smbus
+import i2c_bus
 
 
 class BME280:
@@ -83,14 +84,16 @@ class BME280:
         assert filter & 0b111 == filter
         assert spi3w_en & 0b1 == spi3w_en
 
-        self.bus: smbus.SMBus = smbus.SMBus(bus)
+        self.bus: i2c_bus.I2CBus = i2c_bus.get_bus(bus)
         self.i2c_address: int = address
+        self.mode: int = mode
+        self.osrs: typ.Tuple[int, int, int] = (osrs_p, osrs_t, osrs_h)
 
         ctrl_hum: int = osrs_h
-        ctrl_meas: int = (osrs_t << 5) + (osrs_p << 2) + mode
+        self.ctrl_meas: int = (osrs_t << 5) + (osrs_p << 2) + mode
         config: int = (t_sb << 5) + (filter << 2) + spi3w_en
         self.write_reg(0xF2, ctrl_hum)
-        self.write_reg(0xF4, ctrl_meas)
+        self.write_reg(0xF4, self.ctrl_meas)
         self.write_reg(0xF5, config)
 
         self.init_calibration()
@@ -116,13 +119,48 @@ class BME280:
         self.dig_H[3] = (self.dig_H[3] << 4) + (self.dig_H[4] & 0xF)
         self.dig_H[4] = self.dig_H[4] >> 4
 
+    def measurement_time(self) -> float:
+        """1回の測定にかかる時間(データシートの最大値).
+
+        Returns:
+            測定時間[秒]
+        """
+        # オーバーサンプリングの設定値から回数へ(0: スキップ、5以上: ×16)
+        osrs_p, osrs_t, osrs_h = (0 if osrs == 0 else 1 << (min(osrs, 5) - 1) for osrs in self.osrs)
+        t: float = 1.25 + 2.3 * osrs_t
+        if osrs_p > 0:
+            t += 2.3 * osrs_p + 0.575
+        if osrs_h > 0:
+            t += 2.3 * osrs_h + 0.575
+        return t / 1000
+
+    def force_measurement(self) -> bytes:
+        """強制モードで1回測定して、終わったら生データのレジスタを読み込む.
+
+        Returns:
+            0xF7〜0xFE の値
+        """
+        self.write_reg(0xF4, (self.ctrl_meas & ~0b11) | 0b01)
+        time.sleep(self.measurement_time())
+        # status と生データは1回の転送で読み込み、measuring が0になっていなければ読み直す
+        for _ in range(10):
+            status, rawdata = self.bus.read_blocks(self.i2c_address, [(0xF3, 1), (0xF7, 8)])
+            if status[0] & 0b1000 == 0:
+                break
+            time.sleep(0.001)
+        return bytes(rawdata)
+
     def read_raw(self) -> typ.Tuple:
-        """センサの生データを読み込む.
+        """センサの生データを読み込む(強制モードのときは、測定してから読み込む).
 
         Returns:
             生データのTuple(気圧、気温、湿度)
         """
-        rawdata: bytes = bytes(self.bus.read_i2c_block_data(self.i2c_address, 0xF7, 8))
+        rawdata: bytes
+        if self.mode in (0b01, 0b10):
+            rawdata = self.force_measurement()
+        else:
+            rawdata = bytes(self.bus.read_i2c_block_data(self.i2c_address, 0xF7, 8))
         pres: typ.Tuple = struct.unpack(">HB", rawdata[0:3])
         pres_raw: int = (pres[0] << 4) + (pres[1] >> 4)
         temp: typ.Tuple = struct.unpack(">HB", rawdata[3:6])
@@ -163,7 +201,9 @@ class BME280:
         if var1 == 0:
             return 0
         p: int = 1048576 - adc_P
-        p = (((p << 31) - var2) * 3125) // var1
+        # C と同じく0方向に丸める(// は負の無限大方向に丸めるので、絶対値で割る)
+        n: int = ((p << 31) - var2) * 3125
+        p = abs(n) // abs(var1) if (n < 0) == (var1 < 0) else -(abs(n) // abs(var1))
         var1 = (self.dig_P[8] * (p >> 13) * (p >> 13)) >> 25
         var2 = (self.dig_P[7] * p) >> 19
         p = ((p + var1 + var2) >> 8) + (self.dig_P[6] << 4)
@@ -195,18 +235,55 @@ class BME280:
         v_x1_u32r = 419430400 if v_x1_u32r > 419430400 else v_x1_u32r
         return v_x1_u32r >> 12
 
-    def read(self) -> typ.Tuple:
-        """センサのデータを読み込む.
+    def compensate(self, rawdata: typ.Tuple) -> typ.Tuple:
+        """生データを補正する.
+
+        Args:
+            rawdata: read_raw で読み込んだ生データ
 
         Returns:
             データのTuple(気圧、気温、湿度)
         """
-        rawdata: typ.Tuple = self.read_raw()
         temp: int = self.compensate_T(rawdata[1])
         pres: int = self.compensate_P(rawdata[0])
         hum: int = self.compensate_H(rawdata[2])
         return (pres / 256 / 100, temp / 100, hum / 1024)
 
+    def read(self) -> typ.Tuple:
+        """センサのデータを読み込む.
+
+        Returns:
+            データのTuple(気圧、気温、湿度)
+        """
+        return self.compensate(self.read_raw())
+
+    def read_burst(self, count: int) -> typ.Dict[str, typ.Tuple]:
+        """センサのデータを続けて読み込んで、まとめる.
+
+        平均は生データを平均してから補正する(記録した生データから同じ値を求め直せる)。
+        最小・最大は、1回ごとに補正した値から求める。
+
+        Args:
+            count: 読み込む回数
+
+        Returns:
+            raw(生データの平均), mean(平均), min(最小), max(最大)をキーにした、それぞれ気圧、気温、湿度のTuple
+
+        Raises:
+            ValueError: 強制モードでないのに、2回以上読み込もうとした(通常モードでは同じ測定結果を読むだけになる)
+        """
+        if count > 1 and self.mode not in (1, 2):
+            raise ValueError("read_burst needs forced mode to take more than one sample")
+        samples: typ.List[typ.Tuple] = [self.read_raw() for _ in range(count)]
+        rawdata: typ.Tuple = tuple(round(sum(values) / count) for values in zip(*samples))
+        values: typ.List[typ.Tuple] = list(zip(*(self.compensate(sample) for sample in samples)))
+        return {
+            "raw": rawdata,
+            "mean": self.compensate(rawdata),
+            "min": tuple(min(value) for value in values),
+            "max": tuple(max(value) for value in values),
+        }
+
 
 if __name__ == "__main__":
     bme280: BME280 = BME280()
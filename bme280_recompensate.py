@@ -0,0 +1,256 @@
+"""BME280の生データをまとめて補正し直す.
+
+収集側で記録した生データ(bme280_raw_log)と calibration data(bme280_calibration)から、
+データシートの整数演算の補正式を NumPy の64bit整数の配列演算でまとめて計算する。
+補正式の誤りや calibration data の読み間違いがあっても、過去のデータを補正し直せる。
+
+C の整数演算と結果を一致させるため、右シフトは算術シフト、割り算は0方向への丸めにしている。
+`check` で、test/bme280.cc(データシートの補正式そのもの)と結果が一致することを確かめられる。
+"""
+
+import argparse
+import configparser
+import datetime
+import subprocess
+import typing as typ
+import numpy as np
+import db_store
+
+# test/bme280.cc に書いてある calibration data(dig_T, dig_P, dig_H)
+REFERENCE_CALIBRATION: typ.Tuple[typ.List[int], typ.List[int], typ.List[int]] = (
+    [28998, 27158, 50],
+    [36231, -10432, 3024, 7042, -68, -7, 9900, -10230, 4285],
+    [75, 378, 0, 282, 50, 30],
+)
+
+
+def trunc_div(n: np.ndarray, d: np.ndarray) -> np.ndarray:
+    """C と同じく0方向に丸める整数の割り算.
+
+    Args:
+        n: 割られる数
+        d: 割る数(0を含まないこと)
+
+    Returns:
+        商
+    """
+    q: np.ndarray = np.abs(n) // np.abs(d)
+    return np.where((n < 0) != (d < 0), -q, q)
+
+
+def compensate_T(adc_T: np.ndarray, dig_T: typ.Sequence[int]) -> typ.Tuple[np.ndarray, np.ndarray]:
+    """温度を補正する.
+
+    Args:
+        adc_T: 温度の生データ
+        dig_T: 温度の補正値
+
+    Returns:
+        補正後の値[0.01℃], t_fine
+    """
+    adc_T = np.asarray(adc_T, dtype=np.int64)
+    T1, T2, T3 = (np.int64(value) for value in dig_T)
+    var1: np.ndarray = (((adc_T >> 3) - (T1 << 1)) * T2) >> 11
+    var2: np.ndarray = (((((adc_T >> 4) - T1) * ((adc_T >> 4) - T1)) >> 12) * T3) >> 14
+    t_fine: np.ndarray = var1 + var2
+    return (t_fine * 5 + 128) >> 8, t_fine
+
+
+def compensate_P(adc_P: np.ndarray, t_fine: np.ndarray, dig_P: typ.Sequence[int]) -> np.ndarray:
+    """気圧を補正する.
+
+    Args:
+        adc_P: 気圧の生データ
+        t_fine: compensate_T で求めた t_fine
+        dig_P: 気圧の補正値
+
+    Returns:
+        補正後の値[Pa/256](計算できないときは0)
+    """
+    adc_P = np.asarray(adc_P, dtype=np.int64)
+    P1, P2, P3, P4, P5, P6, P7, P8, P9 = (np.int64(value) for value in dig_P)
+    var1: np.ndarray = t_fine - 128000
+    var2: np.ndarray = var1 * var1 * P6
+    var2 = var2 + ((var1 * P5) << 17)
+    var2 = var2 + (P4 << 35)
+    var1 = ((var1 * var1 * P3) >> 8) + ((var1 * P2) << 12)
+    var1 = ((np.int64(1) << 47) + var1) * P1 >> 33
+    valid: np.ndarray = var1 != 0
+    p: np.ndarray = 1048576 - adc_P
+    p = trunc_div(((p << 31) - var2) * 3125, np.where(valid, var1, 1))
+    var1 = (P9 * (p >> 13) * (p >> 13)) >> 25
+    var2 = (P8 * p) >> 19
+    p = ((p + var1 + var2) >> 8) + (P7 << 4)
+    # C では unsigned int で返す
+    return np.where(valid, p & 0xFFFFFFFF, 0)
+
+
+def compensate_H(adc_H: np.ndarray, t_fine: np.ndarray, dig_H: typ.Sequence[int]) -> np.ndarray:
+    """湿度を補正する.
+
+    Args:
+        adc_H: 湿度の生データ
+        t_fine: compensate_T で求めた t_fine
+        dig_H: 湿度の補正値
+
+    Returns:
+        補正後の値[%/1024]
+    """
+    adc_H = np.asarray(adc_H, dtype=np.int64)
+    H1, H2, H3, H4, H5, H6 = (np.int64(value) for value in dig_H)
+    v: np.ndarray = t_fine - 76800
+    v = ((((adc_H << 14) - (H4 << 20) - (H5 * v)) + 16384) >> 15) * (
+        ((((((v * H6) >> 10) * (((v * H3) >> 11) + 32768)) >> 10) + 2097152) * H2 + 8192) >> 14
+    )
+    v = v - (((((v >> 15) * (v >> 15)) >> 7) * H1) >> 4)
+    v = np.clip(v, 0, 419430400)
+    return v >> 12
+
+
+def compensate(
+    adc_P: np.ndarray,
+    adc_T: np.ndarray,
+    adc_H: np.ndarray,
+    dig_T: typ.Sequence[int],
+    dig_P: typ.Sequence[int],
+    dig_H: typ.Sequence[int],
+) -> typ.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """生データを補正して、BME280.read と同じ単位にする.
+
+    Args:
+        adc_P: 気圧の生データ
+        adc_T: 温度の生データ
+        adc_H: 湿度の生データ
+        dig_T: 温度の補正値
+        dig_P: 気圧の補正値
+        dig_H: 湿度の補正値
+
+    Returns:
+        気圧[hPa], 気温[℃], 湿度[%]
+    """
+    temp, t_fine = compensate_T(adc_T, dig_T)
+    pres: np.ndarray = compensate_P(adc_P, t_fine, dig_P)
+    hum: np.ndarray = compensate_H(adc_H, t_fine, dig_H)
+    return pres / 256 / 100, temp / 100, hum / 1024
+
+
+def check(reference: str, count: int, seed: int) -> bool:
+    """C の補正式(test/bme280.cc の --batch)と結果を比べる.
+
+    生データは、温度が -40〜85℃、気圧が 300〜1100hPa(センサの動作範囲)になる範囲から、乱数で選ぶ。
+
+    Args:
+        reference: test/bme280.cc をコンパイルした実行ファイル
+        count: 比べる生データの数
+        seed: 乱数の種
+
+    Returns:
+        全て一致したか
+    """
+    dig_T, dig_P, dig_H = REFERENCE_CALIBRATION
+    rng: np.random.Generator = np.random.default_rng(seed)
+    adc_P: np.ndarray = rng.integers(0, 1 << 20, count * 10)
+    adc_T: np.ndarray = rng.integers(0, 1 << 20, count * 10)
+    adc_H: np.ndarray = rng.integers(0, 1 << 16, count * 10)
+    temp, t_fine = compensate_T(adc_T, dig_T)
+    pres: np.ndarray = compensate_P(adc_P, t_fine, dig_P)
+    valid: np.ndarray = (temp >= -4000) & (temp <= 8500) & (pres >= 300 * 100 * 256) & (pres <= 1100 * 100 * 256)
+    adc_P, adc_T, adc_H = (adc[valid][:count] for adc in (adc_P, adc_T, adc_H))
+    temp, t_fine = compensate_T(adc_T, dig_T)
+    expected: np.ndarray = np.stack(
+        [t_fine, temp, compensate_P(adc_P, t_fine, dig_P), compensate_H(adc_H, t_fine, dig_H)], axis=1
+    )
+    stdin: str = " ".join(str(value) for value in [*dig_T, *dig_P, *dig_H]) + "\n"
+    stdin += "".join(f"{p} {t} {h}\n" for p, t, h in zip(adc_P, adc_T, adc_H))
+    result: subprocess.CompletedProcess = subprocess.run(
+        [reference, "--batch"], input=stdin, capture_output=True, text=True, check=True
+    )
+    actual: np.ndarray = np.loadtxt(result.stdout.splitlines(), dtype=np.int64, ndmin=2)
+    mismatch: np.ndarray = np.flatnonzero((actual != expected).any(axis=1))
+    for i in mismatch[:10]:
+        print(f"mismatch: p={adc_P[i]} t={adc_T[i]} h={adc_H[i]}: C={actual[i].tolist()} NumPy={expected[i].tolist()}")
+    print(f"{len(expected) - len(mismatch)}/{len(expected)} matched")
+    return len(mismatch) == 0
+
+
+def recompensate(
+    store: db_store.DBStore,
+    start_time: datetime.datetime,
+    end_time: datetime.datetime,
+    calibration_id: typ.Optional[int],
+    update: bool,
+) -> None:
+    """記録した生データを補正し直す.
+
+    Args:
+        store: DBストア
+        start_time: 範囲の最初(start_timeを含む)
+        end_time: 範囲の最後(end_timeを含まない)
+        calibration_id: 全てのデータをこの calibration data で補正する(Noneのときは記録したときのもの)
+        update: bme280_log の値を補正し直した値で更新するか
+    """
+    calibrations: typ.Dict[int, typ.Any] = {row["id"]: row for row in store.select_bme280_calibration()}
+    rows: typ.List = store.select_bme280_raw_log(start_time, end_time)
+    if len(rows) == 0:
+        print("no data")
+        return
+    data: np.ndarray = np.array([row[:5] for row in rows], dtype=np.int64)
+    stored: np.ndarray = np.array([row[5:8] for row in rows], dtype=np.float64)
+    if calibration_id is not None:
+        data[:, 1] = calibration_id
+    result: np.ndarray = np.empty((len(data), 3))
+    for cid in np.unique(data[:, 1]):
+        target: np.ndarray = data[:, 1] == cid
+        calibration: typ.Any = calibrations[int(cid)]
+        pres, temp, hum = compensate(
+            data[target, 2],
+            data[target, 3],
+            data[target, 4],
+            calibration["dig_t"],
+            calibration["dig_p"],
+            calibration["dig_h"],
+        )
+        result[target] = np.stack([temp, pres, hum], axis=1)
+    diff: np.ndarray = np.abs(result - stored)
+    print(f"{len(data)} rows")
+    for i, name in enumerate(["temp", "pressure", "humidity"]):
+        print(f"{name}: max diff {np.nanmax(diff[:, i]):g}, changed {int((diff[:, i] > 1e-3).sum())} rows")
+    if update:
+        store.update_bme280_log([(int(i), *values) for i, values in zip(data[:, 0], result.tolist())])
+        print("updated")
+
+
+def main() -> None:
+    """メイン処理."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_run: argparse.ArgumentParser = subparsers.add_parser("run", help="recompensate logged raw data")
+    parser_run.add_argument("-s", "--start", help="start time (default: 2000-01-01)", default="2000-01-01")
+    parser_run.add_argument("-e", "--end", help="end time (default: now)")
+    parser_run.add_argument("-c", "--calibration", type=int, help="use this calibration id for all rows")
+    parser_run.add_argument("-u", "--update", action="store_true", help="update bme280_log")
+    parser_check: argparse.ArgumentParser = subparsers.add_parser("check", help="compare with the C reference")
+    parser_check.add_argument("-r", "--reference", help="reference executable", default="test/bme280")
+    parser_check.add_argument("-n", "--count", type=int, help="number of samples", default=10000)
+    parser_check.add_argument("--seed", type=int, help="random seed", default=0)
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.command == "check":
+        if not check(args.reference, args.count, args.seed):
+            raise SystemExit(1)
+        return
+
+    end_time: datetime.datetime = datetime.datetime.now()
+    if args.end:
+        end_time = datetime.datetime.fromisoformat(args.end)
+    start_time: datetime.datetime = datetime.datetime.fromisoformat(args.start)
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+    recompensate(db_store.DBStore(db_url), start_time, end_time, args.calibration, args.update)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""MH-Z19 を別スレッドで読み込む.
+
+センサーとのシリアル通信は専用のスレッドで一定間隔に行い、最後に読めた値を時刻と一緒に持っておく。
+収集側のループは latest で最後の値を取り出すだけなので、センサーが応答しなくても止まらない。
+古くなった値(max_age より前に読んだ値)は返さない。
+"""
+
+import datetime
+import threading
+import time
+import typing as typ
+import periodic
+
+
+def read_mh_z19() -> typ.Dict:
+    """MH-Z19 を読み込む.
+
+    Returns:
+        mh_z19.read_all の結果(読めなかったときは co2 がない)
+    """
+    import mh_z19  # type: ignore
+
+    return mh_z19.read_all(serial_console_untouched=True)
+
+
+class CO2Reader(periodic.PeriodicWorker):
+    """MH-Z19 を別スレッドで読み込む."""
+
+    def __init__(
+        self, interval: float = 10.0, max_age: float = 120.0, read: typ.Callable[[], typ.Dict] = read_mh_z19
+    ) -> None:
+        """初期化.
+
+        Args:
+            interval: 読み込む間隔[秒]
+            max_age: この秒数より前に読んだ値は返さない
+            read: 読み込む関数(co2 を含む dict を返す)
+        """
+        super().__init__()
+        self.interval: float = interval
+        self.max_age: float = max_age
+        self.read: typ.Callable[[], typ.Dict] = read
+        self.lock: threading.Lock = threading.Lock()
+        self.value: typ.Optional[typ.Dict] = None
+        self.read_at: float = 0.0  # 最後に読めた時刻(time.monotonic)
+
+    def tasks(self) -> typ.List[typ.Tuple[float, typ.Callable[[], None]]]:
+        """行う処理.
+
+        Returns:
+            interval ごとに読み込む
+        """
+        return [(self.interval, self.poll)]
+
+    def poll(self) -> None:
+        """読み込んで、読めたら値を更新する."""
+        try:
+            d: typ.Dict = self.read()
+        except Exception as e:
+            print(f"MH_Z19 エラー: {e}", flush=True)
+            d = {}
+        if "co2" in d:
+            d = {**d, "created_at": datetime.datetime.now()}
+            with self.lock:
+                self.value = d
+                self.read_at = time.monotonic()
+
+    def latest(self) -> typ.Optional[typ.Dict]:
+        """最後に読めた値を返す.
+
+        Returns:
+            mh_z19.read_all の結果に読んだ時刻(created_at)を加えたもの。読めていないときや、
+            古くなったときはNone
+        """
+        with self.lock:
+            if self.value is None or time.monotonic() - self.read_at > self.max_age:
+                return None
+            return self.value
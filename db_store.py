@@ -1,10 +1,30 @@
 """DBストア."""
 
 import datetime
+import json
+import select
 import typing as typ
 import psycopg2  # type: ignore
 import psycopg2.extensions  # type: ignore
 import psycopg2.extras  # type: ignore
+import psycopg2.sql  # type: ignore
+
+# select_bucketed_log で取得できる系列(系列名: (テーブル名, 時間単位で集計する式))
+BUCKET_SERIES: typ.Dict[str, typ.Tuple[str, str]] = {
+    "temp": ("temp_log", "avg(temp)::float8 / 1000"),
+    "co2": ("co2_log", "avg(co2)::float8"),
+    "temp2": ("co2_log", "avg(temp)::float8"),
+    "temp3": ("bme280_log", "avg(temp)::float8"),
+    "pressure": ("bme280_log", "avg(pressure)::float8"),
+    "humidity": ("bme280_log", "avg(humidity)::float8"),
+    "illuminance": ("tsl2572_log", "avg(illuminance)::float8"),
+}
+
+# create_log_table で使える列の型
+LOG_COLUMN_TYPES: typ.Set[str] = {"int", "bigint", "real", "float8", "text", "boolean"}
+
+# 登録したときに NOTIFY するテーブル(チャンネル名はテーブル名)
+NOTIFY_CHANNELS: typ.Tuple[str, ...] = ("power_log", "temp_log", "co2_log", "bme280_log", "tsl2572_log")
 
 
 class DBStore:
@@ -40,6 +60,48 @@ class DBStore:
             self.connection.close()
             self.connection = None
 
+    def notify(self, channel: str, payload: typ.Dict) -> None:
+        """NOTIFYで登録したデータを通知する.
+
+        通知はcommitしたときに送られる。
+
+        Args:
+            channel: チャンネル名(テーブル名)
+            payload: 通知するデータ(JSONにする)
+        """
+        self.cursor.execute("select pg_notify(%s, %s)", (channel, json.dumps(payload, default=str, ensure_ascii=False)))
+
+    def listen(self, *channels: str) -> None:
+        """LISTENを開始する.
+
+        通知をすぐに受け取れるように、接続をautocommitにする。
+
+        Args:
+            channels: チャンネル名(テーブル名)
+        """
+        self.connection.autocommit = True
+        for channel in channels:
+            self.cursor.execute(psycopg2.sql.SQL("listen {}").format(psycopg2.sql.Identifier(channel)))
+
+    def wait_notifies(self, timeout: float) -> typ.List[typ.Tuple[str, typ.Dict]]:
+        """通知を待つ.
+
+        Args:
+            timeout: タイムアウト[秒]
+
+        Returns:
+            (チャンネル名, データ)のリスト(タイムアウトしたときは空)
+        """
+        self.connection.poll()
+        if len(self.connection.notifies) == 0:
+            if select.select([self.connection], [], [], timeout) != ([], [], []):
+                self.connection.poll()
+        result: typ.List[typ.Tuple[str, typ.Dict]] = [
+            (notify.channel, json.loads(notify.payload)) for notify in self.connection.notifies
+        ]
+        del self.connection.notifies[:]
+        return result
+
     def scan_log(self, channel: int, channel_page: int, pan_id: int, addr: str, lqi: int, pair_id: str) -> None:
         """SKSCANの結果を登録する.
 
@@ -77,9 +139,11 @@ class DBStore:
             瞬時電流_T: 瞬時電流計測値(T相)
         """
         self.cursor.execute(
-            "insert into power_log (係数, 積算電力量, 電力量単位, 瞬時電力, 瞬時電流_R, 瞬時電流_T) values (%s, %s, %s, %s, %s, %s)",
+            "insert into power_log (係数, 積算電力量, 電力量単位, 瞬時電力, 瞬時電流_R, 瞬時電流_T) values (%s, %s, %s, %s, %s, %s)"
+            " returning *",
             (係数, 積算電力量, 電力量単位, 瞬時電力, 瞬時電流_R, 瞬時電流_T),
         )
+        self.notify("power_log", dict(self.cursor.fetchone()))
         self.connection.commit()
 
     def temp_log(self, temp: int) -> None:
@@ -88,7 +152,8 @@ class DBStore:
         Args:
             temp: 温度
         """
-        self.cursor.execute("insert into temp_log (temp) values (%s)", (temp,))
+        self.cursor.execute("insert into temp_log (temp) values (%s) returning *", (temp,))
+        self.notify("temp_log", dict(self.cursor.fetchone()))
         self.connection.commit()
 
     def co2_log(self, co2: int, temp: int, pressure: int, ss: int) -> None:
@@ -101,20 +166,70 @@ class DBStore:
             ss: status
         """
         self.cursor.execute(
-            "insert into co2_log (co2, temp, pressure, ss) values (%s, %s, %s, %s)", (co2, temp, pressure, ss)
+            "insert into co2_log (co2, temp, pressure, ss) values (%s, %s, %s, %s) returning *",
+            (co2, temp, pressure, ss),
         )
+        self.notify("co2_log", dict(self.cursor.fetchone()))
         self.connection.commit()
 
-    def bme280_log(self, temp: float, pressure: float, humidity: float) -> None:
+    def bme280_log(self, temp: float, pressure: float, humidity: float) -> int:
         """BM280の計測結果を登録する.
 
         Args:
             temp: 温度
             pressure: 気圧
             humidity: 湿度
+
+        Returns:
+            登録した行の id
+        """
+        self.cursor.execute(
+            "insert into bme280_log (temp, pressure, humidity) values (%s, %s, %s) returning *",
+            (temp, pressure, humidity),
+        )
+        row: typ.Dict = dict(self.cursor.fetchone())
+        self.notify("bme280_log", row)
+        self.connection.commit()
+        return row["id"]
+
+    def bme280_calibration(self, dig_T: typ.List[int], dig_P: typ.List[int], dig_H: typ.List[int]) -> int:
+        """BME280の calibration data を登録する(同じものが登録済みなら、それを使う).
+
+        Args:
+            dig_T: 温度の補正値
+            dig_P: 気圧の補正値
+            dig_H: 湿度の補正値
+
+        Returns:
+            calibration data の id
         """
         self.cursor.execute(
-            "insert into bme280_log (temp, pressure, humidity) values (%s, %s, %s)", (temp, pressure, humidity)
+            "select id from bme280_calibration where dig_t = %s and dig_p = %s and dig_h = %s order by id desc limit 1",
+            (dig_T, dig_P, dig_H),
+        )
+        row: typ.Optional[psycopg2.extras.DictRow] = self.cursor.fetchone()
+        if row is None:
+            self.cursor.execute(
+                "insert into bme280_calibration (dig_t, dig_p, dig_h) values (%s, %s, %s) returning id",
+                (dig_T, dig_P, dig_H),
+            )
+            row = self.cursor.fetchone()
+            self.connection.commit()
+        return row["id"]
+
+    def bme280_raw_log(self, log_id: int, calibration_id: int, adc_P: int, adc_T: int, adc_H: int) -> None:
+        """BME280の生データを登録する.
+
+        Args:
+            log_id: 補正後の値を登録した bme280_log の id
+            calibration_id: 補正に使った calibration data の id
+            adc_P: 気圧の生データ
+            adc_T: 温度の生データ
+            adc_H: 湿度の生データ
+        """
+        self.cursor.execute(
+            "insert into bme280_raw_log (id, calibration_id, adc_p, adc_t, adc_h) values (%s, %s, %s, %s, %s)",
+            (log_id, calibration_id, adc_P, adc_T, adc_H),
         )
         self.connection.commit()
 
@@ -129,9 +244,10 @@ class DBStore:
             ch1: ch1
         """
         self.cursor.execute(
-            "insert into tsl2572_log (illuminance, lux1, lux2, ch0, ch1) values (%s, %s, %s, %s, %s)",
+            "insert into tsl2572_log (illuminance, lux1, lux2, ch0, ch1) values (%s, %s, %s, %s, %s) returning *",
             (illuminance, lux1, lux2, ch0, ch1),
         )
+        self.notify("tsl2572_log", dict(self.cursor.fetchone()))
         self.connection.commit()
 
     def select_scan_log(
@@ -152,6 +268,44 @@ class DBStore:
         )
         return self.cursor.fetchall()
 
+    def create_log_table(self, table: str, columns: typ.Sequence[typ.Tuple[str, str]]) -> None:
+        """計測値のテーブルがなければ作る(id と created_at は自動で付ける).
+
+        Args:
+            table: テーブル名
+            columns: (列名, 型)のリスト(型は LOG_COLUMN_TYPES のどれか)
+        """
+        definitions: typ.List[psycopg2.sql.Composable] = [psycopg2.sql.SQL("id serial primary key")]
+        for name, column_type in columns:
+            if column_type not in LOG_COLUMN_TYPES:
+                raise ValueError(f"{table}.{name}: unsupported type: {column_type}")
+            definitions.append(
+                psycopg2.sql.SQL("{} {}").format(psycopg2.sql.Identifier(name), psycopg2.sql.SQL(column_type))
+            )
+        definitions.append(psycopg2.sql.SQL("created_at timestamp not null default current_timestamp"))
+        self.cursor.execute(
+            psycopg2.sql.SQL("create table if not exists {} ({})").format(
+                psycopg2.sql.Identifier(table), psycopg2.sql.SQL(", ").join(definitions)
+            )
+        )
+        self.connection.commit()
+
+    def insert_log_rows(self, table: str, columns: typ.Sequence[str], rows: typ.Sequence[typ.Sequence]) -> None:
+        """計測値をまとめて登録する(最後の行を NOTIFY する).
+
+        Args:
+            table: テーブル名
+            columns: 列名のリスト(最後は created_at)
+            rows: 登録するデータ
+        """
+        query: psycopg2.sql.Composed = psycopg2.sql.SQL("insert into {} ({}) values %s returning *").format(
+            psycopg2.sql.Identifier(table), psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, columns))
+        )
+        result: typ.List = psycopg2.extras.execute_values(self.cursor, query, rows, fetch=True)
+        if len(result) > 0:
+            self.notify(table, dict(result[-1]))
+        self.connection.commit()
+
     def select_power_log(
         self, start_time: datetime.datetime, end_time: datetime.datetime
     ) -> typ.List[psycopg2.extras.DictRow]:
@@ -224,6 +378,51 @@ class DBStore:
         )
         return self.cursor.fetchall()
 
+    def select_bme280_calibration(self) -> typ.List[psycopg2.extras.DictRow]:
+        """bme280_calibrationからデータ取得.
+
+        Returns:
+            データ
+        """
+        self.cursor.execute("select * from bme280_calibration order by id")
+        return self.cursor.fetchall()
+
+    def select_bme280_raw_log(
+        self, start_time: datetime.datetime, end_time: datetime.datetime
+    ) -> typ.List[psycopg2.extras.DictRow]:
+        """bme280_raw_logから、補正後の値と合わせてデータ取得.
+
+        Args:
+            start_time: 取得範囲の最初(start_timeを含む)
+            end_time: 取得範囲の最初(end_timeを含まない)
+
+        Returns:
+            データ(id, calibration_id, adc_p, adc_t, adc_h, temp, pressure, humidity, created_at)
+        """
+        self.cursor.execute(
+            "select r.id, r.calibration_id, r.adc_p, r.adc_t, r.adc_h, l.temp, l.pressure, l.humidity, l.created_at"
+            " from bme280_raw_log r join bme280_log l on l.id = r.id"
+            " where l.created_at >= %s and l.created_at < %s order by l.created_at",
+            (start_time, end_time),
+        )
+        return self.cursor.fetchall()
+
+    def update_bme280_log(self, rows: typ.Sequence[typ.Tuple[int, float, float, float]]) -> None:
+        """bme280_logの値をまとめて更新する.
+
+        Args:
+            rows: (id, 温度, 気圧, 湿度)のリスト
+        """
+        psycopg2.extras.execute_values(
+            self.cursor,
+            "update bme280_log set temp = v.temp, pressure = v.pressure, humidity = v.humidity"
+            " from (values %s) as v (id, temp, pressure, humidity) where bme280_log.id = v.id",
+            rows,
+            template="(%s, %s::real, %s::real, %s::real)",
+            page_size=10000,
+        )
+        self.connection.commit()
+
     def select_tsl2572_log(
         self, start_time: datetime.datetime, end_time: datetime.datetime
     ) -> typ.List[psycopg2.extras.DictRow]:
@@ -242,11 +441,80 @@ class DBStore:
         )
         return self.cursor.fetchall()
 
-    def select_latest_log(self, moving_start: datetime.datetime) -> typ.Dict:
+    def select_bucketed_log(
+        self,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+        bucket: datetime.timedelta,
+        series: typ.Sequence[str],
+    ) -> typ.List[psycopg2.extras.DictRow]:
+        """複数のテーブルのデータを、時間単位で集計して横に並べて取得.
+
+        区間はエポックからの bucket の倍数で区切るので、1分なら毎分0秒、30分なら毎時0分と30分から始まる。
+        どの系列にもデータがない区間は返さない。
+
+        Args:
+            start_time: 取得範囲の最初(start_timeを含む)
+            end_time: 取得範囲の最初(end_timeを含まない)
+            bucket: 集計する区間の幅
+            series: 系列名(BUCKET_SERIESのキー)のリスト
+
+        Returns:
+            データ(time列は区間の開始時刻、以降は系列名の列)
+        """
+        tables: typ.Dict[str, typ.List[str]] = {}
+        for name in series:
+            if name not in BUCKET_SERIES:
+                raise ValueError(f"unknown series: {name}")
+            tables.setdefault(BUCKET_SERIES[name][0], []).append(name)
+        bucket_expr: str = "'epoch'::timestamp + floor(extract(epoch from {}) / %(seconds)s) * %(width)s"
+        joins: typ.List[str] = []
+        for index, (table, names) in enumerate(tables.items()):
+            aggregates: str = ", ".join(f"{BUCKET_SERIES[name][1]} as {name}" for name in names)
+            joins.append(
+                f"left join (select {bucket_expr.format('created_at')} as time, {aggregates} from {table}"
+                f" where created_at >= %(start)s and created_at < %(end)s group by 1) as t{index} using (time)"
+            )
+        columns: str = ", ".join(series)
+        first_bucket: str = bucket_expr.format("%(start)s::timestamp")
+        self.cursor.execute(
+            f"select time, {columns}"
+            f" from generate_series({first_bucket}, %(end)s::timestamp - interval '1 microsecond', %(width)s) as time"
+            f" {' '.join(joins)} where num_nonnulls({columns}) > 0 order by time",
+            {"start": start_time, "end": end_time, "width": bucket, "seconds": bucket.total_seconds()},
+        )
+        return self.cursor.fetchall()
+
+    def select_power_counter(
+        self, start_time: datetime.datetime, end_time: datetime.datetime, bucket: datetime.timedelta
+    ) -> typ.List[psycopg2.extras.DictRow]:
+        """power_logから、区間ごとの最後の積算電力量を取得.
+
+        区間は select_bucketed_log と同じく、エポックからの bucket の倍数で区切る。
+
+        Args:
+            start_time: 取得範囲の最初(start_timeを含む)
+            end_time: 取得範囲の最初(end_timeを含まない)
+            bucket: 区間の幅
+
+        Returns:
+            データ(time列は区間の開始時刻、以降は 係数, 積算電力量, 電力量単位)
+        """
+        self.cursor.execute(
+            "select distinct on (time)"
+            " 'epoch'::timestamp + floor(extract(epoch from created_at) / %(seconds)s) * %(width)s as time,"
+            " 係数, 積算電力量, 電力量単位 from power_log"
+            " where created_at >= %(start)s and created_at < %(end)s and 積算電力量 is not null"
+            " order by time, created_at desc",
+            {"start": start_time, "end": end_time, "width": bucket, "seconds": bucket.total_seconds()},
+        )
+        return self.cursor.fetchall()
+
+    def select_latest_log(self, moving_start: typ.Optional[datetime.datetime]) -> typ.Dict:
         """最新のログを返す.
 
         Args:
-            moving_start: 移動平均の開始時刻(含まない)
+            moving_start: 移動平均の開始時刻(含まない。Noneのときは移動平均を取得しない)
 
         Returns:
             最新のログ
@@ -254,11 +522,13 @@ class DBStore:
         result: typ.Dict = {}
         self.cursor.execute("select * from power_log order by created_at desc limit 1")
         result["power"] = self.cursor.fetchone()
-        self.cursor.execute(
-            "select avg(瞬時電力) as 瞬時電力, avg(瞬時電流_r + 瞬時電流_t) as 瞬時電流 from power_log where created_at > %s",
-            (moving_start,),
-        )
-        result["power_average"] = self.cursor.fetchone()
+        if moving_start is not None:
+            self.cursor.execute(
+                "select avg(瞬時電力) as 瞬時電力, avg(瞬時電流_r + 瞬時電流_t) as 瞬時電流 from power_log"
+                " where created_at > %s",
+                (moving_start,),
+            )
+            result["power_average"] = self.cursor.fetchone()
         self.cursor.execute("select * from temp_log order by created_at desc limit 1")
         result["temp"] = self.cursor.fetchone()
         self.cursor.execute("select * from co2_log order by created_at desc limit 1")
@@ -0,0 +1,153 @@
+"""収集側からディスプレイ側に計測値を送る.
+
+収集側(power_consumption.py -d)は、1分ごとに計測値を固定長の構造体にして、Unix ドメインソケット(データグラム)に送る。
+ディスプレイ側(display_controller.py)はソケットを bind して受け取るので、ファイルの監視も YAML のパースもいらない。
+値がないときは NaN を送る。
+
+ディスプレイ側が動いていないときやソケットの受信キューがいっぱいのときは、送らずに捨てる(収集側は待たない)。
+"""
+
+import dataclasses
+import math
+import os
+import socket
+import struct
+import time
+import typing as typ
+
+# 構造体の版(レイアウトを変えたら上げる)
+VERSION: int = 1
+# 版、送った時刻、CO₂濃度、気温、湿度、気圧、瞬時電力、瞬時電力の移動平均、瞬時電流(R相とT相の合計)
+PACKET: struct.Struct = struct.Struct("<B7xdddddddd")
+
+
+@dataclasses.dataclass
+class DisplayData:
+    """ディスプレイに表示する計測値."""
+
+    timestamp: float = 0.0  # 送った時刻(time.time)
+    co2: typ.Optional[float] = None  # CO₂濃度[ppm]
+    temp: typ.Optional[float] = None  # 気温[℃]
+    hum: typ.Optional[float] = None  # 湿度[%]
+    pres: typ.Optional[float] = None  # 気圧[hPa]
+    power: typ.Optional[float] = None  # 瞬時電力[W]
+    power_avg: typ.Optional[float] = None  # 瞬時電力の移動平均[W]
+    current: typ.Optional[float] = None  # 瞬時電流[A]
+
+
+def pack(data: DisplayData) -> bytes:
+    """計測値を構造体にする.
+
+    Args:
+        data: 計測値
+
+    Returns:
+        構造体
+    """
+    values: typ.List[float] = [math.nan if value is None else value for value in dataclasses.astuple(data)[1:]]
+    return PACKET.pack(VERSION, data.timestamp, *values)
+
+
+def unpack(packet: bytes) -> typ.Optional[DisplayData]:
+    """構造体を計測値に戻す.
+
+    Args:
+        packet: 構造体
+
+    Returns:
+        計測値(長さや版が違うときはNone)
+    """
+    if len(packet) != PACKET.size:
+        return None
+    version, timestamp, *values = PACKET.unpack(packet)
+    if version != VERSION:
+        return None
+    return DisplayData(timestamp, *(None if math.isnan(value) else value for value in values))
+
+
+class DisplaySender:
+    """計測値を送る側."""
+
+    def __init__(self, path: str) -> None:
+        """初期化.
+
+        Args:
+            path: ソケットのパス
+        """
+        self.path: str = path
+        self.sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, data: DisplayData) -> bool:
+        """計測値を送る.
+
+        Args:
+            data: 計測値(timestamp が0のときは今の時刻にする)
+
+        Returns:
+            送れたか(受け取る側がいないときや、受信キューがいっぱいのときは False)
+        """
+        if data.timestamp == 0.0:
+            data = dataclasses.replace(data, timestamp=time.time())
+        try:
+            self.sock.sendto(pack(data), self.path)
+        except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+            return False
+        return True
+
+    def close(self) -> None:
+        """ソケットを閉じる."""
+        self.sock.close()
+
+
+class DisplayReceiver:
+    """計測値を受け取る側."""
+
+    def __init__(self, path: str) -> None:
+        """初期化(前回のソケットが残っていたら消してから bind する).
+
+        Args:
+            path: ソケットのパス
+        """
+        self.path: str = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def fileno(self) -> int:
+        """ソケットのファイルディスクリプタ(selectors などで待つとき用).
+
+        Returns:
+            ファイルディスクリプタ
+        """
+        return self.sock.fileno()
+
+    def receive(self, timeout: typ.Optional[float] = None) -> typ.Optional[DisplayData]:
+        """計測値を受け取る(溜まっているときは最新のものだけを返す).
+
+        Args:
+            timeout: 待つ時間[秒](Noneのときは届くまで待つ、0のときは待たない)
+
+        Returns:
+            計測値(届かなかったときはNone)
+        """
+        latest: typ.Optional[DisplayData] = None
+        self.sock.settimeout(timeout)
+        try:
+            packet: bytes = self.sock.recv(PACKET.size + 1)
+        except (socket.timeout, BlockingIOError):
+            return None
+        self.sock.setblocking(False)
+        while True:
+            latest = unpack(packet) or latest
+            try:
+                packet = self.sock.recv(PACKET.size + 1)
+            except BlockingIOError:
+                return latest
+
+    def close(self) -> None:
+        """ソケットを閉じて、パスを消す."""
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
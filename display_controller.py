@@ -1,13 +1,35 @@
-"""スマートメーターから電力消費量を読むよ."""
+"""スマートメーターから電力消費量を読むよ.
 
-import configparser
+ディスプレイの制御は、1つのスレッド(main)のイベントループで行う。
+収集側からの計測値(display_channel のソケット)、ボタンのイベント、自動で消す時刻を selectors でまとめて待つ。
+gpiozero のコールバックは別スレッドで呼ばれるので、イベントをキューに入れて self-pipe に書き込むだけにして、
+ディスプレイには触らない。画面は、表示する内容が変わったときだけ送る。
+
+画面は複数あり、画面が点いているときにボタンを押すと次の画面にする。
+電力と CO₂濃度の直近1時間の折れ線は、受け取った値を入れたリングバッファから描くので、DB には問い合わせない。
+"""
 
+import configparser
+import os
+import queue
+import selectors
 import time
-import yaml  # type: ignore
+import typing as typ
 import gpiozero  # type: ignore
-from watchfiles import watch
+import display_channel
+import ring_buffer
 from oled_ssd1306 import Display
 
+# ボタンのイベント
+PRESSED: str = "pressed"
+RELEASED: str = "released"
+
+# 画面(環境、電力、電力の折れ線、CO₂濃度の折れ線)
+SCREENS: typ.List[str] = ["env", "power", "power_graph", "co2_graph"]
+# 折れ線の値の間隔[秒]と数(直近1時間)
+HISTORY_INTERVAL: float = 60
+HISTORY_SIZE: int = 60
+
 
 class DisplayController:
     """LEDの表示と制御をつかさどるクラス."""
@@ -17,49 +39,163 @@ class DisplayController:
         inifile: configparser.ConfigParser = configparser.ConfigParser()
         inifile.read("power_consumption.ini", "utf-8")
         self.inifile: configparser.ConfigParser = inifile
+        # ボタンのイベント(gpiozero のスレッドから入れる)と、イベントループを起こすための self-pipe
+        self.events: queue.SimpleQueue = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.data: display_channel.DisplayData = display_channel.DisplayData()  # 最後に受け取った値
+        self.history: typ.Dict[str, ring_buffer.RingBuffer] = {
+            "power": ring_buffer.RingBuffer(HISTORY_SIZE, HISTORY_INTERVAL),
+            "co2": ring_buffer.RingBuffer(HISTORY_SIZE, HISTORY_INTERVAL),
+        }
+        self.screen: int = 0  # 表示している画面(screens の番号)
+        self.last_values: typ.Optional[typ.Tuple] = None  # 最後に描いた画面と値
+        self.dirty: bool = False  # 描いたが、まだ送っていない
 
     def main(self) -> None:
         """メイン処理."""
         display_address: int = self.inifile.getint("ssd1306", "address", fallback=0x3C)
-        self.data_path: str = self.inifile.get("ssd1306", "data_path", fallback="display.dat")
+        socket_path: str = self.inifile.get("ssd1306", "socket", fallback="display.sock")
         button_pin: str = self.inifile.get("ssd1306", "pin", fallback="4")
         button_pull_up: bool = self.inifile.getboolean("ssd1306", "pull_up", fallback=False)
         contrast: int = self.inifile.getint("ssd1306", "contrast", fallback=1)
+        self.timeout: float = self.inifile.getfloat("ssd1306", "timeout", fallback=30)
+        screens: str = self.inifile.get("ssd1306", "screens", fallback=",".join(SCREENS))
+        self.screens: typ.List[str] = [screen.strip() for screen in screens.split(",") if screen.strip() in SCREENS]
         self.display = Display(display_address, contrast)
         self.button: gpiozero.Button = gpiozero.Button(button_pin, pull_up=button_pull_up)
         self.is_pressed: bool = self.button.is_pressed
         if not self.is_pressed:
             self.display.clear()
-        self.last_released: float = time.perf_counter()
-        self.button.when_pressed = self.pressed
-        self.button.when_released = self.released
+        self.off_at: float = time.monotonic() + self.timeout  # ボタンが離されているとき、画面を消す時刻
+        self.button.when_pressed = lambda: self.post(PRESSED)
+        self.button.when_released = lambda: self.post(RELEASED)
+
+        receiver: display_channel.DisplayReceiver = display_channel.DisplayReceiver(socket_path)
+        selector: selectors.BaseSelector = selectors.DefaultSelector()
+        selector.register(receiver, selectors.EVENT_READ, lambda: self.receive(receiver))
+        selector.register(self.wakeup_r, selectors.EVENT_READ, self.handle_events)
+        try:
+            while True:
+                for key, _ in selector.select(self.wait_time()):
+                    key.data()
+                self.check_timeout()
+                self.flush()
+        finally:
+            selector.close()
+            receiver.close()
+
+    def post(self, event: str) -> None:
+        """イベントループにボタンのイベントを渡す(gpiozero のスレッドから呼ぶ).
+
+        Args:
+            event: イベント
+        """
+        self.events.put(event)
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:  # パイプがいっぱいのときは、もう起こしてある
+            pass
+
+    def wait_time(self) -> typ.Optional[float]:
+        """イベントを待つ時間.
 
-        self.update()
+        Returns:
+            画面を消すまでの秒数(消す予定がないときはNone)
+        """
+        if not self.display.is_display or self.is_pressed:
+            return None
+        return max(self.off_at - time.monotonic(), 0)
 
-        for changes in watch(self.data_path):
-            self.update()
+    def handle_events(self) -> None:
+        """ボタンのイベントを処理する."""
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.events.empty():
+            event: str = self.events.get()
+            if event == PRESSED:
+                self.pressed()
+            elif event == RELEASED:
+                self.released()
 
     def pressed(self) -> None:
-        """ボタンが押されたとき."""
+        """ボタンが押されたとき(画面が点いているときは次の画面にする)."""
         self.is_pressed = True
         if not self.display.is_display:
             self.display.redraw()
+            self.dirty = False
+        elif len(self.screens) > 1:
+            self.screen = (self.screen + 1) % len(self.screens)
+            self.render()
 
     def released(self) -> None:
         """ボタンが離されたとき."""
         self.is_pressed = False
-        self.last_released = time.perf_counter()
-
-    def update(self) -> None:
-        """画面を更新する."""
-        with open(self.data_path, "r") as f:
-            data = yaml.safe_load(f)
-        self.display.update(data["co2"], data["temp"], data["hum"], data["pres"])
-        if self.display.is_display:
-            if not self.is_pressed and time.perf_counter() > self.last_released + 30:
-                self.display.clear()
-            else:
-                self.display.redraw()
+        self.off_at = time.monotonic() + self.timeout
+
+    def check_timeout(self) -> None:
+        """ボタンが離されてから timeout 秒たったら画面を消す."""
+        if self.display.is_display and not self.is_pressed and time.monotonic() >= self.off_at:
+            self.display.clear()
+
+    def receive(self, receiver: display_channel.DisplayReceiver) -> None:
+        """収集側から届いた計測値を受け取る.
+
+        Args:
+            receiver: 受け取る側のソケット
+        """
+        data: typ.Optional[display_channel.DisplayData] = receiver.receive(0)
+        if data is not None:
+            self.update(data)
+
+    def update(self, data: display_channel.DisplayData) -> None:
+        """受け取った計測値を、折れ線の履歴に入れて、画面を描く.
+
+        Args:
+            data: 収集側から届いた計測値
+        """
+        self.data = data
+        self.history["power"].add(data.timestamp, data.power)
+        self.history["co2"].add(data.timestamp, data.co2)
+        self.render()
+
+    def render(self) -> None:
+        """表示している画面を描く(画面か表示する値が変わったときだけ)."""
+        data: display_channel.DisplayData = self.data
+        screen: str = self.screens[self.screen] if len(self.screens) > 0 else SCREENS[0]
+        history: typ.List[typ.Optional[float]] = []
+        values: typ.Tuple
+        if screen == "power":
+            values = (screen, data.power, data.current, data.power_avg)
+        elif screen in ("power_graph", "co2_graph"):
+            name: str = screen.split("_")[0]
+            history = self.history[name].latest(data.timestamp)
+            values = (screen, getattr(data, name), tuple(history))
+        else:
+            co2: typ.Optional[int] = None if data.co2 is None else int(data.co2)
+            values = (screen, co2, data.temp, data.hum, data.pres)
+        if values == self.last_values:
+            return
+        self.last_values = values
+        if screen == "power":
+            self.display.update_power(data.power, data.current, data.power_avg)
+        elif screen == "power_graph":
+            self.display.update_graph("電力 ", data.power, "6.0f", " W", history)
+        elif screen == "co2_graph":
+            self.display.update_graph("CO₂  ", data.co2, "6.0f", " ppm", history)
+        else:
+            self.display.update(co2, data.temp, data.hum, data.pres)
+        self.dirty = True
+
+    def flush(self) -> None:
+        """描いた画面を送る(画面が消えているときは、次に点けるときに送る)."""
+        if self.dirty and self.display.is_display:
+            self.display.redraw()
+            self.dirty = False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""グラフ用の間引き処理.
+
+Largest-Triangle-Three-Buckets(LTTB)で、ピークや全体の形を保ったまま点数を減らす。
+点数の上限は系列ごとで、ページには系列ごとに選んだ点の和集合を残す(最大で 系列数 × 上限 行になる)。
+"""
+
+import argparse
+import typing as typ
+import numpy as np
+import pandas as pd
+
+# LTTB で残す点数の下限(最初と最後の点と、間のバケツ1つ)
+MIN_POINTS: int = 3
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """LTTBで残す点を選ぶ.
+
+    Args:
+        x: x座標(昇順)
+        y: y座標
+        threshold: 残す点数の上限(MIN_POINTS 以上)
+
+    Returns:
+        残す点のインデックス
+
+    Raises:
+        ValueError: threshold が MIN_POINTS より小さい
+    """
+    if threshold < MIN_POINTS:
+        raise ValueError(f"threshold must be at least {MIN_POINTS}: {threshold}")
+    n: int = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    selected: np.ndarray = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    # 最初と最後の点を除いた残りを threshold - 2 個のバケツに分ける
+    edges: np.ndarray = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    a: int = 0
+    for i in range(threshold - 2):
+        start: int = edges[i]
+        end: int = edges[i + 1]
+        # 次のバケツの平均点(最後のバケツでは最後の点)
+        next_end: int = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x: float = x[end:next_end].mean()
+        avg_y: float = y[end:next_end].mean()
+        area: np.ndarray = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(df: pd.DataFrame, columns: typ.Iterable[str], max_points: typ.Optional[int]) -> pd.DataFrame:
+    """系列ごとにLTTBで間引いた点の和集合を返す.
+
+    欠損値(NaN)は系列ごとに除外してから間引く。
+
+    Args:
+        df: データ("time"列を持つこと)
+        columns: 間引きの対象にする列
+        max_points: 系列ごとの点数の上限(MIN_POINTS 以上。Noneのときは間引かない)
+
+    Returns:
+        間引いたデータ(行数は最大で 系列数 × max_points)
+
+    Raises:
+        ValueError: max_points が MIN_POINTS より小さい
+    """
+    if max_points is not None and max_points < MIN_POINTS:
+        raise ValueError(f"max_points must be at least {MIN_POINTS}: {max_points}")
+    if max_points is None or len(df) <= max_points:
+        return df
+    x: np.ndarray = df["time"].to_numpy(dtype="datetime64[ms]").astype(np.float64)
+    keep: np.ndarray = np.zeros(len(df), dtype=bool)
+    for col in columns:
+        y: np.ndarray = df[col].to_numpy(dtype=np.float64)
+        valid: np.ndarray = np.flatnonzero(~np.isnan(y))
+        keep[valid[lttb(x[valid], y[valid], max_points)]] = True
+    return df[keep]
+
+
+def max_points_arg(value: str) -> int:
+    """コマンドライン引数の --max-points を読む.
+
+    Args:
+        value: 引数の値
+
+    Returns:
+        系列ごとの点数の上限
+
+    Raises:
+        argparse.ArgumentTypeError: 整数でないか、MIN_POINTS より小さい
+    """
+    try:
+        max_points: int = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if max_points < MIN_POINTS:
+        raise argparse.ArgumentTypeError(f"must be at least {MIN_POINTS}: {max_points}")
+    return max_points
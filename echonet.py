@@ -20,6 +20,21 @@ EPC_積算電力量単位: int = 0xE1
 EPC_瞬時電力計測値: int = 0xE7
 EPC_瞬時電流計測値: int = 0xE8
 
+# 積算電力量単位(EPC 0xE1)の値と、kWhへの換算倍率
+積算電力量単位: typ.Dict[int, float] = {
+    0x00: 1.0,
+    0x01: 0.1,
+    0x02: 0.01,
+    0x03: 0.001,
+    0x04: 0.0001,
+    0x0A: 10,
+    0x0B: 100,
+    0x0C: 1000,
+    0x0D: 10000,
+}
+# 積算電力量計測値(EPC 0xE0)の上限(これを超えると0に戻る)
+積算電力量上限: int = 99999999
+
 
 def check_get_res(telegram: str, tid: int) -> bool:
     """スマートメーターからコントローラ宛のプロパティ読みだし応答電文かを調べる.
@@ -0,0 +1,78 @@
+"""グラフの一括生成.
+
+期間内のデータを一度に取得して日ごとに分け、描画はプロセスプールで並列に行う。
+"""
+
+import concurrent.futures
+import datetime
+import os
+import typing as typ
+
+
+def day_range(
+    start_time: datetime.datetime, end_time: datetime.datetime
+) -> typ.Tuple[datetime.datetime, datetime.datetime]:
+    """期間を日単位に広げる.
+
+    途中から始まる日のグラフで、1日分のページを上書きしないようにする。
+
+    Args:
+        start_time: 期間の最初
+        end_time: 期間の最後(含まない)
+
+    Returns:
+        最初の日の0時, 最後の日の翌日0時
+    """
+    start: datetime.datetime = datetime.datetime.combine(start_time.date(), datetime.time())
+    end: datetime.datetime = datetime.datetime.combine(end_time.date(), datetime.time())
+    if end < end_time:
+        end += datetime.timedelta(days=1)
+    return start, end
+
+
+def split_by_day(rows: typ.Iterable, key: str = "created_at") -> typ.Dict[datetime.date, typ.List[typ.Dict]]:
+    """データを日ごとに分ける.
+
+    プロセス間で受け渡せるように、各行は dict に変換する。
+
+    Args:
+        rows: データ
+        key: 時刻の列名
+
+    Returns:
+        日付をキーにしたデータ
+    """
+    result: typ.Dict[datetime.date, typ.List[typ.Dict]] = {}
+    for row in rows:
+        result.setdefault(row[key].date(), []).append(dict(row))
+    return result
+
+
+def is_up_to_date(output_file: str, last_time: datetime.datetime) -> bool:
+    """出力ファイルが最後のデータより新しいかを調べる.
+
+    Args:
+        output_file: 出力ファイル名
+        last_time: 最後のデータの時刻
+
+    Returns:
+        作り直す必要がないときTrue
+    """
+    return os.path.exists(output_file) and os.path.getmtime(output_file) > last_time.timestamp()
+
+
+def run(tasks: typ.List[typ.Tuple[str, typ.Tuple]], func: typ.Callable, jobs: typ.Optional[int]) -> None:
+    """グラフ生成を並列に実行する.
+
+    Args:
+        tasks: (出力ファイル名, funcの引数)のリスト
+        func: グラフ生成関数
+        jobs: 並列数(Noneのときは CPU 数)
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures: typ.Dict[concurrent.futures.Future, str] = {
+            executor.submit(func, *args): output_file for output_file, args in tasks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            print(futures[future])
@@ -0,0 +1,105 @@
+"""グラフのページ出力.
+
+ColumnDataSource に型付きの NumPy 配列を渡すと、Bokeh は JSON のリストではなく base64 のバイナリで埋め込むので、
+ページが小さくなり、ブラウザでの読み込みも速くなる。
+"""
+
+import gzip
+import shutil
+import typing as typ
+import numpy as np
+import pandas as pd
+
+
+def to_epoch_ms(values: typ.Any) -> np.ndarray:
+    """時刻をエポックミリ秒(float64)にする.
+
+    Bokeh と同じく、naive な datetime は UTC とみなす。
+
+    Args:
+        values: 時刻の配列
+
+    Returns:
+        エポックミリ秒の配列
+    """
+    return np.asarray(values, dtype="datetime64[ms]").astype(np.float64)
+
+
+def to_column_data(df: pd.DataFrame, precise: typ.Iterable[str] = ()) -> typ.Dict[str, np.ndarray]:
+    """グラフ(ColumnDataSource)用の列データにする.
+
+    time列はエポックミリ秒(float64)に、それ以外の列は float32 にする。
+
+    Args:
+        df: データ("time"列を持つこと)
+        precise: float32 では桁が足りない列(積算電力量など、float64 のままにする)
+
+    Returns:
+        列ごとのデータ
+    """
+    data: typ.Dict[str, np.ndarray] = {}
+    for col in df.columns:
+        if col == "time":
+            data[col] = to_epoch_ms(df[col].to_numpy())
+        elif col in precise:
+            data[col] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            data[col] = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+    return data
+
+
+def write_gzip(output_file: str) -> str:
+    """Webサーバ用に、圧縮済みのファイルを作る.
+
+    Args:
+        output_file: 出力したファイル名
+
+    Returns:
+        圧縮したファイル名
+    """
+    gzip_file: str = output_file + ".gz"
+    with open(output_file, "rb") as src, gzip.open(gzip_file, "wb", compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst)
+    return gzip_file
+
+
+# 1日分のグラフの横軸の目盛り(時:分)
+TIME_OF_DAY_FORMATS: typ.Dict[str, typ.List[str]] = {"hours": ["%H:%M"], "hourmin": ["%H:%M"], "minutes": ["%H:%M"]}
+
+
+def make_time_figure(title: str, tick_formats: typ.Dict[str, typ.List[str]], **kwargs: typ.Any) -> typ.Any:
+    """横軸が時刻のグラフを作る.
+
+    Bokeh は読み込みに時間がかかるので、グラフを作るときだけ import する。
+
+    Args:
+        title: タイトル
+        tick_formats: 横軸の目盛りの書式(DatetimeTickFormatter の引数)
+        kwargs: bokeh.plotting.figure のその他の引数
+
+    Returns:
+        グラフ(bokeh.plotting.figure)
+    """
+    import bokeh.models as bm
+    import bokeh.plotting as bp
+
+    fig: bp.figure = bp.figure(title=title, x_axis_type="datetime", **kwargs)
+    fig.xaxis.formatter = bm.DatetimeTickFormatter(**tick_formats)
+    return fig
+
+
+def save_page(output_file: str, title: str, layout: typ.Any, gzip: bool = False) -> None:
+    """グラフのページを出力する.
+
+    Args:
+        output_file: 出力ファイル名
+        title: ページのタイトル
+        layout: ページに置くもの(グラフやレイアウト)
+        gzip: 圧縮済みのファイル(.gz)も作るか
+    """
+    import bokeh.plotting as bp
+
+    bp.output_file(output_file, title=title)
+    bp.save(layout)
+    if gzip:
+        write_gzip(output_file)
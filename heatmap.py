@@ -0,0 +1,166 @@
+"""日付×30分のヒートマップ.
+
+電力量・気温・CO₂濃度を、横軸を日付、縦軸を時刻(30分ごと)にしたヒートマップで1ページにまとめる。
+データは DB 側で30分ごとに集計したものを使うので、数年分でも取得するのは1系列あたり数万行で済む。
+"""
+
+import argparse
+import configparser
+import datetime
+import typing as typ
+import bokeh.layouts
+import bokeh.models as bm
+import bokeh.palettes
+import bokeh.plotting as bp
+import numpy as np
+import pandas as pd
+import db_store
+import graph_output
+import power_cost
+
+SLOTS_PER_DAY: int = int(datetime.timedelta(days=1) / power_cost.SLOT)
+DAY_MS: float = datetime.timedelta(days=1) / datetime.timedelta(milliseconds=1)
+
+# ヒートマップ(名前: (タイトル, 単位, 値の書式, パレット))
+HEATMAPS: typ.Dict[str, typ.Tuple[str, str, str, typ.Sequence[str]]] = {
+    "energy": ("電力量", "kWh", "0.00", bokeh.palettes.Inferno256),
+    "temp": ("気温", "℃", "0.0", bokeh.palettes.Turbo256),
+    "co2": ("CO₂", "ppm", "0", bokeh.palettes.Viridis256),
+}
+
+
+def to_grid(values: pd.Series, start_date: datetime.date, days: int) -> np.ndarray:
+    """30分ごとのデータを、時刻×日付の2次元配列にする.
+
+    Args:
+        values: 30分ごとのデータ(30分の開始時刻が添字)
+        start_date: 最初の日
+        days: 日数
+
+    Returns:
+        行が時刻、列が日付の配列(データがないところはNaN)
+    """
+    grid: np.ndarray = np.full((SLOTS_PER_DAY, days), np.nan, dtype=np.float32)
+    index: pd.DatetimeIndex = pd.DatetimeIndex(values.index)
+    day: np.ndarray = np.asarray((index.normalize() - pd.Timestamp(start_date)).days)
+    slot: np.ndarray = np.asarray((index - index.normalize()) // pd.Timedelta(power_cost.SLOT))
+    valid: np.ndarray = (day >= 0) & (day < days) & values.notna().to_numpy()
+    grid[slot[valid], day[valid]] = values.to_numpy()[valid]
+    return grid
+
+
+def make_heatmap_figure(
+    name: str, grid: np.ndarray, start_date: datetime.date, x_range: typ.Optional[bm.Range] = None
+) -> bp.figure:
+    """ヒートマップを1つ作る.
+
+    Args:
+        name: HEATMAPS のキー
+        grid: to_grid で作った配列
+        start_date: 最初の日
+        x_range: 他のヒートマップと共有する横軸の範囲
+
+    Returns:
+        ヒートマップ
+    """
+    title, unit, value_format, palette = HEATMAPS[name]
+    days: int = grid.shape[1]
+    x: float = float(graph_output.to_epoch_ms([start_date])[0])
+    low: float = 0.0
+    high: float = 1.0
+    if not np.isnan(grid).all():
+        # 外れ値で色がつぶれないように、両端1%は飽和させる
+        low, high = (float(value) for value in np.nanpercentile(grid, [1, 99]))
+    color_mapper: bm.LinearColorMapper = bm.LinearColorMapper(
+        palette=palette, low=low, high=high, nan_color="rgba(0, 0, 0, 0)"
+    )
+
+    fig: bp.figure = graph_output.make_time_figure(
+        f"{title}[{unit}]",
+        {"days": ["%Y-%m-%d"], "months": ["%Y-%m"], "years": ["%Y"]},
+        x_range=x_range if x_range is not None else bm.Range1d(x, x + days * DAY_MS),
+        y_range=bm.Range1d(24, 0),  # 0時を上にする
+        y_axis_label="時刻",
+        height=300,
+        sizing_mode="stretch_width",
+        tools="xpan,xwheel_zoom,reset,save",
+    )
+    fig.image(image=[grid], x=x, y=0, dw=days * DAY_MS, dh=24, color_mapper=color_mapper)
+    fig.add_tools(
+        bm.HoverTool(
+            tooltips=[("日付", "$x{%F}"), ("時刻", "$y{0.0}"), (title, f"@image{{{value_format}}}")],
+            formatters={"$x": "datetime"},
+        )
+    )
+    fig.yaxis.ticker = bm.FixedTicker(ticks=list(range(0, 25, 3)))
+    fig.yaxis.major_label_overrides = {hour: f"{hour}:00" for hour in range(0, 25, 3)}
+    fig.add_layout(bm.ColorBar(color_mapper=color_mapper, title=unit), "right")
+    return fig
+
+
+def make_heatmap_page(
+    output_file: str, grids: typ.Dict[str, np.ndarray], start_date: datetime.date, gzip: bool = False
+) -> None:
+    """ヒートマップのページを作る.
+
+    Args:
+        output_file: 出力ファイル名
+        grids: HEATMAPS のキーと to_grid で作った配列
+        start_date: 最初の日
+        gzip: 圧縮済みのファイル(.gz)も作るか
+    """
+    figs: typ.List[bp.figure] = []
+    for name, grid in grids.items():
+        figs.append(make_heatmap_figure(name, grid, start_date, figs[0].x_range if len(figs) > 0 else None))
+    graph_output.save_page(output_file, "Heatmap", bokeh.layouts.column(figs, sizing_mode="stretch_width"), gzip)
+
+
+def main() -> None:
+    """メイン処理."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="output filename", default="heatmap.html")
+    parser.add_argument("-s", "--start", help="start date (default: 1 year ago)")
+    parser.add_argument("-e", "--end", help="end date (default: today)")
+    parser.add_argument("-z", "--gzip", action="store_true", help="also write gzip-compressed output")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    end_date: datetime.date = datetime.date.today()
+    if args.end:
+        end_date = datetime.date.fromisoformat(args.end)
+    start_date: datetime.date = end_date - datetime.timedelta(days=365)
+    if args.start:
+        start_date = datetime.date.fromisoformat(args.start)
+    days: int = (end_date - start_date).days + 1
+    start_time: datetime.datetime = datetime.datetime.combine(start_date, datetime.time())
+    end_time: datetime.datetime = start_time + datetime.timedelta(days=days)
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+
+    store: db_store.DBStore = db_store.DBStore(db_url)
+    grids: typ.Dict[str, np.ndarray] = {}
+    # 最初の30分の使用量のために、その前の30分から取得する
+    counter: typ.List = store.select_power_counter(start_time - power_cost.SLOT, end_time, power_cost.SLOT)
+    if len(counter) >= 2:
+        energy: pd.Series = power_cost.slot_energy(power_cost.make_counter_frame(counter))
+        grids["energy"] = to_grid(energy, start_date, days)
+    env: pd.DataFrame = pd.DataFrame(
+        store.select_bucketed_log(start_time, end_time, power_cost.SLOT, ["temp2", "temp3", "co2"]),
+        columns=["time", "temp2", "temp3", "co2"],
+    ).set_index("time")
+    if len(env) > 0:
+        # BME280 があればその気温を、なければ MH-Z19 の気温を使う
+        grids["temp"] = to_grid(env["temp3"].fillna(env["temp2"]), start_date, days)
+        grids["co2"] = to_grid(env["co2"], start_date, days)
+    if len(grids) == 0:
+        print("no data")
+        return
+
+    make_heatmap_page(args.output, grids, start_date, args.gzip)
+    print(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""I²Cバスの管理.
+
+センサーのドライバ(BME280, TSL2572)は get_bus でバスを取得して、同じバス番号なら同じ I2CBus を共有する。
+I2CBus は転送をロックで直列化し、デバイス(アドレス)ごとに転送回数・バイト数・時間を数える。
+read_blocks は近いレジスタの読み込みを1回のブロック読み込みにまとめる。
+
+実機がなくてもドライバを動かせるように、メモリ上のレジスタで応答する FakeSMBus を用意している。
+set_backend で FakeSMBus を登録すると、そのバス番号では smbus の代わりに使う。
+"""
+
+import dataclasses
+import struct
+import threading
+import time
+import typing as typ
+
+# 1回のブロック読み込みの最大バイト数(SMBus の制限)
+MAX_BLOCK: int = 32
+# read_blocks で、この数までの隙間なら1回の読み込みにまとめる
+MAX_GAP: int = 8
+
+
+@dataclasses.dataclass
+class TransferStats:
+    """デバイスごとの転送の統計."""
+
+    transfers: int = 0  # 転送回数
+    bytes: int = 0  # 転送したバイト数(レジスタアドレスを除く)
+    seconds: float = 0.0  # 転送にかかった時間の合計[秒]
+
+
+class I2CBus:
+    """I²Cバス(スレッドセーフ)."""
+
+    def __init__(self, backend: typ.Any) -> None:
+        """初期化.
+
+        Args:
+            backend: smbus.SMBus 互換のオブジェクト
+        """
+        self.backend: typ.Any = backend
+        self.lock: threading.RLock = threading.RLock()
+        self.stats: typ.Dict[int, TransferStats] = {}
+
+    def transfer(self, address: int, size: int, func: typ.Callable[..., typ.Any], *args: typ.Any) -> typ.Any:
+        """転送する(ロックを取って、統計を数える).
+
+        Args:
+            address: デバイスのアドレス
+            size: 転送するバイト数
+            func: backend のメソッド
+            args: メソッドの引数
+
+        Returns:
+            メソッドの戻り値
+        """
+        with self.lock:
+            start: float = time.perf_counter()
+            result: typ.Any = func(address, *args)
+            elapsed: float = time.perf_counter() - start
+            stats: TransferStats = self.stats.setdefault(address, TransferStats())
+            stats.transfers += 1
+            stats.bytes += size
+            stats.seconds += elapsed
+        return result
+
+    def read_byte_data(self, address: int, register: int) -> int:
+        """1バイト読み込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: レジスタ
+
+        Returns:
+            データ
+        """
+        return self.transfer(address, 1, self.backend.read_byte_data, register)
+
+    def write_byte_data(self, address: int, register: int, value: int) -> None:
+        """1バイト書き込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: レジスタ
+            value: データ
+        """
+        self.transfer(address, 1, self.backend.write_byte_data, register, value)
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> typ.List[int]:
+        """連続したレジスタを読み込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: 最初のレジスタ
+            length: バイト数
+
+        Returns:
+            データ
+        """
+        return self.transfer(address, length, self.backend.read_i2c_block_data, register, length)
+
+    def write_i2c_block_data(self, address: int, register: int, data: typ.Sequence[int]) -> None:
+        """連続したレジスタに書き込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: 最初のレジスタ
+            data: データ
+        """
+        self.transfer(address, len(data), self.backend.write_i2c_block_data, register, list(data))
+
+    def read_blocks(self, address: int, blocks: typ.Sequence[typ.Tuple[int, int]]) -> typ.List[typ.List[int]]:
+        """複数のレジスタの範囲を読み込む.
+
+        隙間が MAX_GAP 以下で、合わせて MAX_BLOCK 以下になる範囲は1回で読み込む。
+        読み込むと値が変わるレジスタが隙間にあるデバイスでは使わないこと。
+
+        Args:
+            address: デバイスのアドレス
+            blocks: (最初のレジスタ, バイト数)のリスト
+
+        Returns:
+            blocks の順に、それぞれのデータ
+        """
+        order: typ.List[int] = sorted(range(len(blocks)), key=lambda i: blocks[i][0])
+        results: typ.List[typ.List[int]] = [[] for _ in blocks]
+        with self.lock:
+            i: int = 0
+            while i < len(order):
+                start: int = blocks[order[i]][0]
+                end: int = start + blocks[order[i]][1]
+                j: int = i + 1
+                while j < len(order):
+                    register, length = blocks[order[j]]
+                    if register - end > MAX_GAP or max(end, register + length) - start > MAX_BLOCK:
+                        break
+                    end = max(end, register + length)
+                    j += 1
+                data: typ.List[int] = self.read_i2c_block_data(address, start, end - start)
+                for k in order[i:j]:
+                    register, length = blocks[k]
+                    results[k] = data[register - start : register - start + length]
+                i = j
+        return results
+
+
+_buses: typ.Dict[int, I2CBus] = {}
+_buses_lock: threading.Lock = threading.Lock()
+
+
+def get_bus(bus: int) -> I2CBus:
+    """バスを取得する(同じバス番号なら同じものを返す).
+
+    Args:
+        bus: i2cのバス番号
+
+    Returns:
+        バス
+    """
+    with _buses_lock:
+        if bus not in _buses:
+            import smbus  # 実機のときだけ必要
+
+            _buses[bus] = I2CBus(smbus.SMBus(bus))
+        return _buses[bus]
+
+
+def set_backend(bus: int, backend: typ.Any) -> I2CBus:
+    """バスの backend を登録する(FakeSMBus を使うときなど).
+
+    Args:
+        bus: i2cのバス番号
+        backend: smbus.SMBus 互換のオブジェクト
+
+    Returns:
+        バス
+    """
+    with _buses_lock:
+        _buses[bus] = I2CBus(backend)
+        return _buses[bus]
+
+
+class FakeDevice:
+    """メモリ上のレジスタで応答するデバイス."""
+
+    def __init__(self, registers: typ.Optional[typ.Mapping[int, int]] = None) -> None:
+        """初期化.
+
+        Args:
+            registers: レジスタの初期値
+        """
+        self.registers: bytearray = bytearray(256)
+        for register, value in (registers or {}).items():
+            self.registers[register] = value
+
+    def read(self, register: int) -> int:
+        """レジスタを読み込む.
+
+        Args:
+            register: レジスタ
+
+        Returns:
+            データ
+        """
+        return self.registers[register & 0xFF]
+
+    def write(self, register: int, value: int) -> None:
+        """レジスタに書き込む.
+
+        Args:
+            register: レジスタ
+            value: データ
+        """
+        self.registers[register & 0xFF] = value & 0xFF
+
+
+class FakeBME280(FakeDevice):
+    """BME280 の代わり(測定はすぐに終わり、set_raw で設定した生データを返す)."""
+
+    # test/bme280.cc と同じ calibration data(dig_T, dig_P, dig_H)
+    CALIBRATION: typ.Tuple[typ.List[int], typ.List[int], typ.List[int]] = (
+        [28998, 27158, 50],
+        [36231, -10432, 3024, 7042, -68, -7, 9900, -10230, 4285],
+        [75, 378, 0, 282, 50, 30],
+    )
+
+    def __init__(self) -> None:
+        """初期化."""
+        super().__init__({0xD0: 0x60})
+        dig_T, dig_P, dig_H = self.CALIBRATION
+        calib0: bytes = struct.pack("<Hhh", *dig_T) + struct.pack("<Hhhhhhhhh", *dig_P) + bytes([0, dig_H[0]])
+        calib1: bytes = struct.pack("<hB", dig_H[1], dig_H[2])
+        calib1 += bytes([(dig_H[3] >> 4) & 0xFF, ((dig_H[4] & 0xF) << 4) | (dig_H[3] & 0xF), (dig_H[4] >> 4) & 0xFF])
+        calib1 += struct.pack("b", dig_H[5])
+        self.registers[0x88 : 0x88 + len(calib0)] = calib0
+        self.registers[0xE1 : 0xE1 + len(calib1)] = calib1
+        self.set_raw(415148, 519888, 30000)
+
+    def set_raw(self, pres: int, temp: int, hum: int) -> None:
+        """生データを設定する.
+
+        Args:
+            pres: 気圧の生データ(20bit)
+            temp: 温度の生データ(20bit)
+            hum: 湿度の生データ(16bit)
+        """
+        self.registers[0xF7:0xFD] = struct.pack(">I", pres << 12)[:3] + struct.pack(">I", temp << 12)[:3]
+        self.registers[0xFD:0xFF] = struct.pack(">H", hum)
+
+
+class FakeTSL2572(FakeDevice):
+    """TSL2572 の代わり(ALS を有効にするとすぐに測定が終わり、set_counts や set_light で設定した値を返す)."""
+
+    # ALS Gain(CONTROL register の値)ごとの倍率
+    AGAIN: typ.Tuple[int, ...] = (1, 8, 16, 120)
+
+    def __init__(self) -> None:
+        """初期化."""
+        super().__init__({0x12: 0x34})
+        self.light: typ.Optional[typ.Tuple[float, float]] = None
+        self.set_counts(1000, 100)
+
+    def read(self, register: int) -> int:
+        """レジスタを読み込む(command register の上位ビットは無視する).
+
+        Args:
+            register: command register の値
+
+        Returns:
+            データ
+        """
+        register &= 0x1F
+        if register == 0x13:  # STATUS
+            return 0x11 if self.registers[0x00] & 0x02 else 0x00
+        if 0x14 <= register < 0x18 and self.light is not None:
+            # 今の ATIME と AGAIN で測ったときの値(フルスケールで飽和する)
+            cycles: int = 256 - self.registers[0x01]
+            gain: int = self.AGAIN[self.registers[0x0F] & 0b11]
+            full_scale: int = min(1024 * cycles, 65535)
+            counts: typ.List[int] = [min(int(rate * cycles * gain), full_scale) for rate in self.light]
+            self.registers[0x14:0x18] = struct.pack("<HH", *counts)
+        return self.registers[register]
+
+    def write(self, register: int, value: int) -> None:
+        """レジスタに書き込む(command register の上位ビットは無視する).
+
+        Args:
+            register: command register の値
+            value: データ
+        """
+        super().write(register & 0x1F, value)
+
+    def set_counts(self, ch0: int, ch1: int) -> None:
+        """ADCの値を設定する.
+
+        Args:
+            ch0: CH0
+            ch1: CH1
+        """
+        self.light = None
+        self.registers[0x14:0x18] = struct.pack("<HH", ch0, ch1)
+
+    def set_light(self, ch0: float, ch1: float) -> None:
+        """明るさを設定する(ADCの値は、ATIME と AGAIN に合わせて決まる).
+
+        Args:
+            ch0: CH0 の、積分時間 2.73ms・1x gain あたりのカウント数
+            ch1: CH1 の、積分時間 2.73ms・1x gain あたりのカウント数
+        """
+        self.light = (ch0, ch1)
+
+
+class FakeSMBus:
+    """smbus.SMBus 互換の、メモリ上のデバイスで応答するバス."""
+
+    def __init__(self, devices: typ.Optional[typ.Mapping[int, FakeDevice]] = None, latency: float = 0.0) -> None:
+        """初期化.
+
+        Args:
+            devices: アドレスとデバイス
+            latency: 1回の転送にかかる時間[秒](実機の転送時間の代わりに待つ)
+        """
+        self.devices: typ.Dict[int, FakeDevice] = dict(devices or {})
+        self.latency: float = latency
+
+    def device(self, address: int) -> FakeDevice:
+        """転送にかかる時間だけ待って、デバイスを返す.
+
+        Args:
+            address: アドレス
+
+        Returns:
+            デバイス
+
+        Raises:
+            OSError: デバイスがない(実機と同じく Remote I/O error)
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if address not in self.devices:
+            raise OSError(121, "Remote I/O error")
+        return self.devices[address]
+
+    def read_byte_data(self, address: int, register: int) -> int:
+        """1バイト読み込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: レジスタ
+
+        Returns:
+            データ
+        """
+        return self.device(address).read(register)
+
+    def write_byte_data(self, address: int, register: int, value: int) -> None:
+        """1バイト書き込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: レジスタ
+            value: データ
+        """
+        self.device(address).write(register, value)
+
+    def read_i2c_block_data(self, address: int, register: int, length: int) -> typ.List[int]:
+        """連続したレジスタを読み込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: 最初のレジスタ
+            length: バイト数
+
+        Returns:
+            データ
+        """
+        device: FakeDevice = self.device(address)
+        return [device.read(register + i) for i in range(length)]
+
+    def write_i2c_block_data(self, address: int, register: int, data: typ.List[int]) -> None:
+        """連続したレジスタに書き込む.
+
+        Args:
+            address: デバイスのアドレス
+            register: 最初のレジスタ
+            data: データ
+        """
+        device: FakeDevice = self.device(address)
+        for i, value in enumerate(data):
+            device.write(register + i, value)
@@ -0,0 +1,133 @@
+"""追記型のグラフデータファイル.
+
+グラフのページ(html)は1日1回だけ作り、データはページと同じ場所の CSV から JavaScript で読み込む。
+cron で実行するたびに、CSV の最後の行(ウォーターマーク)より新しいデータだけを追記する。
+時刻は Bokeh と同じく、naive な datetime を UTC とみなしたエポックミリ秒で保存する。
+ウォーターマークを DB の時刻と正確に比べられるように、ミリ秒未満(マイクロ秒まで)も小数で書く。
+"""
+
+import datetime
+import math
+import os
+import typing as typ
+import pandas as pd
+
+EPOCH: datetime.datetime = datetime.datetime(1970, 1, 1)
+
+# CSV を読み込んで source.data に設定する JavaScript。
+# 読み込み後の処理は postprocess に書く(data に列ごとの Float64Array が入っている)。
+LOADER_JS: str = """
+fetch(url, {cache: "no-store"}).then((response) => response.text()).then((text) => {
+    const lines = text.split("\\n").filter((line) => line.length > 0)
+    const names = lines[0].split(",")
+    const data = {}
+    for (const name of names) {
+        data[name] = new Float64Array(lines.length - 1)
+    }
+    for (let i = 1; i < lines.length; i++) {
+        const values = lines[i].split(",")
+        for (let j = 0; j < names.length; j++) {
+            data[names[j]][i - 1] = values[j] === "" ? NaN : Number(values[j])
+        }
+    }
+    %s
+    source.data = data
+})
+"""
+
+
+def data_file_path(output_file: str) -> str:
+    """ページに対応するデータファイル名を返す.
+
+    Args:
+        output_file: ページのファイル名
+
+    Returns:
+        データファイル名
+    """
+    return os.path.splitext(output_file)[0] + ".csv"
+
+
+def read_header(data_file: str) -> typ.Optional[typ.List[str]]:
+    """データファイルの列名を返す.
+
+    Args:
+        data_file: データファイル名
+
+    Returns:
+        列名(ファイルがないときはNone)
+    """
+    if not os.path.exists(data_file):
+        return None
+    with open(data_file, "r", encoding="utf-8") as f:
+        return f.readline().rstrip("\n").split(",")
+
+
+def read_watermark(data_file: str) -> typ.Optional[datetime.datetime]:
+    """データファイルの最後の行の時刻を返す.
+
+    ファイルの末尾だけを読むので、ファイルの大きさによらず一定時間で終わる。
+
+    Args:
+        data_file: データファイル名
+
+    Returns:
+        最後の行の時刻(データがないときはNone)
+    """
+    if not os.path.exists(data_file):
+        return None
+    with open(data_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size: int = f.tell()
+        f.seek(max(0, size - 4096))
+        lines: typ.List[bytes] = f.read().splitlines()
+    if len(lines) == 0:
+        return None
+    try:  # ヘッダしかないときは ValueError になる
+        milliseconds, _, fraction = lines[-1].split(b",")[0].decode().partition(".")
+        return EPOCH + datetime.timedelta(milliseconds=int(milliseconds), microseconds=int(fraction.ljust(3, "0")))
+    except ValueError:
+        return None
+
+
+def format_time(microseconds: int) -> str:
+    """時刻をエポックミリ秒の文字列にする(ミリ秒未満は小数で、末尾の0は省く).
+
+    Args:
+        microseconds: エポックマイクロ秒
+
+    Returns:
+        エポックミリ秒の文字列
+    """
+    milliseconds, fraction = divmod(int(microseconds), 1000)
+    if fraction == 0:
+        return str(milliseconds)
+    return f"{milliseconds}.{fraction:03d}".rstrip("0")
+
+
+def append_rows(data_file: str, df: pd.DataFrame) -> int:
+    """データを追記する.
+
+    ファイルがないときは列名のヘッダを書く。既存のファイルには、ヘッダにある列だけを書く。
+
+    Args:
+        data_file: データファイル名
+        df: データ("time"列が先頭)
+
+    Returns:
+        追記した行数
+    """
+    columns: typ.Optional[typ.List[str]] = read_header(data_file)
+    with open(data_file, "a", encoding="utf-8") as f:
+        if columns is None:
+            columns = list(df.columns)
+            f.write(",".join(columns) + "\n")
+        times: typ.List[int] = list((df["time"] - EPOCH) // datetime.timedelta(microseconds=1))
+        values: typ.List[typ.List] = [
+            list(df[col]) if col in df.columns else [math.nan] * len(df) for col in columns[1:]
+        ]
+        for row in zip(times, *values):
+            fields: typ.List[str] = [format_time(row[0])]
+            fields.extend("" if value is None or math.isnan(value) else f"{value:.10g}" for value in row[1:])
+            f.write(",".join(fields) + "\n")
+    return len(df)
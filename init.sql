@@ -43,6 +43,22 @@ create table bme280_log (
     humidity real,
     created_at timestamp not null default current_timestamp
 );
+drop table bme280_calibration;
+create table bme280_calibration (
+    id serial primary key,
+    dig_t int[], -- dig_T1〜dig_T3
+    dig_p int[], -- dig_P1〜dig_P9
+    dig_h int[], -- dig_H1〜dig_H6
+    created_at timestamp not null default current_timestamp
+);
+drop table bme280_raw_log;
+create table bme280_raw_log (
+    id int primary key, -- bme280_log の id
+    calibration_id int, -- bme280_calibration の id
+    adc_p int,
+    adc_t int,
+    adc_h int
+);
 drop table tsl2572_log;
 create table tsl2572_log (
     id serial primary key,
@@ -3,14 +3,243 @@ import argparse
 import configparser
 import datetime
 import os
+import tempfile
+import time
 import typing as typ
+import psycopg2  # type: ignore
 import db_store
+import rolling_stats
+
+# 通知を受けてから、続けて登録されるデータを待つ時間[秒]
+SETTLE_TIME: float = 1.0
+
+
+def render(data: typ.Dict) -> str:
+    """htmlを作る.
+
+    Args:
+        data: select_latest_log で取得したデータ
+
+    Returns:
+        html
+    """
+    lines: typ.List[str] = []
+    lines.extend(
+        [
+            "<!DOCTYPE html>\n",
+            "<html lang='ja'>\n",
+            "<head>\n",
+            "<meta charset='utf-8'/>\n",
+            "<meta name='viewport' content='width=device-width, initial-scale=1.0, user-scalable=yes'>\n",
+            "<style type='text/css'>\n",
+            "body { font-size: x-large; }\n",
+            ".red { color: red; }\n",
+            ".blue { color: blue; }\n",
+            ".green { color: green; }\n",
+            ".right { text-align: right; }\n",
+            "</style>\n",
+            "</head>\n",
+            "<body>\n",
+            "<table>\n",
+        ]
+    )
+    if data["power"] is not None:
+        created_at: str = data["power"]["created_at"].strftime("%Y/%m/%d %H:%M:%S")
+        瞬時電力: int = data["power"]["瞬時電力"]
+        瞬時電流: float = (data["power"]["瞬時電流_r"] + data["power"]["瞬時電流_t"]) / 10
+        平均瞬時電力: typ.Optional[float] = data["power_average"]["瞬時電力"]
+        平均瞬時電流: typ.Optional[float] = data["power_average"]["瞬時電流"]
+        電流_color: str = ""
+        if 瞬時電流 > 28:
+            電流_color = "red"
+        elif 瞬時電流 > 15:
+            電流_color = "blue"
+        lines.append(f"<tr><td colspan=3>{created_at}</td></tr>\n")
+        lines.append(f"<tr><td>瞬時電力</td><td class='right'>{瞬時電力}</td><td>[W]</td></tr>\n")
+        if 平均瞬時電力 is not None:
+            lines.append(f"<tr><td>　(平均)</td><td class='right'>{平均瞬時電力:.0f}</td><td>[W]</td></tr>\n")
+        lines.append(f"<tr><td>瞬時電流</td><td class='right {電流_color}'>{瞬時電流}</td><td>[A]</td></tr>\n")
+        if 平均瞬時電流 is not None:
+            lines.append(f"<tr><td>　(平均)</td><td class='right {電流_color}'>{平均瞬時電流 / 10:.1f}</td><td>[A]</td></tr>\n")
+    if data["temp"] is not None:
+        CPU: float = data["temp"]["temp"] / 1000
+        lines.append(f"<tr><td>CPU温度</td><td class='right'>{CPU:.1f}</td><td>[℃]</td></tr>\n")
+    if data["co2"] is not None:
+        CO2: int = data["co2"]["co2"]
+        co2_color: str = "blue"
+        if CO2 > 2000:
+            co2_color = "red"
+        elif CO2 > 1000:
+            co2_color = "green"
+        # temp: int = data["co2"]["temp"]
+        lines.append(f"<tr><td>CO₂濃度</td><td class='right {co2_color}'>{CO2}</td><td>[ppm]</td></tr>\n")
+        # lines.append(f"<tr><td>気温</td><td class='right'>{temp}</td><td>[℃]</td></tr>\n")
+    if data["bme280"] is not None:
+        temp: float = data["bme280"]["temp"]
+        hum: float = data["bme280"]["humidity"]
+        pres: float = data["bme280"]["pressure"]
+        temp_color: str = "green"
+        if temp < 18:
+            temp_color = "blue"
+        elif temp > 25:
+            temp_color = "red"
+        hum_color: str = "green"
+        if hum < 40:
+            hum_color = "blue"
+        elif hum > 65:
+            hum_color = "red"
+        lines.append(f"<tr><td>気温</td><td class='right {temp_color}'>{temp:.1f}</td><td>[℃]</td></tr>\n")
+        lines.append(f"<tr><td>湿度</td><td class='right {hum_color}'>{hum:.1f}</td><td>[%]</td></tr>\n")
+        lines.append(f"<tr><td>気圧</td><td class='right'>{pres:.1f}</td><td>[hPa]</td></tr>\n")
+    if data["tsl2572"] is not None:
+        illuminance: float = data["tsl2572"]["illuminance"]
+        lux1: float = data["tsl2572"]["lux1"]
+        lux2: float = data["tsl2572"]["lux2"]
+        illumi_color: str = "green"
+        if illuminance > 60:
+            illumi_color = "red"
+        lines.append(f"<tr><td>照度</td><td class='right {illumi_color}'>{illuminance:.1f}</td><td>[lx]</td></tr>\n")
+        lines.append(f"<tr><td>　LUX1</td><td class='right'>{lux1:.1f}</td><td>[lx]</td></tr>\n")
+        lines.append(f"<tr><td>　LUX2</td><td class='right'>{lux2:.1f}</td><td>[lx]</td></tr>\n")
+    lines.extend(
+        [
+            "</table>\n",
+            "<!--#include file='camera.html' -->",
+            "</body>\n",
+            "</html>\n",
+        ]
+    )
+
+    return "".join(lines)
+
+
+def write_if_changed(output_file: str, content: str) -> bool:
+    """内容が変わったときだけ、ファイルを置き換える.
+
+    一時ファイルに書いてから os.replace で置き換えるので、読む側が書きかけのファイルを見ることはない。
+
+    Args:
+        output_file: 出力ファイル名
+        content: 内容
+
+    Returns:
+        書き込んだときTrue
+    """
+    data: bytes = content.replace("\n", "\r\n").encode("utf-8")
+    try:
+        with open(output_file, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), prefix=".latest_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, output_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+    return True
+
+
+class PowerAverage:
+    """瞬時電力と瞬時電流の移動平均(power_log の通知から更新する)."""
+
+    def __init__(self, store: db_store.DBStore) -> None:
+        """初期化(直近のデータはDBから読み込む).
+
+        Args:
+            store: DBストア
+        """
+        self.power: rolling_stats.RollingStats = rolling_stats.RollingStats(rolling_stats.MOVING_AVERAGE_PERIOD)
+        self.current: rolling_stats.RollingStats = rolling_stats.RollingStats(rolling_stats.MOVING_AVERAGE_PERIOD)
+        now: datetime.datetime = datetime.datetime.now()
+        for row in store.select_power_log(now - rolling_stats.MOVING_AVERAGE_PERIOD, now):
+            self.add(row)
+
+    def add(self, row: typ.Mapping) -> None:
+        """power_logのデータを追加する.
+
+        Args:
+            row: power_logのデータ(NOTIFYのときは時刻が文字列)
+        """
+        created_at: typ.Any = row["created_at"]
+        if isinstance(created_at, str):
+            created_at = datetime.datetime.fromisoformat(created_at)
+        瞬時電流_r: typ.Optional[int] = row["瞬時電流_r"]
+        瞬時電流_t: typ.Optional[int] = row["瞬時電流_t"]
+        self.power.add(created_at, row["瞬時電力"])
+        self.current.add(created_at, None if 瞬時電流_r is None or 瞬時電流_t is None else 瞬時電流_r + 瞬時電流_t)
+
+    def to_dict(self) -> typ.Dict[str, typ.Optional[float]]:
+        """select_latest_log の power_average と同じ形にする.
+
+        Returns:
+            瞬時電力と瞬時電流の移動平均
+        """
+        now: datetime.datetime = datetime.datetime.now()
+        self.power.expire(now)
+        self.current.expire(now)
+        return {"瞬時電力": self.power.mean, "瞬時電流": self.current.mean}
+
+
+def update(store: db_store.DBStore, output_file: str, average: typ.Optional[PowerAverage] = None) -> bool:
+    """最新のデータでhtmlを更新する.
+
+    Args:
+        store: DBストア
+        output_file: 出力ファイル名
+        average: 移動平均(Noneのときは、DBで集計する)
+
+    Returns:
+        書き込んだときTrue
+    """
+    if average is None:
+        data: typ.Dict = store.select_latest_log(datetime.datetime.now() - rolling_stats.MOVING_AVERAGE_PERIOD)
+    else:
+        data = store.select_latest_log(None)
+        data["power_average"] = average.to_dict()
+    return write_if_changed(output_file, render(data))
+
+
+def run_daemon(db_url: str, output_file: str, interval: float) -> None:
+    """新しいデータが登録されるたびにhtmlを更新する.
+
+    DB接続は開いたままにして、LISTEN/NOTIFY で登録を待つ。接続が切れたときは再接続する。
+    移動平均は通知されたデータからメモリ上で計算するので、更新のたびに power_log を集計しない。
+
+    Args:
+        db_url: DB の接続文字列
+        output_file: 出力ファイル名
+        interval: 通知がなくても更新する間隔[秒](移動平均の期間が進むため)
+    """
+    while True:
+        try:
+            store: db_store.DBStore = db_store.DBStore(db_url)
+            store.listen(*db_store.NOTIFY_CHANNELS)
+            average: PowerAverage = PowerAverage(store)
+            while True:
+                update(store, output_file, average)
+                notifies: typ.List[typ.Tuple[str, typ.Dict]] = store.wait_notifies(interval)
+                while len(notifies) > 0:
+                    for channel, payload in notifies:
+                        if channel == "power_log":
+                            average.add(payload)
+                    # 続けて登録されるデータを待って、まとめて1回で更新する
+                    notifies = store.wait_notifies(SETTLE_TIME)
+        except psycopg2.Error as e:
+            print(f"DB接続エラー: {e}", flush=True)
+            time.sleep(10)
 
 
 def main() -> None:
     """メイン処理."""
     parser: argparse.ArgumentParser = argparse.ArgumentParser()
     parser.add_argument("-o", "--output", help="output filename")
+    parser.add_argument("-D", "--daemon", action="store_true", help="keep running and update on new data")
+    parser.add_argument("-i", "--interval", type=float, help="update interval without new data (seconds)", default=60)
 
     args: argparse.Namespace = parser.parse_args()
 
@@ -25,97 +254,12 @@ def main() -> None:
     inifile.read("power_consumption.ini", "utf-8")
     db_url: str = inifile.get("routeB", "db_url")
 
-    moving_start: datetime.datetime = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    if args.daemon:
+        run_daemon(db_url, output_file, args.interval)
+        return
 
     store: db_store.DBStore = db_store.DBStore(db_url)
-    data: typ.Dict = store.select_latest_log(moving_start)
-
-    with open(output_file, "w", newline="\r\n") as out:
-        out.writelines(
-            [
-                "<!DOCTYPE html>\n",
-                "<html lang='ja'>\n",
-                "<head>\n",
-                "<meta charset='utf-8'/>\n",
-                "<meta name='viewport' content='width=device-width, initial-scale=1.0, user-scalable=yes'>\n",
-                "<style type='text/css'>\n",
-                "body { font-size: x-large; }\n",
-                ".red { color: red; }\n",
-                ".blue { color: blue; }\n",
-                ".green { color: green; }\n",
-                ".right { text-align: right; }\n",
-                "</style>\n",
-                "</head>\n",
-                "<body>\n",
-                "<table>\n",
-            ]
-        )
-        if data["power"] is not None:
-            created_at: str = data["power"]["created_at"].strftime("%Y/%m/%d %H:%M:%S")
-            瞬時電力: int = data["power"]["瞬時電力"]
-            瞬時電流: float = (data["power"]["瞬時電流_r"] + data["power"]["瞬時電流_t"]) / 10
-            平均瞬時電力: typ.Optional[float] = data["power_average"]["瞬時電力"]
-            平均瞬時電流: typ.Optional[float] = data["power_average"]["瞬時電流"]
-            電流_color: str = ""
-            if 瞬時電流 > 28:
-                電流_color = "red"
-            elif 瞬時電流 > 15:
-                電流_color = "blue"
-            out.write(f"<tr><td colspan=3>{created_at}</td></tr>\n")
-            out.write(f"<tr><td>瞬時電力</td><td class='right'>{瞬時電力}</td><td>[W]</td></tr>\n")
-            if 平均瞬時電力 is not None:
-                out.write(f"<tr><td>　(平均)</td><td class='right'>{平均瞬時電力:.0f}</td><td>[W]</td></tr>\n")
-            out.write(f"<tr><td>瞬時電流</td><td class='right {電流_color}'>{瞬時電流}</td><td>[A]</td></tr>\n")
-            if 平均瞬時電流 is not None:
-                out.write(f"<tr><td>　(平均)</td><td class='right {電流_color}'>{平均瞬時電流 / 10:.1f}</td><td>[A]</td></tr>\n")
-        if data["temp"] is not None:
-            CPU: float = data["temp"]["temp"] / 1000
-            out.write(f"<tr><td>CPU温度</td><td class='right'>{CPU:.1f}</td><td>[℃]</td></tr>\n")
-        if data["co2"] is not None:
-            CO2: int = data["co2"]["co2"]
-            co2_color: str = "blue"
-            if CO2 > 2000:
-                co2_color = "red"
-            elif CO2 > 1000:
-                co2_color = "green"
-            # temp: int = data["co2"]["temp"]
-            out.write(f"<tr><td>CO₂濃度</td><td class='right {co2_color}'>{CO2}</td><td>[ppm]</td></tr>\n")
-            # out.write(f"<tr><td>気温</td><td class='right'>{temp}</td><td>[℃]</td></tr>\n")
-        if data["bme280"] is not None:
-            temp: float = data["bme280"]["temp"]
-            hum: float = data["bme280"]["humidity"]
-            pres: float = data["bme280"]["pressure"]
-            temp_color: str = "green"
-            if temp < 18:
-                temp_color = "blue"
-            elif temp > 25:
-                temp_color = "red"
-            hum_color: str = "green"
-            if hum < 40:
-                hum_color = "blue"
-            elif hum > 65:
-                hum_color = "red"
-            out.write(f"<tr><td>気温</td><td class='right {temp_color}'>{temp:.1f}</td><td>[℃]</td></tr>\n")
-            out.write(f"<tr><td>湿度</td><td class='right {hum_color}'>{hum:.1f}</td><td>[%]</td></tr>\n")
-            out.write(f"<tr><td>気圧</td><td class='right'>{pres:.1f}</td><td>[hPa]</td></tr>\n")
-        if data["tsl2572"] is not None:
-            illuminance: float = data["tsl2572"]["illuminance"]
-            lux1: float = data["tsl2572"]["lux1"]
-            lux2: float = data["tsl2572"]["lux2"]
-            illumi_color: str = "green"
-            if illuminance > 60:
-                illumi_color = "red"
-            out.write(f"<tr><td>照度</td><td class='right {illumi_color}'>{illuminance:.1f}</td><td>[lx]</td></tr>\n")
-            out.write(f"<tr><td>　LUX1</td><td class='right'>{lux1:.1f}</td><td>[lx]</td></tr>\n")
-            out.write(f"<tr><td>　LUX2</td><td class='right'>{lux2:.1f}</td><td>[lx]</td></tr>\n")
-        out.writelines(
-            [
-                "</table>\n",
-                "<!--#include file='camera.html' -->",
-                "</body>\n",
-                "</html>\n",
-            ]
-        )
+    update(store, output_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""最新の計測値を返す HTTP サーバ.
+
+収集側(power_consumption.py)のプロセス内で動かし、計測値はメモリに持つので DB には問い合わせない。
+
+* `GET /latest.json`: 最新の計測値(JSON)。ETag を付けるので、If-None-Match が一致すれば 304 を返す。
+* `GET /events`: Server-Sent Events。接続したときと、計測値が変わるたびに latest イベントを送る。
+
+計測値は1回の収集ごとにまとめて更新する。ETag と版数は計測値(created_at を除く)だけから決めるので、
+値が変わらなければ 304 を返し、SSE も送らない(弱い ETag にして、created_at だけが違うことを表す)。
+"""
+
+import datetime
+import hashlib
+import http.server
+import json
+import threading
+import typing as typ
+
+# SSE で、更新がなくても接続を保つためにコメントを送る間隔[秒]
+KEEPALIVE_INTERVAL: float = 15
+
+
+class LatestValues:
+    """最新の計測値(スレッドセーフ).
+
+    キーは select_latest_log と同じ(power, power_average, temp, co2, bme280, tsl2572)で、
+    値は各テーブルの列名をキーにした dict。power_stats には瞬時電力と瞬時電流の移動統計が入る。
+    """
+
+    def __init__(self) -> None:
+        """初期化."""
+        self.condition: threading.Condition = threading.Condition()
+        self.values: typ.Dict[str, typ.Dict] = {}
+        self.version: int = 0
+        self.body: bytes = b"{}"
+        self.etag: str = self.make_etag(self.values)
+
+    @staticmethod
+    def make_etag(values: typ.Dict[str, typ.Dict]) -> str:
+        """レスポンスの ETag を作る(収集するたびに変わる created_at は含めない).
+
+        Args:
+            values: 計測値
+
+        Returns:
+            ETag
+        """
+        content: typ.Dict[str, typ.Dict] = {
+            name: {key: value for key, value in entry.items() if key != "created_at"} for name, entry in values.items()
+        }
+        body: bytes = json.dumps(content, default=str, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return 'W/"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+    def update(self, values: typ.Mapping[str, typ.Dict]) -> None:
+        """1回の収集で読んだ計測値をまとめて更新する(値が変わったときだけ版数を上げる).
+
+        Args:
+            values: 種類(power, power_average, power_stats, temp, co2, bme280, tsl2572 など)と計測値
+                (テーブルの列名をキーにする。created_at がなければ現在時刻を付ける)
+        """
+        if len(values) == 0:
+            return
+        now: datetime.datetime = datetime.datetime.now()
+        with self.condition:
+            for name, entry in values.items():
+                self.values[name] = {"created_at": now, **entry}
+            self.body = json.dumps(self.values, default=str, ensure_ascii=False).encode("utf-8")
+            etag: str = self.make_etag(self.values)
+            if etag != self.etag:
+                self.etag = etag
+                self.version += 1
+                self.condition.notify_all()
+
+    def get(self) -> typ.Tuple[int, bytes, str]:
+        """最新の計測値を返す.
+
+        Returns:
+            版数, JSON, ETag
+        """
+        with self.condition:
+            return self.version, self.body, self.etag
+
+    def wait(self, version: int, timeout: float) -> typ.Tuple[int, bytes, str]:
+        """計測値が更新されるのを待つ.
+
+        Args:
+            version: 前回の版数
+            timeout: タイムアウト[秒]
+
+        Returns:
+            版数, JSON, ETag(タイムアウトしたときは版数が変わらない)
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version, self.body, self.etag
+
+
+class LatestRequestHandler(http.server.BaseHTTPRequestHandler):
+    """リクエストハンドラ."""
+
+    server: "LatestServer"
+
+    def do_GET(self) -> None:  # noqa: N802
+        """GET リクエストの処理."""
+        path: str = self.path.split("?")[0]
+        if path == "/latest.json":
+            self.send_latest()
+        elif path == "/events":
+            self.send_events()
+        else:
+            self.send_error(404)
+
+    def send_latest(self) -> None:
+        """最新の計測値を JSON で返す."""
+        _, body, etag = self.server.latest.get()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self) -> None:
+        """計測値が更新されるたびに、Server-Sent Events で送る."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        version, body, _ = self.server.latest.get()
+        try:
+            while True:
+                self.wfile.write(b"event: latest\ndata: " + body + b"\n\n")
+                self.wfile.flush()
+                while True:
+                    new_version, body, _ = self.server.latest.wait(version, KEEPALIVE_INTERVAL)
+                    if new_version != version:
+                        version = new_version
+                        break
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ブラウザが切断した
+
+    def log_message(self, format: str, *args: typ.Any) -> None:
+        """アクセスログは出さない.
+
+        Args:
+            format: 書式
+            args: 引数
+        """
+
+
+class LatestServer(http.server.ThreadingHTTPServer):
+    """最新の計測値を返す HTTP サーバ."""
+
+    daemon_threads = True
+
+    def __init__(self, address: str, port: int, latest: LatestValues) -> None:
+        """初期化.
+
+        Args:
+            address: 待ち受けるアドレス
+            port: ポート番号
+            latest: 最新の計測値
+        """
+        super().__init__((address, port), LatestRequestHandler)
+        self.latest: LatestValues = latest
+
+    def start(self) -> None:
+        """別スレッドで待ち受けを開始する."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
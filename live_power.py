@@ -0,0 +1,226 @@
+"""リアルタイムの電力グラフ(Bokehサーバ).
+
+起動時に直近のデータを power_log から読み込み、その後は power_log に登録されたデータを
+LISTEN/NOTIFY で受け取って、接続しているブラウザに ColumnDataSource.stream で送る。
+DBへの定期的な問い合わせはしない。
+"""
+
+import argparse
+import configparser
+import datetime
+import functools
+import threading
+import time
+import typing as typ
+import bokeh.document
+import bokeh.models as bm
+import bokeh.plotting as bp
+import psycopg2  # type: ignore
+from bokeh.application import Application
+from bokeh.application.handlers.function import FunctionHandler
+from bokeh.server.server import Server
+import db_store
+import graph_output
+
+COLUMNS: typ.Tuple[str, ...] = ("time", "電力", "電流R", "電流T")
+
+
+def to_columns(row: typ.Mapping) -> typ.Dict[str, typ.List]:
+    """power_logの1件をグラフ用の列データにする.
+
+    Args:
+        row: power_logのデータ(NOTIFYのときは時刻が文字列)
+
+    Returns:
+        列ごとのデータ(1件分)
+    """
+    created_at: typ.Any = row["created_at"]
+    if isinstance(created_at, str):
+        created_at = datetime.datetime.fromisoformat(created_at)
+    電流R: typ.Optional[int] = row["瞬時電流_r"]
+    電流T: typ.Optional[int] = row["瞬時電流_t"]
+    return {
+        "time": [created_at],
+        "電力": [row["瞬時電力"]],
+        "電流R": [None if 電流R is None else 電流R / 10.0],
+        "電流T": [None if 電流T is None else 電流T / 10.0],
+    }
+
+
+class PowerFeed(threading.Thread):
+    """power_logの通知を受け取って、接続中のドキュメントに配るスレッド."""
+
+    def __init__(self, db_url: str, rollover: int) -> None:
+        """初期化.
+
+        Args:
+            db_url: DB の接続文字列
+            rollover: ブラウザ側で保持する最大件数
+        """
+        super().__init__(daemon=True)
+        self.db_url: str = db_url
+        self.rollover: int = rollover
+        self.lock: threading.Lock = threading.Lock()
+        self.sources: typ.Dict[bokeh.document.Document, bp.ColumnDataSource] = {}
+
+    def add(self, doc: bokeh.document.Document, source: bp.ColumnDataSource) -> None:
+        """配信先を追加する.
+
+        Args:
+            doc: ドキュメント
+            source: データを追加するソース
+        """
+        with self.lock:
+            self.sources[doc] = source
+
+    def remove(self, doc: bokeh.document.Document) -> None:
+        """配信先を削除する.
+
+        Args:
+            doc: ドキュメント
+        """
+        with self.lock:
+            self.sources.pop(doc, None)
+
+    def stream(self, source: bp.ColumnDataSource, new_data: typ.Dict[str, typ.List]) -> None:
+        """ソースにデータを追加する(ドキュメントのイベントループで呼ぶこと).
+
+        最初に読み込んだデータと重なる分(最後の時刻より後でないデータ)は追加しない。
+
+        Args:
+            source: データを追加するソース
+            new_data: 追加するデータ(1件分)
+        """
+        times: typ.List = source.data["time"]
+        if len(times) > 0 and new_data["time"][0] <= times[-1]:
+            return
+        source.stream(new_data, self.rollover)
+
+    def publish(self, payload: typ.Mapping) -> None:
+        """通知されたデータを、接続中のドキュメントに配る.
+
+        Args:
+            payload: 通知されたデータ(power_logの1件)
+        """
+        new_data: typ.Dict[str, typ.List] = to_columns(payload)
+        with self.lock:
+            targets: typ.List = list(self.sources.items())
+        for doc, source in targets:
+            # ドキュメントの変更は、そのドキュメントのイベントループで行う
+            doc.add_next_tick_callback(functools.partial(self.stream, source, new_data))
+
+    def run(self) -> None:
+        """通知を待って配信する(エラーのときは、表示して再接続する)."""
+        while True:
+            try:
+                store: db_store.DBStore = db_store.DBStore(self.db_url)
+                store.listen("power_log")
+                while True:
+                    for channel, payload in store.wait_notifies(60):
+                        try:
+                            self.publish(payload)
+                        except Exception as e:
+                            # 通知の内容がおかしいときなども、その通知だけ飛ばしてスレッドは止めない
+                            print(f"通知の処理でエラー: {e!r}", flush=True)
+            except psycopg2.Error as e:
+                print(f"DB接続エラー: {e}", flush=True)
+                time.sleep(10)
+            except Exception as e:
+                print(f"エラー: {e!r}", flush=True)
+                time.sleep(10)
+
+
+def make_document(doc: bokeh.document.Document, db_url: str, feed: PowerFeed, hours: float) -> None:
+    """ドキュメントを作る(ブラウザの接続ごとに呼ばれる).
+
+    Args:
+        doc: ドキュメント
+        db_url: DB の接続文字列
+        feed: 通知の配信スレッド
+        hours: 最初に表示する時間[h]
+    """
+    # 読み込んでいる間に登録されたデータを取りこぼさないように、読み込む前に配信先に追加する
+    # (配信はこの関数が終わってから行われ、読み込んだデータと重なる分は PowerFeed.stream が捨てる)
+    source: bp.ColumnDataSource = bp.ColumnDataSource({col: [] for col in COLUMNS})
+    feed.add(doc, source)
+    doc.on_session_destroyed(lambda session_context: feed.remove(doc))
+
+    now: datetime.datetime = datetime.datetime.now()
+    start_time: datetime.datetime = now - datetime.timedelta(hours=hours)
+    # 時計のずれや、読み込み中の登録があっても最新の行まで読むように、終わりは先にしておく
+    end_time: datetime.datetime = now + datetime.timedelta(days=1)
+    store: db_store.DBStore = db_store.DBStore(db_url)
+    data: typ.Dict[str, typ.List] = {col: [] for col in COLUMNS}
+    for row in store.select_power_log(start_time, end_time):
+        for col, values in to_columns(row).items():
+            data[col].extend(values)
+    del store
+    source.data = data
+
+    tooltips: typ.List[typ.Tuple[str, str]] = [
+        ("time", "@time{%F %T}"),
+        ("瞬時電力", "@{電力}{0,0}"),
+        ("瞬時電流(R相)", "@{電流R}{0,0.0}"),
+        ("瞬時電流(T相)", "@{電流T}{0,0.0}"),
+    ]
+    hover_tool: bm.HoverTool = bm.HoverTool(tooltips=tooltips, formatters={"@time": "datetime"})
+
+    fig: bp.figure = graph_output.make_time_figure(
+        "Power consumption (live)",
+        graph_output.TIME_OF_DAY_FORMATS,
+        x_axis_label="時刻",
+        y_axis_label="電力[W]",
+        sizing_mode="stretch_both",
+    )
+    fig.add_tools(hover_tool)
+    power_renderer: bm.GlyphRenderer = fig.line(
+        "time", "電力", legend_label="瞬時電力", line_color="orange", line_width=2, source=source
+    )
+    fig.y_range = bm.DataRange1d(start=0, renderers=[power_renderer])
+    current_renderers: typ.List[bm.GlyphRenderer] = [
+        fig.line("time", col, y_range_name="A", legend_label=legend_label, line_color=color, source=source)
+        for col, legend_label, color in (("電流R", "瞬時電流(R相)", "blue"), ("電流T", "瞬時電流(T相)", "green"))
+    ]
+    fig.extra_y_ranges["A"] = bm.DataRange1d(start=0, renderers=current_renderers)
+    fig.add_layout(bm.LinearAxis(y_range_name="A", axis_label="電流[A]"), "right")
+
+    fig.legend.click_policy = "hide"
+    fig.legend.location = "top_left"
+
+    doc.title = "Power consumption"
+    doc.add_root(fig)
+
+
+def main() -> None:
+    """メイン処理."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, help="port number", default=5006)
+    parser.add_argument("--hours", type=float, help="initial window in hours", default=6)
+    parser.add_argument("-r", "--rollover", type=int, help="max points kept in the browser (default: 1/min for hours)")
+    parser.add_argument("-a", "--allow-websocket-origin", action="append", help="allowed websocket origin (host:port)")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+
+    rollover: int = args.rollover or int(args.hours * 60)
+    feed: PowerFeed = PowerFeed(db_url, rollover)
+    feed.start()
+
+    handler: FunctionHandler = FunctionHandler(
+        functools.partial(make_document, db_url=db_url, feed=feed, hours=args.hours)
+    )
+    server: Server = Server(
+        {"/": Application(handler)},
+        port=args.port,
+        allow_websocket_origin=args.allow_websocket_origin or [f"localhost:{args.port}"],
+    )
+    server.start()
+    print(f"http://localhost:{args.port}/", flush=True)
+    server.io_loop.start()
+
+
+if __name__ == "__main__":
+    main()
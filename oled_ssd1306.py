@@ -1,31 +1,225 @@
-"""SSD1306 OLED Display."""
+"""SSD1306 OLED Display.
 
+画面は、SSD1306 の GDDRAM と同じ形(ページ(縦8ドット)ごとに、列ごとに1バイト)のバッファに描く。
+文字は、一度 TrueType フォントでラスタライズしたものをキャッシュ(GlyphCache)して、バッファにコピーするだけにする。
+ラベルや単位などの決まった文字列は、文字列ごとキャッシュする。
+
+送るときは、前回送った画面と比べて、ページごとに変わった列の範囲だけを、列アドレスとページアドレスを指定して送る。
+"""
+
+import math
 import time
 import typing as typ
-import board  # type: ignore
-import adafruit_ssd1306  # type: ignore
 from PIL import Image, ImageDraw, ImageFont  # type: ignore
+from i2c_bus import TransferStats
 
 WIDTH: int = 128
 HEIGHT: int = 64
+PAGES: int = HEIGHT // 8
+
+FONT_PATH: str = "/usr/share/fonts/truetype/horai-umefont/ume-tmo3.ttf"
+FONT_SIZE: int = 16
+# 1行(FONT_SIZE ドット)のページ数
+LINE_PAGES: int = FONT_SIZE // 8
+
+# フォント(Pillow 内蔵のフォントは、FreeType がないと ImageFont になる)
+Font = typ.Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]
+
+# SSD1306 のコマンド
+SET_COL_ADDR: int = 0x21
+SET_PAGE_ADDR: int = 0x22
+# 範囲を指定して書き込むときの、データ以外の転送バイト数(コマンドは制御バイトと2バイトずつ6回、データの制御バイト)
+WRITE_OVERHEAD: int = 6 * 2 + 1
+
+
+def to_pages(image: Image.Image) -> typ.List[bytes]:
+    """画像を GDDRAM の形にする.
+
+    Args:
+        image: 画像(モードは "1"、高さは8の倍数)
+
+    Returns:
+        ページごとの、列ごとのバイト(下位ビットが上のドット)
+    """
+    width, height = image.size
+    pixels: typ.Any = image.load()
+    pages: typ.List[bytes] = []
+    for page in range(height // 8):
+        row: bytearray = bytearray(width)
+        for x in range(width):
+            value: int = 0
+            for bit in range(8):
+                if pixels[x, page * 8 + bit]:
+                    value |= 1 << bit
+            row[x] = value
+        pages.append(bytes(row))
+    return pages
+
+
+class GlyphCache:
+    """ラスタライズした文字(列)のキャッシュ."""
+
+    def __init__(self, font: Font) -> None:
+        """初期化.
+
+        Args:
+            font: フォント
+        """
+        self.font: Font = font
+        self.cache: typ.Dict[str, typ.List[bytes]] = {}
+
+    def get(self, text: str) -> typ.List[bytes]:
+        """文字列をラスタライズしたものを返す(キャッシュにないときだけラスタライズする).
+
+        Args:
+            text: 文字列
+
+        Returns:
+            LINE_PAGES ページ分の、列ごとのバイト(幅は文字送りの幅)
+        """
+        glyph: typ.Optional[typ.List[bytes]] = self.cache.get(text)
+        if glyph is None:
+            width: int = max(math.ceil(self.font.getlength(text)), 1)
+            image: Image.Image = Image.new("1", (width, LINE_PAGES * 8))
+            ImageDraw.Draw(image).text((0, 0), text, font=self.font, fill=255)
+            glyph = to_pages(image)
+            self.cache[text] = glyph
+        return glyph
+
+
+class AdafruitSSD1306:
+    """adafruit_ssd1306 で、アドレスを指定して GDDRAM に書き込む."""
+
+    def __init__(self, address: int) -> None:
+        """初期化.
+
+        Args:
+            address: OLED の I²Cアドレス
+        """
+        import board  # type: ignore  # 実機のときだけ必要
+        import adafruit_ssd1306  # type: ignore
+
+        i2c: board.I2C = board.I2C()
+        self.oled: adafruit_ssd1306.SSD1306_I2C = adafruit_ssd1306.SSD1306_I2C(WIDTH, HEIGHT, i2c, addr=address)
+
+    def write_cmd(self, cmd: int) -> None:
+        """コマンドを書き込む.
+
+        Args:
+            cmd: コマンド
+        """
+        self.oled.write_cmd(cmd)
+
+    def write_data(self, data: bytes) -> None:
+        """GDDRAM に書き込む.
+
+        Args:
+            data: データ
+        """
+        with self.oled.i2c_device:
+            self.oled.i2c_device.write(b"\x40" + data)
+
+    def contrast(self, contrast: int) -> None:
+        """輝度を設定する.
+
+        Args:
+            contrast: 輝度(0〜255)
+        """
+        self.oled.contrast(contrast)
+
+    def poweron(self) -> None:
+        """表示する."""
+        self.oled.poweron()
+
+    def poweroff(self) -> None:
+        """表示を消す(GDDRAM の内容は残る)."""
+        self.oled.poweroff()
+
+
+class FakeSSD1306:
+    """SSD1306 の代わり(GDDRAM をメモリに持ち、水平アドレッシングモードの書き込みを再現する)."""
+
+    def __init__(self) -> None:
+        """初期化."""
+        self.ram: bytearray = bytearray(WIDTH * PAGES)
+        self.is_on: bool = True
+        self.columns: typ.Tuple[int, int] = (0, WIDTH - 1)
+        self.pages: typ.Tuple[int, int] = (0, PAGES - 1)
+        self.pending: typ.List[int] = []  # 引数を待っているコマンド
+        self.column: int = 0
+        self.page: int = 0
+
+    def write_cmd(self, cmd: int) -> None:
+        """コマンドを書き込む(列アドレスとページアドレスの設定だけを再現する).
+
+        Args:
+            cmd: コマンド
+        """
+        if len(self.pending) == 0 and cmd not in (SET_COL_ADDR, SET_PAGE_ADDR):
+            return
+        self.pending.append(cmd)
+        if len(self.pending) == 3:
+            if self.pending[0] == SET_COL_ADDR:
+                self.columns = (self.pending[1], self.pending[2])
+                self.column = self.pending[1]
+            else:
+                self.pages = (self.pending[1], self.pending[2])
+                self.page = self.pending[1]
+            self.pending = []
+
+    def write_data(self, data: bytes) -> None:
+        """GDDRAM に書き込む.
+
+        Args:
+            data: データ
+        """
+        for value in data:
+            self.ram[self.page * WIDTH + self.column] = value
+            if self.column < self.columns[1]:
+                self.column += 1
+                continue
+            self.column = self.columns[0]
+            self.page = self.page + 1 if self.page < self.pages[1] else self.pages[0]
+
+    def contrast(self, contrast: int) -> None:
+        """輝度を設定する.
+
+        Args:
+            contrast: 輝度(0〜255)
+        """
+
+    def poweron(self) -> None:
+        """表示する."""
+        self.is_on = True
+
+    def poweroff(self) -> None:
+        """表示を消す."""
+        self.is_on = False
 
 
 class Display:
     """OLED Display."""
 
-    def __init__(self, address: int, contrast: int) -> None:
+    def __init__(
+        self, address: int, contrast: int, oled: typ.Any = None, font_path: typ.Optional[str] = FONT_PATH
+    ) -> None:
         """初期化.
 
         Args:
             address: OLED の I²Cアドレス
             contrast: 輝度(0〜255)、0で消える。
+            oled: AdafruitSSD1306 互換のオブジェクト(Noneのときは実機)
+            font_path: TrueType フォントのパス(Noneのときは Pillow 内蔵のフォント。日本語は表示できない)
         """
-        i2c: board.I2C = board.I2C()
-        self.oled: adafruit_ssd1306.SSD1306_I2C = adafruit_ssd1306.SSD1306_I2C(WIDTH, HEIGHT, i2c, addr=address)
+        self.oled: typ.Any = oled if oled is not None else AdafruitSSD1306(address)
         self.oled.contrast(contrast)
-        self.image: Image = Image.new("1", (self.oled.width, self.oled.height))
-        self.draw: ImageDraw = ImageDraw.Draw(self.image)
-        self.font: ImageFont = ImageFont.truetype("/usr/share/fonts/truetype/horai-umefont/ume-tmo3.ttf", 16)
+        font: Font = (
+            ImageFont.truetype(font_path, FONT_SIZE) if font_path is not None else ImageFont.load_default(FONT_SIZE)
+        )
+        self.glyphs: GlyphCache = GlyphCache(font)
+        self.frame: bytearray = bytearray(WIDTH * PAGES)  # 描いている画面
+        self.sent: typ.Optional[bytearray] = None  # 最後に送った画面(Noneのときは分からない)
+        self.stats: TransferStats = TransferStats()
         self.is_display: bool = True
 
     def clear(self) -> None:
@@ -38,8 +232,99 @@ class Display:
         if not self.is_display:
             self.oled.poweron()
             self.is_display = True
-        self.oled.image(self.image)
-        self.oled.show()
+        self.flush()
+
+    def flush(self) -> None:
+        """前回送った画面から変わった部分だけを送る.
+
+        ページごとに変わった列の範囲を求めて、続くページは、まとめた方が転送量が少ないときは1回で送る。
+        """
+        start: float = time.perf_counter()
+        if self.sent is None:
+            self.write(0, WIDTH - 1, 0, PAGES - 1)
+        else:
+            # (最初の列, 最後の列, 最初のページ, 最後のページ)
+            regions: typ.List[typ.List[int]] = []
+            for page in range(PAGES):
+                offset: int = page * WIDTH
+                row: bytearray = self.frame[offset : offset + WIDTH]
+                sent: bytearray = self.sent[offset : offset + WIDTH]
+                if row == sent:
+                    continue
+                first: int = 0
+                while row[first] == sent[first]:
+                    first += 1
+                last: int = WIDTH - 1
+                while row[last] == sent[last]:
+                    last -= 1
+                if len(regions) > 0 and regions[-1][3] == page - 1:
+                    r_first, r_last, r_page, _ = regions[-1]
+                    merged: int = (max(r_last, last) - min(r_first, first) + 1) * (page - r_page + 1)
+                    separate: int = (r_last - r_first + 1) * (page - r_page) + (last - first + 1) + WRITE_OVERHEAD
+                    if merged <= separate:
+                        regions[-1] = [min(r_first, first), max(r_last, last), r_page, page]
+                        continue
+                regions.append([first, last, page, page])
+            for region in regions:
+                self.write(*region)
+        self.sent = bytearray(self.frame)
+        self.stats.seconds += time.perf_counter() - start
+
+    def write(self, first: int, last: int, first_page: int, last_page: int) -> None:
+        """画面の範囲を GDDRAM に書き込む.
+
+        Args:
+            first: 最初の列
+            last: 最後の列
+            first_page: 最初のページ
+            last_page: 最後のページ
+        """
+        data: bytes = b"".join(
+            self.frame[page * WIDTH + first : page * WIDTH + last + 1] for page in range(first_page, last_page + 1)
+        )
+        for cmd in (SET_COL_ADDR, first, last, SET_PAGE_ADDR, first_page, last_page):
+            self.oled.write_cmd(cmd)
+        self.oled.write_data(data)
+        self.stats.transfers += 7
+        self.stats.bytes += WRITE_OVERHEAD + len(data)
+
+    def text(self, x: int, page: int, text: str, static: bool = False) -> int:
+        """文字列を描く.
+
+        Args:
+            x: 左端の列
+            page: 一番上のページ
+            text: 文字列
+            static: 決まった文字列(ラベルなど)なら文字列ごとキャッシュする(数字などは1文字ずつキャッシュする)
+
+        Returns:
+            次の文字を描く列
+        """
+        for chars in [text] if static else text:
+            glyph: typ.List[bytes] = self.glyphs.get(chars)
+            width: int = min(len(glyph[0]), WIDTH - x)
+            if width <= 0:
+                break
+            for i, columns in enumerate(glyph[: PAGES - page]):
+                offset: int = (page + i) * WIDTH + x
+                self.frame[offset : offset + width] = columns[:width]
+            x += width
+        return x
+
+    def lines(self, rows: typ.Sequence[typ.Tuple[str, typ.Optional[float], str, str]]) -> None:
+        """画面を消して、値を1行ずつ描く(値がない行は詰める).
+
+        Args:
+            rows: (ラベル, 値, 書式, 単位)のリスト
+        """
+        self.frame[:] = bytes(len(self.frame))
+        page: int = 0
+        for label, value, spec, unit in rows:
+            if value is not None:
+                x: int = self.text(0, page, label, static=True)
+                x = self.text(x, page, format(value, spec))
+                self.text(x, page, unit, static=True)
+                page += LINE_PAGES
 
     def update(
         self, co2: typ.Optional[int], temp: typ.Optional[float], hum: typ.Optional[float], pres: typ.Optional[float]
@@ -52,23 +337,84 @@ class Display:
             hum: 湿度
             pres: 気圧
         """
-        self.draw.rectangle([0, 0, WIDTH, HEIGHT], fill=0)
-        y: int = 0
-        if co2 is not None:
-            self.draw.text((0, y), f"CO₂  {co2:6.1f} ppm", font=self.font, fill=255)
-            y += 16
-        if temp is not None:
-            self.draw.text((0, y), f"気温 {temp:6.1f} ℃", font=self.font, fill=255)
-            y += 16
-        if hum is not None:
-            self.draw.text((0, y), f"湿度 {hum:6.1f} %", font=self.font, fill=255)
-            y += 16
-        if pres is not None:
-            self.draw.text((0, y), f"気圧 {pres:6.1f} hPa", font=self.font, fill=255)
-            y += 16
+        self.lines(
+            [
+                ("CO₂  ", co2, "6.1f", " ppm"),
+                ("気温 ", temp, "6.1f", " ℃"),
+                ("湿度 ", hum, "6.1f", " %"),
+                ("気圧 ", pres, "6.1f", " hPa"),
+            ]
+        )
+
+    def update_power(
+        self, power: typ.Optional[float], current: typ.Optional[float], power_avg: typ.Optional[float]
+    ) -> None:
+        """電力の画面にする.
+
+        Args:
+            power: 瞬時電力[W]
+            current: 瞬時電流[A]
+            power_avg: 瞬時電力の移動平均[W]
+        """
+        self.lines(
+            [
+                ("電力 ", power, "6.0f", " W"),
+                ("電流 ", current, "6.1f", " A"),
+                ("平均 ", power_avg, "6.0f", " W"),
+            ]
+        )
+
+    def update_graph(
+        self, label: str, value: typ.Optional[float], spec: str, unit: str, history: typ.Sequence[typ.Optional[float]]
+    ) -> None:
+        """1行目に最新の値、その下に履歴の折れ線(sparkline)を描く.
+
+        Args:
+            label: ラベル
+            value: 最新の値
+            spec: 値の書式
+            unit: 単位
+            history: 古い順の値(値がないところはNone)
+        """
+        self.frame[:] = bytes(len(self.frame))
+        x: int = self.text(0, 0, label, static=True)
+        if value is not None:
+            x = self.text(x, 0, format(value, spec))
+            self.text(x, 0, unit, static=True)
+        self.sparkline(LINE_PAGES, PAGES - LINE_PAGES, history)
+
+    def sparkline(self, first_page: int, pages: int, values: typ.Sequence[typ.Optional[float]]) -> None:
+        """折れ線を描く(最小値から最大値までを高さいっぱいにする).
+
+        Args:
+            first_page: 一番上のページ
+            pages: 高さ(ページ数)
+            values: 古い順の値(値がないところは描かない)
+        """
+        known: typ.List[float] = [value for value in values if value is not None]
+        if len(values) == 0 or len(known) == 0:
+            return
+        low: float = min(known)
+        high: float = max(known)
+        top: int = first_page * 8
+        height: int = pages * 8
+        previous: typ.Optional[int] = None
+        for x in range(WIDTH):
+            value: typ.Optional[float] = values[x * len(values) // WIDTH]
+            if value is None:
+                previous = None
+                continue
+            level: float = (value - low) / (high - low) if high > low else 0.5
+            y: int = top + height - 1 - round(level * (height - 1))
+            # 前の列とつながるように、縦に線を引く
+            start, end = (y, y) if previous is None else (min(y, previous), max(y, previous))
+            for dot in range(start, end + 1):
+                self.frame[(dot // 8) * WIDTH + x] |= 1 << (dot % 8)
+            previous = y
 
 
 if __name__ == "__main__":
     display: Display = Display(0x3C, 1)
     display.update(800, 12.3, 34.5, 1234.5)
+    display.redraw()
     time.sleep(10)
@@ -0,0 +1,53 @@
+"""一定間隔で処理を行う別スレッド.
+
+センサーの読み込み(co2_reader.CO2Reader, sensor_plugin.SensorScheduler)で使う。
+処理ごとの間隔で、次に行う時刻が早いものから順に行う。
+処理に時間がかかって遅れたときは、遅れを取り戻そうとせずに、終わった時刻から次の間隔を数える。
+"""
+
+import abc
+import heapq
+import threading
+import time
+import typing as typ
+
+
+class PeriodicWorker(abc.ABC):
+    """一定間隔で処理を行う別スレッドの基底クラス."""
+
+    def __init__(self) -> None:
+        """初期化."""
+        self.stopped: threading.Event = threading.Event()
+        self.thread: typ.Optional[threading.Thread] = None
+
+    @abc.abstractmethod
+    def tasks(self) -> typ.List[typ.Tuple[float, typ.Callable[[], None]]]:
+        """行う処理.
+
+        Returns:
+            (間隔[秒], 処理)のリスト(処理の例外は処理の中で扱うこと)
+        """
+
+    def start(self) -> None:
+        """開始する."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """止める(処理中のときは、終わってから止まる)."""
+        self.stopped.set()
+
+    def run(self) -> None:
+        """次に行う時刻が早い処理から順に行う(スレッドの処理)."""
+        tasks: typ.List[typ.Tuple[float, typ.Callable[[], None]]] = self.tasks()
+        now: float = time.monotonic()
+        schedule: typ.List[typ.Tuple[float, int]] = [(now, i) for i in range(len(tasks))]
+        heapq.heapify(schedule)
+        while len(schedule) > 0 and not self.stopped.is_set():
+            next_time, index = schedule[0]
+            if self.stopped.wait(max(next_time - time.monotonic(), 0)):
+                break
+            interval, task = tasks[index]
+            task()
+            heapq.heapreplace(schedule, (max(next_time + interval, time.monotonic()), index))
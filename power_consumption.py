@@ -2,19 +2,48 @@
 
 import argparse
 import configparser
+import datetime
 import re
 import struct
 import subprocess
 import sys
 import time
 import typing as typ
-import yaml  # type: ignore
+import alert
+import co2_reader
 import db_store
 import echonet
+import rolling_stats
+import sensor_plugin
 import skcommand
-import mh_z19
-import bme280
-import tsl2572
+
+if typ.TYPE_CHECKING:
+    import display_channel
+    import latest_server
+
+# 瞬時電力計測値・瞬時電流計測値から求める監視対象の値
+INSTANT_VALUES: typ.Set[str] = {"power", "current", "current_r", "current_t"}
+
+
+def instant_values(
+    瞬時電力: typ.Optional[int], 瞬時電流_R: typ.Optional[int], 瞬時電流_T: typ.Optional[int]
+) -> typ.Dict[str, typ.Optional[float]]:
+    """監視対象の値(電力[W]、電流[A])にする.
+
+    Args:
+        瞬時電力: 瞬時電力計測値
+        瞬時電流_R: 瞬時電流計測値(R相)
+        瞬時電流_T: 瞬時電流計測値(T相)
+
+    Returns:
+        値の名前と値
+    """
+    return {
+        "power": 瞬時電力,
+        "current": None if 瞬時電流_R is None or 瞬時電流_T is None else (瞬時電流_R + 瞬時電流_T) / 10,
+        "current_r": None if 瞬時電流_R is None else 瞬時電流_R / 10,
+        "current_t": None if 瞬時電流_T is None else 瞬時電流_T / 10,
+    }
 
 
 class PowerConsumption:
@@ -50,12 +79,28 @@ class PowerConsumption:
 
         self.sk: skcommand.SKSerial = skcommand.SKSerial(device, timeout, debug)
 
+        self.alert: alert.AlertEngine = alert.load_rules(inifile)
+        # 瞬時電力・瞬時電流のルールがあるときに、1分ごとの計測の合間に読み出す間隔[秒](0なら読み出さない)
+        self.alert_interval: float = 0
+        if len(self.alert.values & INSTANT_VALUES) > 0:
+            self.alert_interval = inifile.getfloat("alert", "interval", fallback=10)
+
         self.connected: bool = False
         self.sk_flag: bool = True
         self.temp_flag: bool = False
         self.co2_flag: bool = False
         self.bme280_flag: bool = False
         self.display_flag: bool = False
+        self.latest: typ.Optional[latest_server.LatestValues] = None
+        self.latest_pending: typ.Dict[str, typ.Dict] = {}  # 今回の収集で読んだ計測値(HTTPサーバ用)
+        self.display: typ.Optional[display_channel.DisplaySender] = None
+        # 最後に読み出した瞬時電力・瞬時電流(instant_values の値)
+        self.instant: typ.Dict[str, typ.Optional[float]] = instant_values(None, None, None)
+        # 瞬時電力[W]と瞬時電流(R相とT相の合計)[0.1A]の移動統計
+        self.power_stats: typ.Dict[str, rolling_stats.RollingStats] = {
+            "瞬時電力": rolling_stats.RollingStats(rolling_stats.MOVING_AVERAGE_PERIOD),
+            "瞬時電流": rolling_stats.RollingStats(rolling_stats.MOVING_AVERAGE_PERIOD),
+        }
 
     def main(self) -> None:
         """メイン処理."""
@@ -68,6 +113,7 @@ class PowerConsumption:
         parser.add_argument("-b", "--bme280", action="store_true", help="log BME280")
         parser.add_argument("-l", "--tsl2572", action="store_true", help="log TSL2572")
         parser.add_argument("-d", "--display", action="store_true", help="enable display")
+        parser.add_argument("-w", "--http", action="store_true", help="serve latest values over HTTP")
 
         args: argparse.Namespace = parser.parse_args()
 
@@ -84,10 +130,18 @@ class PowerConsumption:
 
         self.temp_flag = args.temp
         self.co2_flag = args.co2
+        if self.co2_flag:
+            co2_interval: float = self.inifile.getfloat("mh_z19", "interval", fallback=10)
+            co2_max_age: float = self.inifile.getfloat("mh_z19", "max_age", fallback=120)
+            self.co2_reader: co2_reader.CO2Reader = co2_reader.CO2Reader(co2_interval, co2_max_age)
+            self.co2_reader.start()
         self.bme280_flag = args.bme280
         self.tsl2572_flag = args.tsl2572
         self.display_flag = args.display
+        # センサーなどのモジュールは、使うときだけ import する(-i などで起動を速くするため)
         if self.bme280_flag:
+            import bme280
+
             bus: int = self.inifile.getint("bme280", "bus", fallback=1)
             address: int = self.inifile.getint("bme280", "address", fallback=0x76)
             osrs_h: int = self.inifile.getint("bme280", "osrs_h", fallback=1)
@@ -95,23 +149,53 @@ class PowerConsumption:
             osrs_p: int = self.inifile.getint("bme280", "osrs_p", fallback=5)
             t_sb: int = self.inifile.getint("bme280", "t_sb", fallback=0)
             filter: int = self.inifile.getint("bme280", "filter", fallback=4)
+            mode: int = self.inifile.getint("bme280", "mode", fallback=3)
             self.bme280 = bme280.BME280(
                 bus,
                 address,
                 osrs_h=osrs_h,
                 osrs_t=osrs_t,
                 osrs_p=osrs_p,
+                mode=mode,
                 t_sb=t_sb,
                 filter=filter,
             )
+            self.bme280_burst: int = self.inifile.getint("bme280", "burst", fallback=1)
+            if self.bme280_burst > 1 and mode not in (1, 2):
+                # 通常モードで続けて読み込んでも、同じ測定結果を読むだけになる
+                raise ValueError("[bme280] burst > 1 requires mode = 1 (forced mode)")
+            self.bme280_raw: bool = self.inifile.getboolean("bme280", "raw_log", fallback=False)
+            self.bme280_calibration_id: typ.Optional[int] = None
         if self.tsl2572_flag:
+            import tsl2572
+
             tsl2572_bus: int = self.inifile.getint("tsl2572", "bus", fallback=1)
             tsl2572_address: int = self.inifile.getint("tsl2572", "address", fallback=0x39)
             atime: int = self.inifile.getint("tsl2572", "atime", fallback=0xC0)
             again: int = self.inifile.getint("tsl2572", "again", fallback=0)
-            self.tsl2572 = tsl2572.TSL2572(tsl2572_bus, tsl2572_address, atime=atime, again=again)
+            continuous: bool = self.inifile.getboolean("tsl2572", "continuous", fallback=False)
+            wtime: int = self.inifile.getint("tsl2572", "wtime", fallback=0x00)
+            auto_range: bool = self.inifile.getboolean("tsl2572", "auto_range", fallback=False)
+            self.tsl2572 = tsl2572.TSL2572(
+                tsl2572_bus,
+                tsl2572_address,
+                atime=atime,
+                again=again,
+                continuous=continuous,
+                wtime=wtime,
+                auto_range=auto_range,
+            )
         if self.display_flag:
-            self.data_path: str = self.inifile.get("ssd1306", "data_path", fallback="display.dat")
+            import display_channel
+
+            self.display = display_channel.DisplaySender(self.inifile.get("ssd1306", "socket", fallback="display.sock"))
+        if args.http:
+            import latest_server
+
+            self.latest = latest_server.LatestValues()
+            http_address: str = self.inifile.get("http", "address", fallback="127.0.0.1")
+            http_port: int = self.inifile.getint("http", "port", fallback=8080)
+            latest_server.LatestServer(http_address, http_port, self.latest).start()
 
         if not self.sk.routeB_auth(self.routeB_id, self.routeB_password):
             print("ルートBの認証情報の設定に失敗しました。")
@@ -120,7 +204,22 @@ class PowerConsumption:
         else:
             self.connected = self.scan() and self.join()
 
-        if not self.temp_flag and not self.co2_flag and not self.bme280_flag and not self.sk_flag:
+        self.sensors: typ.List[sensor_plugin.SensorPlugin] = sensor_plugin.load_plugins(self.inifile)
+        self.sensor_scheduler: sensor_plugin.SensorScheduler = sensor_plugin.SensorScheduler(self.sensors)
+        if len(self.sensors) > 0:
+            store: db_store.DBStore = db_store.DBStore(self.db_url)
+            for plugin in self.sensors:
+                store.create_log_table(plugin.table, [(field.name, field.sql_type) for field in plugin.fields])
+            del store
+            self.sensor_scheduler.start()
+
+        if (
+            not self.temp_flag
+            and not self.co2_flag
+            and not self.bme280_flag
+            and not self.sk_flag
+            and len(self.sensors) == 0
+        ):
             sys.exit(1)
 
         try:
@@ -189,6 +288,22 @@ class PowerConsumption:
         if self.zabbix_trap:
             print(f"- {self.zabbix_key_prefix}.{key} {value}", file=self.zabbix_trap)
 
+    def publish(self, name: str, values: typ.Dict) -> None:
+        """HTTPサーバに渡す計測値を追加する(update_latest でまとめて更新する).
+
+        Args:
+            name: 種類
+            values: 計測値
+        """
+        if self.latest is not None:
+            self.latest_pending[name] = values
+
+    def update_latest(self) -> None:
+        """追加した計測値で、HTTPサーバの最新の計測値をまとめて更新する."""
+        if self.latest is not None:
+            self.latest.update(self.latest_pending)
+        self.latest_pending = {}
+
     def get_prop(self) -> bool:
         """property値読み出し.
 
@@ -234,6 +349,17 @@ class PowerConsumption:
         store: db_store.DBStore = db_store.DBStore(self.db_url)
         store.power_log(係数, 積算電力量, 電力量単位, 瞬時電力, 瞬時電流_R, 瞬時電流_T)
         del store
+        self.publish(
+            "power",
+            {
+                "係数": 係数,
+                "積算電力量": 積算電力量,
+                "電力量単位": 電力量単位,
+                "瞬時電力": 瞬時電力,
+                "瞬時電流_r": 瞬時電流_R,
+                "瞬時電流_t": 瞬時電流_T,
+            },
+        )
 
         self.add_zabbix("coefficient", 係数)
         self.add_zabbix("energy", 積算電力量)
@@ -242,8 +368,77 @@ class PowerConsumption:
         self.add_zabbix("current_R", 瞬時電流_R)
         self.add_zabbix("current_T", 瞬時電流_T)
 
+        now: datetime.datetime = datetime.datetime.now()
+        self.instant = instant_values(瞬時電力, 瞬時電流_R, 瞬時電流_T)
+        self.alert.evaluate(self.instant, now)
+        self.power_stats["瞬時電力"].add(now, 瞬時電力)
+        self.power_stats["瞬時電流"].add(
+            now, None if 瞬時電流_R is None or 瞬時電流_T is None else 瞬時電流_R + 瞬時電流_T
+        )
         return True
 
+    def check_instant(self) -> None:
+        """瞬時電力と瞬時電流だけを読み出して、監視ルールを評価する(DBには登録しない)."""
+        props: typ.Optional[typ.List] = self.sk.get_prop(
+            self.ipv6addr, [echonet.EPC_瞬時電力計測値, echonet.EPC_瞬時電流計測値]
+        )
+        if props is None:
+            return
+        propdict: typ.Dict[int, bytes] = {p.epc: p.edt for p in props}
+        瞬時電力: typ.Optional[int] = None
+        瞬時電流_R: typ.Optional[int] = None
+        瞬時電流_T: typ.Optional[int] = None
+        if echonet.EPC_瞬時電力計測値 in propdict:
+            瞬時電力 = struct.unpack_from("!l", propdict[echonet.EPC_瞬時電力計測値])[0]
+        if echonet.EPC_瞬時電流計測値 in propdict:
+            瞬時電流_R = struct.unpack_from("!h", propdict[echonet.EPC_瞬時電流計測値])[0]
+            瞬時電流_T = struct.unpack_from("!h", propdict[echonet.EPC_瞬時電流計測値], 2)[0]
+        self.instant = instant_values(瞬時電力, 瞬時電流_R, 瞬時電流_T)
+        self.alert.evaluate(self.instant)
+
+    def publish_power_stats(self) -> None:
+        """瞬時電力と瞬時電流の移動統計を、HTTPサーバとzabbixに渡す."""
+        now: datetime.datetime = datetime.datetime.now()
+        for stats in self.power_stats.values():
+            stats.expire(now)
+        power: rolling_stats.RollingStats = self.power_stats["瞬時電力"]
+        current: rolling_stats.RollingStats = self.power_stats["瞬時電流"]
+        self.publish("power_average", {"瞬時電力": power.mean, "瞬時電流": current.mean})
+        self.publish("power_stats", {name: stats.to_dict() for name, stats in self.power_stats.items()})
+        if power.count > 0:
+            self.add_zabbix("power_avg", power.mean)
+            self.add_zabbix("power_min", power.min)
+            self.add_zabbix("power_max", power.max)
+            self.add_zabbix("power_stddev", power.stddev)
+        if current.count > 0:
+            self.add_zabbix("current_avg", current.mean)
+            self.add_zabbix("current_max", current.max)
+
+    def send_display(
+        self, co2: typ.Optional[int], temp: typ.Optional[float], hum: typ.Optional[float], pres: typ.Optional[float]
+    ) -> None:
+        """ディスプレイに計測値を送る.
+
+        Args:
+            co2: CO₂濃度
+            temp: 気温
+            hum: 湿度
+            pres: 気圧
+        """
+        import display_channel
+
+        data: display_channel.DisplayData = display_channel.DisplayData(
+            co2=co2,
+            temp=temp,
+            hum=hum,
+            pres=pres,
+            power=self.instant["power"],
+            power_avg=self.power_stats["瞬時電力"].mean,
+            current=self.instant["current"],
+        )
+        if self.display is not None and not self.display.send(data):
+            self.sk.debug_print("display: not sent")
+
     def log_temp(self) -> float:
         """温度を記録する.
 
@@ -256,6 +451,8 @@ class PowerConsumption:
         store: db_store.DBStore = db_store.DBStore(self.db_url)
         store.temp_log(temp)
         del store
+        self.alert.evaluate({"cpu_temp": temp / 1000})
+        self.publish("temp", {"temp": temp})
         self.add_zabbix("cpu_temperature", temp)
         return float(temp)
 
@@ -265,12 +462,14 @@ class PowerConsumption:
         Returns:
             CO2濃度, 気温
         """
-        d: typ.Dict = mh_z19.read_all(serial_console_untouched=True)
+        d: typ.Optional[typ.Dict] = self.co2_reader.latest()
         self.sk.debug_print(f"MH_Z19: {d}")
-        if "co2" in d:
+        if d is not None:
             store: db_store.DBStore = db_store.DBStore(self.db_url)
             store.co2_log(d["co2"], d["temperature"], d["UhUl"], d["SS"])
             del store
+            self.publish("co2", {"co2": d["co2"], "temp": d["temperature"], "pressure": d["UhUl"], "ss": d["SS"]})
+            self.alert.evaluate({"co2": d["co2"], "co2_temp": d["temperature"]})
             self.add_zabbix("co2", d["co2"])
             return (d["co2"], d["temperature"])
         return (0, 0)
@@ -281,10 +480,29 @@ class PowerConsumption:
         Returns:
             気圧, 気温, 湿度
         """
-        d: typ.Tuple = self.bme280.read()
+        values: typ.Dict[str, float] = {}
+        rawdata: typ.Tuple
+        d: typ.Tuple
+        if self.bme280_burst > 1:
+            burst: typ.Dict[str, typ.Tuple] = self.bme280.read_burst(self.bme280_burst)
+            rawdata, d = burst["raw"], burst["mean"]
+            for stat in ("min", "max"):
+                values.update(zip([f"pressure_{stat}", f"temp_{stat}", f"humidity_{stat}"], burst[stat]))
+        else:
+            rawdata = self.bme280.read_raw()
+            d = self.bme280.compensate(rawdata)
         store: db_store.DBStore = db_store.DBStore(self.db_url)
-        store.bme280_log(d[1], d[0], d[2])
+        log_id: int = store.bme280_log(d[1], d[0], d[2])
+        if self.bme280_raw:
+            # 後から補正し直せるように、生データと calibration data も残す
+            if self.bme280_calibration_id is None:
+                self.bme280_calibration_id = store.bme280_calibration(
+                    self.bme280.dig_T, self.bme280.dig_P, self.bme280.dig_H
+                )
+            store.bme280_raw_log(log_id, self.bme280_calibration_id, *rawdata)
         del store
+        self.publish("bme280", {"temp": d[1], "pressure": d[0], "humidity": d[2], **values})
+        self.alert.evaluate({"temp": d[1], "pressure": d[0], "humidity": d[2]})
         self.add_zabbix("temperature", d[1])
         self.add_zabbix("pressure", d[0])
         self.add_zabbix("humidity", d[2])
@@ -300,9 +518,34 @@ class PowerConsumption:
         store: db_store.DBStore = db_store.DBStore(self.db_url)
         store.tsl2572_log(values[0], values[1], values[2], values[3], values[4])
         del store
+        self.publish(
+            "tsl2572",
+            {"illuminance": values[0], "lux1": values[1], "lux2": values[2], "ch0": values[3], "ch1": values[4]},
+        )
+        self.alert.evaluate({"illuminance": values[0]})
         self.add_zabbix("illuminance", values[0])
         return values
 
+    def log_sensors(self) -> None:
+        """プラグインのセンサーで読み込んだ値をまとめて記録する."""
+        pending: typ.Dict[str, typ.List[typ.Dict[str, typ.Any]]] = self.sensor_scheduler.take()
+        if len(pending) == 0:
+            return
+        store: db_store.DBStore = db_store.DBStore(self.db_url)
+        for plugin in self.sensors:
+            rows: typ.List[typ.Dict[str, typ.Any]] = pending.get(plugin.name, [])
+            if len(rows) == 0:
+                continue
+            columns: typ.List[str] = [field.name for field in plugin.fields] + ["created_at"]
+            store.insert_log_rows(plugin.table, columns, [[row.get(column) for column in columns] for row in rows])
+            self.sk.debug_print(f"{plugin.name}: {rows[-1]}")
+            self.publish(plugin.name, rows[-1])
+            self.alert.evaluate({f"{plugin.name}.{field.name}": rows[-1].get(field.name) for field in plugin.fields})
+            for field in plugin.fields:
+                if field.zabbix_key is not None and rows[-1].get(field.name) is not None:
+                    self.add_zabbix(field.zabbix_key, rows[-1][field.name])
+        del store
+
     def task(self) -> None:
         """1分間隔で繰り返し実行."""
         interval: int = 60
@@ -323,6 +566,7 @@ class PowerConsumption:
                 (pres, temp, hum) = self.log_bme280()
             if self.tsl2572_flag and self.tsl2572.initialized:
                 self.log_tsl2572()
+            self.log_sensors()
             if self.sk_flag:
                 if self.connected:
                     if not self.get_prop():
@@ -337,20 +581,32 @@ class PowerConsumption:
                         self.connected = True
                     else:
                         wait_counter = 10
-            if self.display_flag:
-                with open(self.data_path, "w") as f:
-                    data = {"co2": co2, "temp": temp, "hum": hum, "pres": pres}
-                    yaml.dump(data, f)
+                self.publish_power_stats()
+            self.update_latest()
+            if self.display:
+                self.send_display(co2, temp, hum, pres)
             if self.zabbix_trap:
                 self.zabbix_trap.close()
                 with open("zabbix.log", "wt") as zabbix_log:
                     subprocess.run(self.zabbix_command, stdout=zabbix_log, stderr=subprocess.STDOUT)
                 self.zabbix_trap = None
             now: float = time.time()
+            next_alert: float = now + self.alert_interval
             if self.connected:
                 while now < next_time:
-                    line: str = self.sk.readline(next_time - now)
+                    deadline: float = next_time
+                    if self.alert_interval > 0:
+                        if now >= next_alert:
+                            self.check_instant()
+                            now = time.time()
+                            next_alert = now + self.alert_interval
+                            continue
+                        deadline = min(next_time, next_alert)
+                    line: str = self.sk.readline(deadline - now)
                     if len(line) == 0 or not line.endswith("\n"):
+                        if deadline < next_time:
+                            now = time.time()
+                            continue
                         break
                     line = line.replace("\r\n", "")
                     self.sk.debug_print(f"DROP [{line}]")
@@ -0,0 +1,253 @@
+"""30分ごとの電力量と電気料金の計算.
+
+スマートメーターの積算電力量から30分ごとの使用量を求め、ini ファイルの [tariff] に書いた料金プラン
+(時間帯別単価、月の使用量による段階別単価、基本料金)で料金を計算して、日ごと・月ごとに集計する。
+"""
+
+import argparse
+import configparser
+import dataclasses
+import datetime
+import typing as typ
+import numpy as np
+import pandas as pd
+import db_store
+import echonet
+
+SLOT: datetime.timedelta = datetime.timedelta(minutes=30)
+MINUTES_PER_DAY: int = 24 * 60
+
+
+def parse_time_of_use(value: str) -> np.ndarray:
+    """時間帯別単価の設定を、1分ごとの単価の表にする.
+
+    Args:
+        value: 「開始時刻-終了時刻 単価」のカンマ区切り(例: "23:00-07:00 27.86, 07:00-23:00 35.76")
+
+    Returns:
+        0時0分からの分を添字にした単価の配列
+    """
+    prices: np.ndarray = np.full(MINUTES_PER_DAY, np.nan)
+    for item in value.split(","):
+        period, price = item.split()
+        start, end = (int(t.split(":")[0]) * 60 + int(t.split(":")[1]) for t in period.split("-"))
+        if start < end:
+            prices[start:end] = float(price)
+        else:  # 日をまたぐ時間帯
+            prices[start:] = float(price)
+            prices[: end % MINUTES_PER_DAY] = float(price)
+    if np.isnan(prices).any():
+        raise ValueError(f"time_of_use does not cover all day: {value}")
+    return prices
+
+
+def parse_tiers(value: str) -> typ.List[typ.Tuple[float, float]]:
+    """段階別単価の設定を解析する.
+
+    Args:
+        value: 「使用量の下限[kWh] 単価」のカンマ区切り(例: "0 29.80, 120 36.40, 300 40.49")
+
+    Returns:
+        (下限, 単価)のリスト(下限の昇順)
+    """
+    tiers: typ.List[typ.Tuple[float, float]] = []
+    for item in value.split(","):
+        lower, price = item.split()
+        tiers.append((float(lower), float(price)))
+    return sorted(tiers)
+
+
+@dataclasses.dataclass
+class Tariff:
+    """料金プラン.
+
+    時間帯別単価と段階別単価の両方を指定したときは、その合計を単価とする。
+    """
+
+    base: float = 0.0  # 基本料金(円/月)
+    adjustment: float = 0.0  # 全ての使用量に加算する単価(燃料費調整額、再エネ賦課金など)(円/kWh)
+    time_of_use: typ.Optional[np.ndarray] = None  # 平日の1分ごとの単価(円/kWh)
+    weekend_time_of_use: typ.Optional[np.ndarray] = None  # 土日の1分ごとの単価(円/kWh)
+    tiers: typ.List[typ.Tuple[float, float]] = dataclasses.field(default_factory=list)  # 段階別単価
+
+    @classmethod
+    def from_config(cls, inifile: configparser.ConfigParser, section: str = "tariff") -> "Tariff":
+        """設定ファイルから料金プランを作る.
+
+        Args:
+            inifile: ini ファイル
+            section: セクション名
+
+        Returns:
+            料金プラン
+        """
+        tariff: Tariff = Tariff(
+            base=inifile.getfloat(section, "base", fallback=0.0),
+            adjustment=inifile.getfloat(section, "adjustment", fallback=0.0),
+        )
+        if inifile.has_option(section, "time_of_use"):
+            tariff.time_of_use = parse_time_of_use(inifile.get(section, "time_of_use"))
+            tariff.weekend_time_of_use = tariff.time_of_use
+        if inifile.has_option(section, "weekend_time_of_use"):
+            tariff.weekend_time_of_use = parse_time_of_use(inifile.get(section, "weekend_time_of_use"))
+        if inifile.has_option(section, "tiers"):
+            tariff.tiers = parse_tiers(inifile.get(section, "tiers"))
+        return tariff
+
+
+def make_counter_frame(rows: typ.Sequence[typ.Mapping], key: str = "time") -> pd.DataFrame:
+    """積算電力量のデータを DataFrame にする.
+
+    Args:
+        rows: select_power_counter または select_power_log のデータ
+        key: 時刻の列名
+
+    Returns:
+        time, 係数, 積算電力量, 電力量単位 の列を持つデータ
+    """
+    columns: typ.List[str] = [key, "係数", "積算電力量", "電力量単位"]
+    return pd.DataFrame.from_records(rows, columns=columns).rename(columns={key: "time"})
+
+
+def slot_energy(df: pd.DataFrame) -> pd.Series:
+    """30分ごとの使用量を求める.
+
+    隣り合う計測値の差を、後の計測値の時刻が属する30分に割り当てる。欠測があったときは、
+    その間の使用量は欠測の後の30分にまとめて入る。
+    積算電力量が上限を超えて0に戻ったときは、上限で折り返して差を求める。
+    係数や積算電力量単位が変わったときは、kWh に換算した値の差を使う(減っていたときは0とする)。
+
+    Args:
+        df: make_counter_frame のデータ(時刻順)
+
+    Returns:
+        30分ごとの使用量[kWh](30分の開始時刻が添字。最初の計測値の30分は含まない)
+    """
+    係数: np.ndarray = df["係数"].fillna(1).to_numpy(dtype=np.float64)
+    単位補正値: pd.Series = df["電力量単位"].map(echonet.積算電力量単位)
+    for 電力量単位 in df.loc[単位補正値.isna() & df["電力量単位"].notna(), "電力量単位"].unique():
+        print(f"電力量単位異常: {int(電力量単位):X}")
+    倍率: np.ndarray = 係数 * 単位補正値.fillna(1.0).to_numpy(dtype=np.float64)
+    積算電力量: np.ndarray = df["積算電力量"].to_numpy(dtype=np.int64)
+
+    counts: np.ndarray = np.diff(積算電力量) % (echonet.積算電力量上限 + 1)
+    same: np.ndarray = 倍率[1:] == 倍率[:-1]
+    kwh: np.ndarray = 積算電力量 * 倍率
+    energy: np.ndarray = np.where(same, counts * 倍率[1:], np.maximum(np.diff(kwh), 0.0))
+    slots: pd.DatetimeIndex = pd.DatetimeIndex(df["time"].to_numpy()[1:]).floor(SLOT)
+    return pd.Series(energy, index=slots).groupby(level=0).sum()
+
+
+def slot_price(slots: pd.DatetimeIndex, table_weekday: np.ndarray, table_weekend: np.ndarray) -> np.ndarray:
+    """30分ごとの時間帯別単価を求める.
+
+    Args:
+        slots: 30分の開始時刻
+        table_weekday: 平日の1分ごとの単価
+        table_weekend: 土日の1分ごとの単価
+
+    Returns:
+        単価の配列
+    """
+    minutes: np.ndarray = np.asarray(slots.hour * 60 + slots.minute)
+    weekend: np.ndarray = np.asarray(slots.dayofweek >= 5)
+    return np.where(weekend, table_weekend[minutes], table_weekday[minutes])
+
+
+def slot_cost(energy: pd.Series, tariff: Tariff) -> pd.Series:
+    """30分ごとの電力量料金を求める(基本料金は含まない).
+
+    段階別単価は、暦月ごとの使用量の累計で決める。
+
+    Args:
+        energy: 30分ごとの使用量[kWh](月の初めからのデータがあること)
+        tariff: 料金プラン
+
+    Returns:
+        30分ごとの電力量料金[円]
+    """
+    kwh: np.ndarray = energy.to_numpy()
+    cost: np.ndarray = kwh * tariff.adjustment
+    if tariff.time_of_use is not None and tariff.weekend_time_of_use is not None:
+        cost += kwh * slot_price(
+            typ.cast(pd.DatetimeIndex, energy.index), tariff.time_of_use, tariff.weekend_time_of_use
+        )
+    if len(tariff.tiers) > 0:
+        month: pd.Index = typ.cast(pd.DatetimeIndex, energy.index).to_period("M")
+        total: np.ndarray = energy.groupby(month).cumsum().to_numpy()
+        before: np.ndarray = total - kwh
+        uppers: typ.List[float] = [lower for lower, _ in tariff.tiers[1:]] + [np.inf]
+        for (lower, price), upper in zip(tariff.tiers, uppers):
+            # 月の累計のうち、この段階に入る分
+            cost += (np.clip(total, lower, upper) - np.clip(before, lower, upper)) * price
+    return pd.Series(cost, index=energy.index)
+
+
+def make_report(
+    energy: pd.Series, tariff: Tariff, start_time: datetime.datetime, end_time: datetime.datetime, period: str
+) -> pd.DataFrame:
+    """使用量と料金を集計する.
+
+    基本料金は日割りにする(月ごとの集計では、期間に含まれる日数分)。
+
+    Args:
+        energy: 30分ごとの使用量[kWh](段階別単価のため、start_time の月の初めからのデータ)
+        tariff: 料金プラン
+        start_time: 集計範囲の最初(start_timeを含む)
+        end_time: 集計範囲の最後(end_timeを含まない)
+        period: 集計単位("slot", "day", "month")
+
+    Returns:
+        使用量[kWh]、電力量料金、基本料金、料金[円]
+    """
+    df: pd.DataFrame = pd.DataFrame({"使用量": energy, "電力量料金": slot_cost(energy, tariff)})
+    df = df[(df.index >= start_time) & (df.index < end_time)]
+    if period == "slot":
+        return df
+    daily: pd.DataFrame = df.resample("D").sum()
+    daily["基本料金"] = tariff.base / typ.cast(pd.DatetimeIndex, daily.index).days_in_month
+    daily["料金"] = daily["電力量料金"] + daily["基本料金"]
+    if period == "day":
+        return daily
+    return daily.resample("MS").sum()
+
+
+def main() -> None:
+    """メイン処理."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", help="start time (default: first day of this month)")
+    parser.add_argument("-e", "--end", help="end time (default: now)")
+    parser.add_argument("-p", "--period", choices=["slot", "day", "month"], help="report period", default="day")
+    parser.add_argument("-c", "--csv", action="store_true", help="output as CSV")
+
+    args: argparse.Namespace = parser.parse_args()
+
+    end_time: datetime.datetime = datetime.datetime.now()
+    if args.end:
+        end_time = datetime.datetime.fromisoformat(args.end)
+    start_time: datetime.datetime = datetime.datetime.combine(end_time.date().replace(day=1), datetime.time())
+    if args.start:
+        start_time = datetime.datetime.fromisoformat(args.start)
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+    tariff: Tariff = Tariff.from_config(inifile)
+
+    # 段階別単価のために月の初めから、最初の30分の使用量のためにその前の30分から取得する
+    month_start: datetime.datetime = datetime.datetime.combine(start_time.date().replace(day=1), datetime.time())
+    store: db_store.DBStore = db_store.DBStore(db_url)
+    rows: typ.List = store.select_power_counter(month_start - SLOT, end_time, SLOT)
+    if len(rows) < 2:
+        print("no data")
+        return
+    report: pd.DataFrame = make_report(slot_energy(make_counter_frame(rows)), tariff, start_time, end_time, args.period)
+    if args.csv:
+        print(report.to_csv(float_format="%.3f"), end="")
+    else:
+        print(report.to_string(float_format=lambda value: f"{value:,.2f}"))
+        print(f"合計: {report['使用量'].sum():,.2f} [kWh], {report.get('料金', report['電力量料金']).sum():,.0f} [円]")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,69 +4,133 @@ import argparse
 import configparser
 import datetime
 import os
-import statistics
 import typing as typ
-import bokeh.models as bm
-import bokeh.plotting as bp
+import numpy as np
+import pandas as pd
 import db_store
+import downsample
+import graph_batch
+import graph_output
+import incremental
+import echonet
 
+COLUMNS: typ.Tuple[str, ...] = ("time", "電力量", "電力", "電流R", "電流T", "MA電力", "MA電流R", "MA電流T")
+# データファイルに保存する列(移動平均はページで計算する)
+DATA_FILE_COLUMNS: typ.List[str] = ["time", "電力量", "電力", "電流R", "電流T"]
 
-def calc_電力量(row) -> float:
+# データファイルを読み込んだあとで、移動平均を計算する JavaScript
+MOVING_AVERAGE_JS: str = """
+    for (const name of ["電力", "電流R", "電流T"]) {
+        const values = data[name]
+        const average = new Float64Array(values.length)
+        let total = 0
+        let count = 0
+        for (let i = 0; i < values.length; i++) {
+            if (!isNaN(values[i])) {
+                total += values[i]
+                count++
+            }
+            if (i >= size && !isNaN(values[i - size])) {
+                total -= values[i - size]
+                count--
+            }
+            average[i] = total / count
+        }
+        data["MA" + name] = average
+    }
+"""
+
+
+def calc_電力量(df: pd.DataFrame) -> pd.Series:
     """電力量を計算する.
 
     Args:
-        row: 1件分のデータ
+        df: power_logのデータ
 
     Returns:
         電力量
     """
-    unit: typ.Dict[int, float] = {
-        0x00: 1.0,
-        0x01: 0.1,
-        0x02: 0.01,
-        0x03: 0.001,
-        0x04: 0.0001,
-        0x0A: 10,
-        0x0B: 100,
-        0x0C: 1000,
-        0x0D: 10000,
-    }
-    係数: int = row["係数"]
-    積算電力量: int = row["積算電力量"]
-    電力量単位: int = row["電力量単位"]
-    単位補正値: float = 1.0
+    単位補正値: pd.Series = df["電力量単位"].map(echonet.積算電力量単位)
+    for 電力量単位 in df.loc[単位補正値.isna() & df["電力量単位"].notna(), "電力量単位"].unique():
+        print(f"電力量単位異常: {int(電力量単位):X}")
+    return df["係数"] * df["積算電力量"] * 単位補正値.fillna(1.0)
+
+
+def moving_average(values: np.ndarray, window: int) -> np.ndarray:
+    """累積和を使って移動平均を計算する.
 
-    if 電力量単位 in unit:
-        単位補正値 = unit[電力量単位]
-    else:
-        print(f"電力量単位異常: {電力量単位:X}")
-    return 係数 * 積算電力量 * 単位補正値
+    先頭の window - 1 件は、それまでのデータだけで平均する。欠損値(NaN)は平均から除外する。
+
+    Args:
+        values: データ
+        window: 移動平均のサンプル数
+
+    Returns:
+        移動平均
+    """
+    valid: np.ndarray = ~np.isnan(values)
+    total: np.ndarray = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    count: np.ndarray = np.concatenate(([0], np.cumsum(valid)))
+    end: np.ndarray = np.arange(1, len(values) + 1)
+    start: np.ndarray = np.maximum(end - window, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total[end] - total[start]) / (count[end] - count[start])
 
 
-def make_power_graph(output_file: str, data: typ.List, window: int) -> None:
+def make_power_dataframe(data: typ.List, window: int) -> pd.DataFrame:
+    """グラフ用のデータを作成する.
+
+    Args:
+        data: power_logのデータ
+        window: 移動平均のサンプル数
+
+    Returns:
+        グラフ用のデータ
+    """
+    if len(data) == 0:
+        return pd.DataFrame({col: [] for col in COLUMNS})
+    log: pd.DataFrame = pd.DataFrame(data, columns=list(data[0].keys()))
+    df: pd.DataFrame = pd.DataFrame({"time": log["created_at"], "電力量": calc_電力量(log)})
+    # 電流は0.1A単位の整数なので、移動平均も整数のまま計算してから換算する
+    raw_data: typ.List[typ.Tuple[str, str, float]] = [
+        ("電力", "瞬時電力", 1.0),
+        ("電流R", "瞬時電流_r", 10.0),
+        ("電流T", "瞬時電流_t", 10.0),
+    ]
+    for col, log_col, scale in raw_data:
+        values: np.ndarray = log[log_col].to_numpy(dtype=np.float64)
+        df[col] = values / scale
+        df[f"MA{col}"] = moving_average(values, window) / scale
+    return df[list(COLUMNS)]
+
+
+def make_power_graph(
+    output_file: str,
+    data: typ.List,
+    window: int,
+    max_points: typ.Optional[int] = None,
+    data_url: typ.Optional[str] = None,
+    gzip: bool = False,
+) -> None:
     """グラフ作成.
 
     Args:
         output_file: 出力ファイル名
         data: データ
         window: 移動平均のサンプル数
+        max_points: 系列ごとの点数の上限(Noneのときは間引かない)
+        data_url: データファイルのURL(指定したときは、dataを使わずにページからデータファイルを読み込む)
+        gzip: 圧縮済みのファイル(.gz)も作るか
     """
-    cols: typ.Tuple = ("time", "電力量", "電力", "電流R", "電流T", "MA電力", "MA電流R", "MA電流T")
-    datadict: typ.Dict = {}
-    for col in cols:
-        datadict[col] = []
-    has_data: bool = len(data) > 0
-    for row in data:
-        datadict["time"].append(row["created_at"])
-        datadict["電力量"].append(calc_電力量(row))
-        datadict["電力"].append(row["瞬時電力"])
-        datadict["電流R"].append(row["瞬時電流_r"] / 10.0)
-        datadict["電流T"].append(row["瞬時電流_t"] / 10.0)
-        datadict["MA電力"].append(statistics.mean(datadict["電力"][-window:]))
-        datadict["MA電流T"].append(statistics.mean(datadict["電流T"][-window:]))
-        datadict["MA電流R"].append(statistics.mean(datadict["電流R"][-window:]))
-
-    source: bp.ColumnDataSource = bp.ColumnDataSource(datadict)
+    # Bokeh は読み込みに時間がかかるので、ページを作るときだけ import する
+    import bokeh.events
+    import bokeh.models as bm
+    import bokeh.plotting as bp
+
+    df: pd.DataFrame = downsample.downsample(make_power_dataframe(data, window), COLUMNS[1:], max_points)
+    has_data: bool = len(df) > 0
+
+    source: bp.ColumnDataSource = bp.ColumnDataSource(graph_output.to_column_data(df, precise=["電力量"]))
     tooltips: typ.List[typ.Tuple[str, str]] = [
         ("time", "@time{%F %T}"),
         ("積算電力量", "@{電力量}{0,0.0}"),
@@ -76,28 +140,26 @@ def make_power_graph(output_file: str, data: typ.List, window: int) -> None:
     ]
     hover_tool: bm.HoverTool = bm.HoverTool(tooltips=tooltips, formatters={"@time": "datetime"})
 
-    bp.output_file(output_file, title="Power consumption")
-    fig: bp.figure = bp.figure(
-        title="Power consumption",
-        x_axis_type="datetime",
+    fig: bp.figure = graph_output.make_time_figure(
+        "Power consumption",
+        graph_output.TIME_OF_DAY_FORMATS,
         x_axis_label="時刻",
         y_axis_label="電力量[kWh]",
         sizing_mode="stretch_both",
     )
     fig.add_tools(hover_tool)
-    fmt: typ.List[str] = ["%H:%M"]
-    fig.xaxis.formatter = bm.DatetimeTickFormatter(hours=fmt, hourmin=fmt, minutes=fmt)
     if has_data:
-        電力量_min: float = min(datadict["電力量"])
-        電力量_max: float = max(datadict["電力量"])
+        電力量_min: float = df["電力量"].min()
+        電力量_max: float = df["電力量"].max()
         電力量_5p: float = (電力量_max - 電力量_min) * 0.05
         fig.y_range = bm.Range1d(電力量_min - 電力量_5p, 電力量_max + 電力量_5p)
-    fig.extra_y_ranges["W"] = bm.Range1d(0, max(datadict["電力"]) * 1.05 if has_data else 0)
+    fig.extra_y_ranges["W"] = bm.Range1d(0, df["電力"].max() * 1.05 if has_data else 0)
     fig.add_layout(bm.LinearAxis(y_range_name="W", axis_label="電力[W]"), "left")
-    fig.extra_y_ranges["A"] = bm.Range1d(0, max(*datadict["電流R"], *datadict["電流T"]) * 1.05 if has_data else 0)
+    fig.extra_y_ranges["A"] = bm.Range1d(0, max(df["電流R"].max(), df["電流T"].max()) * 1.05 if has_data else 0)
     fig.add_layout(bm.LinearAxis(y_range_name="A", axis_label="電流[A]"), "right")
 
-    fig.line("time", "電力量", legend_label="積算電力量", line_color="red", source=source)
+    renderers: typ.Dict[str, typ.List[bm.GlyphRenderer]] = {"default": [], "W": [], "A": []}
+    renderers["default"].append(fig.line("time", "電力量", legend_label="積算電力量", line_color="red", source=source))
 
     raw_data: typ.List = [
         ("電力", "W", "瞬時電力", "orange"),
@@ -105,7 +167,7 @@ def make_power_graph(output_file: str, data: typ.List, window: int) -> None:
         ("電流T", "A", "瞬時電流(T相)", "green"),
     ]
     for col, range_name, legend_label, color in raw_data:
-        fig.line(
+        raw_renderer: bm.GlyphRenderer = fig.line(
             "time",
             col,
             y_range_name=range_name,
@@ -113,7 +175,9 @@ def make_power_graph(output_file: str, data: typ.List, window: int) -> None:
             line_color=color,
             line_alpha=0.8,
             source=source,
-        ).visible = False
+        )
+        raw_renderer.visible = False
+        renderers[range_name].append(raw_renderer)
 
     ma_data: typ.List = [
         ("MA電力", "W", "瞬時電力(移動平均)", "orange"),
@@ -121,22 +185,37 @@ def make_power_graph(output_file: str, data: typ.List, window: int) -> None:
         ("MA電流T", "A", "瞬時電流(T相)(移動平均)", "green"),
     ]
     for col, range_name, legend_label, color in ma_data:
-        fig.line(
-            "time",
-            col,
-            y_range_name=range_name,
-            legend_label=legend_label,
-            line_color=color,
-            line_width=2,
-            line_alpha=0.8,
-            line_dash="dotted",
-            source=source,
+        renderers[range_name].append(
+            fig.line(
+                "time",
+                col,
+                y_range_name=range_name,
+                legend_label=legend_label,
+                line_color=color,
+                line_width=2,
+                line_alpha=0.8,
+                line_dash="dotted",
+                source=source,
+            )
+        )
+
+    if data_url is not None:
+        # データはページを開いたときに読み込むので、軸の範囲はデータに合わせて自動で決める
+        fig.y_range = bm.DataRange1d(renderers=renderers["default"])
+        fig.extra_y_ranges["W"] = bm.DataRange1d(start=0, renderers=renderers["W"])
+        fig.extra_y_ranges["A"] = bm.DataRange1d(start=0, renderers=renderers["A"])
+        fig.js_on_event(
+            bokeh.events.DocumentReady,
+            bm.CustomJS(
+                args={"source": source, "url": data_url, "size": window},
+                code=incremental.LOADER_JS % MOVING_AVERAGE_JS,
+            ),
         )
 
     fig.legend.click_policy = "hide"
     fig.legend.location = "top_left"
 
-    bp.save(fig)
+    graph_output.save_page(output_file, "Power consumption", fig, gzip)
 
 
 def main() -> None:
@@ -147,6 +226,17 @@ def main() -> None:
     parser.add_argument("-e", "--end", help="end time")
     parser.add_argument("-d", "--days", type=int, help="before n days")
     parser.add_argument("-w", "--window", type=int, help="window size of moving average", default=30)
+    parser.add_argument(
+        "-m",
+        "--max-points",
+        type=downsample.max_points_arg,
+        help="max points per series (LTTB downsampling, >= 3; the page keeps the union of all series' points)",
+    )
+    parser.add_argument("-b", "--batch", action="store_true", help="generate daily graphs from start to end")
+    parser.add_argument("-j", "--jobs", type=int, help="number of parallel jobs in batch mode")
+    parser.add_argument("-f", "--force", action="store_true", help="regenerate up-to-date graphs in batch mode")
+    parser.add_argument("-z", "--gzip", action="store_true", help="also write gzip-compressed output")
+    parser.add_argument("-i", "--incremental", action="store_true", help="append new data to the data file of the page")
 
     args: argparse.Namespace = parser.parse_args()
 
@@ -161,6 +251,26 @@ def main() -> None:
     if args.days:
         end_time = datetime.datetime.now()
         start_time = end_time - datetime.timedelta(args.days)
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+
+    store: db_store.DBStore = db_store.DBStore(db_url)
+
+    if args.batch:
+        output_dir: str = args.output or "."
+        if not os.path.isdir(output_dir):
+            parser.error("OUTPUT must be a directory in batch mode")
+        start_time, end_time = graph_batch.day_range(start_time, end_time)
+        tasks: typ.List[typ.Tuple[str, typ.Tuple]] = []
+        for day, rows in sorted(graph_batch.split_by_day(store.select_power_log(start_time, end_time)).items()):
+            day_file: str = os.path.join(output_dir, f"power_{day}.html")
+            if args.force or not graph_batch.is_up_to_date(day_file, rows[-1]["created_at"]):
+                tasks.append((day_file, (day_file, rows, args.window, args.max_points, None, args.gzip)))
+        graph_batch.run(tasks, make_power_graph, args.jobs)
+        return
+
     output_file: str = f"power_{start_time.date()}.html"
     if args.output:
         if os.path.isdir(args.output):
@@ -168,14 +278,22 @@ def main() -> None:
         else:
             output_file = args.output
 
-    inifile: configparser.ConfigParser = configparser.ConfigParser()
-    inifile.read("power_consumption.ini", "utf-8")
-    db_url: str = inifile.get("routeB", "db_url")
+    if args.incremental:
+        data_file: str = incremental.data_file_path(output_file)
+        watermark: typ.Optional[datetime.datetime] = incremental.read_watermark(data_file)
+        if watermark is not None:
+            start_time = max(start_time, watermark + datetime.timedelta(microseconds=1))
+        new_rows: typ.List = store.select_power_log(start_time, end_time)
+        if len(new_rows) > 0:
+            incremental.append_rows(data_file, make_power_dataframe(new_rows, args.window)[DATA_FILE_COLUMNS])
+        if not os.path.exists(output_file):
+            make_power_graph(output_file, [], args.window, data_url=os.path.basename(data_file), gzip=args.gzip)
+        print(output_file)
+        return
 
-    store: db_store.DBStore = db_store.DBStore(db_url)
     data: typ.List = store.select_power_log(start_time, end_time)
 
-    make_power_graph(output_file, data, args.window)
+    make_power_graph(output_file, data, args.window, args.max_points, gzip=args.gzip)
     print(output_file)
 
 
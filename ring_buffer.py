@@ -0,0 +1,55 @@
+"""一定間隔の値のリングバッファ.
+
+時刻を interval ごとの枠(スロット)に分けて、最新の size 個の枠の値だけを持つ。
+配列の大きさは決まっていて、値を追加しても履歴を走査し直すことはない。
+値が届かなかった枠は None になる(古い値が残っていても、枠の番号が違えば使わない)。
+"""
+
+import array
+import math
+import typing as typ
+
+
+class RingBuffer:
+    """一定間隔の値を、決まった数だけ持つリングバッファ."""
+
+    def __init__(self, size: int, interval: float) -> None:
+        """初期化.
+
+        Args:
+            size: 持つ値の数
+            interval: 値の間隔[秒]
+        """
+        self.size: int = size
+        self.interval: float = interval
+        self.values: array.array = array.array("d", [math.nan] * size)
+        self.slots: array.array = array.array("q", [-1] * size)  # それぞれの値の枠の番号
+
+    def add(self, timestamp: float, value: typ.Optional[float]) -> None:
+        """値を追加する(同じ枠の値は上書きする).
+
+        Args:
+            timestamp: 時刻(time.time)
+            value: 値(Noneのときは追加しない)
+        """
+        if value is None:
+            return
+        slot: int = int(timestamp // self.interval)
+        self.values[slot % self.size] = value
+        self.slots[slot % self.size] = slot
+
+    def latest(self, timestamp: float) -> typ.List[typ.Optional[float]]:
+        """時刻までの size 個の枠の値を返す.
+
+        Args:
+            timestamp: 最後の枠の時刻(time.time)
+
+        Returns:
+            古い順の値(値がない枠はNone)
+        """
+        last: int = int(timestamp // self.interval)
+        result: typ.List[typ.Optional[float]] = []
+        for slot in range(last - self.size + 1, last + 1):
+            i: int = slot % self.size
+            result.append(self.values[i] if self.slots[i] == slot else None)
+        return result
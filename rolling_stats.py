@@ -0,0 +1,118 @@
+"""時間窓の移動統計.
+
+値を追加するたびに、窓から外れた値を取り除きながら、合計・二乗和と、最小値・最大値の単調キューを更新する。
+1回の更新はならし O(1) で、履歴を走査し直すことはない。
+"""
+
+import collections
+import datetime
+import math
+import typing as typ
+
+# 最新の計測値と一緒に表示する移動平均の期間
+MOVING_AVERAGE_PERIOD: datetime.timedelta = datetime.timedelta(minutes=5)
+
+
+class RollingStats:
+    """時間窓の移動統計(平均、最小、最大、標準偏差)."""
+
+    def __init__(self, window: datetime.timedelta) -> None:
+        """初期化.
+
+        Args:
+            window: 窓の幅(最新の値の時刻から window より前の値は含めない)
+        """
+        self.window: datetime.timedelta = window
+        self.values: typ.Deque[typ.Tuple[datetime.datetime, float]] = collections.deque()
+        # 最小値・最大値の候補(時刻順で、値はそれぞれ単調増加・単調減少)
+        self.min_queue: typ.Deque[typ.Tuple[datetime.datetime, float]] = collections.deque()
+        self.max_queue: typ.Deque[typ.Tuple[datetime.datetime, float]] = collections.deque()
+        # 桁落ちを抑えるため、最初の値からの差で合計と二乗和を持つ
+        self.offset: typ.Optional[float] = None
+        self.total: float = 0.0
+        self.total_sq: float = 0.0
+
+    def add(self, timestamp: datetime.datetime, value: typ.Optional[float]) -> None:
+        """値を追加する.
+
+        Args:
+            timestamp: 時刻(前回以降であること)
+            value: 値(None のときは追加せず、古い値を取り除くだけ)
+        """
+        if value is not None:
+            if self.offset is None:
+                self.offset = value
+            diff: float = value - self.offset
+            self.values.append((timestamp, value))
+            self.total += diff
+            self.total_sq += diff * diff
+            while len(self.min_queue) > 0 and self.min_queue[-1][1] >= value:
+                self.min_queue.pop()
+            self.min_queue.append((timestamp, value))
+            while len(self.max_queue) > 0 and self.max_queue[-1][1] <= value:
+                self.max_queue.pop()
+            self.max_queue.append((timestamp, value))
+        self.expire(timestamp)
+
+    def expire(self, now: datetime.datetime) -> None:
+        """窓から外れた値を取り除く.
+
+        Args:
+            now: 現在時刻
+        """
+        start: datetime.datetime = now - self.window
+        while len(self.values) > 0 and self.values[0][0] <= start:
+            _, value = self.values.popleft()
+            diff: float = value - typ.cast(float, self.offset)
+            self.total -= diff
+            self.total_sq -= diff * diff
+        while len(self.min_queue) > 0 and self.min_queue[0][0] <= start:
+            self.min_queue.popleft()
+        while len(self.max_queue) > 0 and self.max_queue[0][0] <= start:
+            self.max_queue.popleft()
+        if len(self.values) == 0:
+            # 誤差が溜まらないように、空になったらやり直す
+            self.offset = None
+            self.total = 0.0
+            self.total_sq = 0.0
+
+    @property
+    def count(self) -> int:
+        """窓の中の値の数."""
+        return len(self.values)
+
+    @property
+    def mean(self) -> typ.Optional[float]:
+        """平均(値がないときはNone)."""
+        if len(self.values) == 0:
+            return None
+        return typ.cast(float, self.offset) + self.total / len(self.values)
+
+    @property
+    def min(self) -> typ.Optional[float]:
+        """最小値(値がないときはNone)."""
+        return self.min_queue[0][1] if len(self.min_queue) > 0 else None
+
+    @property
+    def max(self) -> typ.Optional[float]:
+        """最大値(値がないときはNone)."""
+        return self.max_queue[0][1] if len(self.max_queue) > 0 else None
+
+    @property
+    def stddev(self) -> typ.Optional[float]:
+        """標準偏差(母標準偏差。値がないときはNone)."""
+        count: int = len(self.values)
+        if count == 0:
+            return None
+        if count == 1:
+            return 0.0
+        mean_diff: float = self.total / count
+        return math.sqrt(max(self.total_sq / count - mean_diff * mean_diff, 0.0))
+
+    def to_dict(self) -> typ.Dict[str, typ.Optional[float]]:
+        """統計値を dict にする.
+
+        Returns:
+            count, mean, min, max, stddev
+        """
+        return {"count": self.count, "mean": self.mean, "min": self.min, "max": self.max, "stddev": self.stddev}
@@ -0,0 +1,25 @@
+"""ロードアベレージ(センサーのプラグインの例)."""
+
+import os
+import typing as typ
+import sensor_plugin
+
+
+class LoadAverage(sensor_plugin.SensorPlugin):
+    """ロードアベレージ."""
+
+    name: str = "loadavg"
+    fields: typ.List[sensor_plugin.Field] = [
+        sensor_plugin.Field("load1", zabbix_key="loadavg1"),
+        sensor_plugin.Field("load5", zabbix_key="loadavg5"),
+        sensor_plugin.Field("load15", zabbix_key="loadavg15"),
+    ]
+
+    def read(self) -> typ.Optional[typ.Dict[str, typ.Any]]:
+        """ロードアベレージを読み込む.
+
+        Returns:
+            1分、5分、15分のロードアベレージ
+        """
+        load1, load5, load15 = os.getloadavg()
+        return {"load1": load1, "load5": load5, "load15": load15}
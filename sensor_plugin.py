@@ -0,0 +1,157 @@
+"""センサーのプラグイン.
+
+センサーを追加するときは、SensorPlugin のサブクラスで計測値の列(Field)と読み込み間隔を宣言して、read を書く。
+テーブル(<name>_log)は起動したときに作り、読み込みはセンサーごとの間隔で別スレッドから行う。
+読み込んだ値は1分ごとにまとめて登録し、HTTP サーバ・アラート・zabbix にも渡す。
+
+プラグインは、power_consumption.ini の [sensors] の enabled に名前を書いたものだけを読み込む(import する)。
+名前は entry point(グループは power_consumption.sensors)から探し、なければ BUILTIN_PLUGINS から探す。
+プラグインの設定は [sensor.<name>] に書く(period で読み込み間隔を変えられる)。
+"""
+
+import abc
+import configparser
+import dataclasses
+import datetime
+import functools
+import threading
+import typing as typ
+import periodic
+
+ENTRY_POINT_GROUP: str = "power_consumption.sensors"
+
+# 同梱のプラグイン(名前: "モジュール:クラス")
+BUILTIN_PLUGINS: typ.Dict[str, str] = {
+    "loadavg": "sensor_loadavg:LoadAverage",
+}
+
+
+@dataclasses.dataclass
+class Field:
+    """計測値の列."""
+
+    name: str  # 列名
+    sql_type: str = "real"  # 列の型(db_store.LOG_COLUMN_TYPES のどれか)
+    zabbix_key: typ.Optional[str] = None  # zabbix のキー(プレフィックスは除く。Noneのときは送らない)
+
+
+class SensorPlugin(abc.ABC):
+    """センサーのプラグインの基底クラス."""
+
+    name: str = ""  # 名前(テーブル名は <name>_log)
+    fields: typ.List[Field] = []  # 計測値の列
+    period: float = 60.0  # 読み込み間隔のデフォルト[秒]
+
+    def __init__(self, inifile: configparser.ConfigParser, section: str) -> None:
+        """初期化.
+
+        Args:
+            inifile: ini ファイル
+            section: このプラグインの設定のセクション名
+        """
+        self.period = inifile.getfloat(section, "period", fallback=type(self).period)
+
+    @property
+    def table(self) -> str:
+        """テーブル名."""
+        return f"{self.name}_log"
+
+    @abc.abstractmethod
+    def read(self) -> typ.Optional[typ.Dict[str, typ.Any]]:
+        """センサーを読み込む.
+
+        Returns:
+            列名と値(読めなかったときはNone)
+        """
+
+
+def find_plugin(name: str) -> typ.Type[SensorPlugin]:
+    """名前からプラグインのクラスを探す(そのプラグインのモジュールだけを import する).
+
+    Args:
+        name: プラグインの名前
+
+    Returns:
+        プラグインのクラス
+    """
+    import importlib  # プラグインを使うときだけ import する
+    import importlib.metadata
+
+    entry_points: typ.Any = importlib.metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        group: typ.Iterable = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:  # Python 3.9
+        group = entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in group:
+        if entry_point.name == name:
+            return entry_point.load()
+    if name not in BUILTIN_PLUGINS:
+        raise ValueError(f"unknown sensor plugin: {name}")
+    module_name, class_name = BUILTIN_PLUGINS[name].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def load_plugins(inifile: configparser.ConfigParser) -> typ.List[SensorPlugin]:
+    """有効にしたプラグインを読み込む.
+
+    Args:
+        inifile: ini ファイル
+
+    Returns:
+        プラグインのリスト
+    """
+    plugins: typ.List[SensorPlugin] = []
+    for name in inifile.get("sensors", "enabled", fallback="").split(","):
+        name = name.strip()
+        if name != "":
+            plugins.append(find_plugin(name)(inifile, f"sensor.{name}"))
+    return plugins
+
+
+class SensorScheduler(periodic.PeriodicWorker):
+    """プラグインごとの間隔で、別スレッドでセンサーを読み込む."""
+
+    def __init__(self, plugins: typ.List[SensorPlugin]) -> None:
+        """初期化.
+
+        Args:
+            plugins: プラグインのリスト
+        """
+        super().__init__()
+        self.plugins: typ.List[SensorPlugin] = plugins
+        self.lock: threading.Lock = threading.Lock()
+        self.pending: typ.Dict[str, typ.List[typ.Dict[str, typ.Any]]] = {}
+
+    def tasks(self) -> typ.List[typ.Tuple[float, typ.Callable[[], None]]]:
+        """行う処理.
+
+        Returns:
+            プラグインごとに、その間隔で読み込む
+        """
+        return [(plugin.period, functools.partial(self.poll, plugin)) for plugin in self.plugins]
+
+    def poll(self, plugin: SensorPlugin) -> None:
+        """プラグインのセンサーを読み込んで、読めたら値を溜める.
+
+        Args:
+            plugin: プラグイン
+        """
+        try:
+            values: typ.Optional[typ.Dict[str, typ.Any]] = plugin.read()
+        except Exception as e:
+            print(f"{plugin.name} エラー: {e}", flush=True)
+            values = None
+        if values is not None:
+            with self.lock:
+                self.pending.setdefault(plugin.name, []).append({**values, "created_at": datetime.datetime.now()})
+
+    def take(self) -> typ.Dict[str, typ.List[typ.Dict[str, typ.Any]]]:
+        """読み込んだ値を取り出す.
+
+        Returns:
+            プラグインの名前と、前回取り出してから読み込んだ値(created_at 付き)のリスト
+        """
+        with self.lock:
+            pending: typ.Dict[str, typ.List[typ.Dict[str, typ.Any]]] = self.pending
+            self.pending = {}
+        return pending
@@ -4,155 +4,230 @@ import configparser
 import datetime
 import os
 import typing as typ
-import bokeh.models as bm
-import bokeh.plotting as bp
+import numpy as np
 import pandas as pd
 import db_store
+import downsample
+import graph_batch
+import graph_output
+import incremental
+
+# グラフに使う系列(db_store.BUCKET_SERIES のキー)
+SERIES: typ.List[str] = ["temp", "co2", "temp2", "temp3", "pressure", "humidity", "illuminance"]
+
+# データファイルを読み込んだあとで、照度から点灯していた時間帯の帯を作る JavaScript
+LIGHT_JS: str = """
+    const left = []
+    const right = []
+    const time = data["time"]
+    const illuminance = data["illuminance"]
+    let start = null
+    for (let i = 0; i < time.length; i++) {
+        if (illuminance[i] > 60) {
+            if (start === null) {
+                start = time[i]
+            }
+        } else if (start !== null) {
+            left.push(start)
+            right.push(time[i - 1])
+            start = null
+        }
+    }
+    if (start !== null) {
+        left.push(start)
+        right.push(time[time.length - 1])
+    }
+    let top = 0
+    for (const name of ["temp", "temp2", "temp3", "humidity", "illuminance"]) {
+        for (const value of data[name] || []) {
+            if (value > top) {
+                top = value
+            }
+        }
+    }
+    light.data = {left: left, right: right, top: left.map(() => top + 10), bottom: left.map(() => 0)}
+"""
+
+
+def make_temp_dataframe(rows: typ.List, drop_empty: bool = True) -> pd.DataFrame:
+    """グラフ用のデータを作成する.
+
+    Args:
+        rows: select_bucketed_log で取得したデータ
+        drop_empty: 1件もデータがない系列の列を除くか
+
+    Returns:
+        グラフ用のデータ
+    """
+    df: pd.DataFrame = pd.DataFrame(rows, columns=["time", *SERIES])
+    if not drop_empty:
+        return df
+    if len(df) == 0:
+        return df[["time"]]
+    return df.dropna(axis=1, how="all")
+
+
+def light_intervals(df: pd.DataFrame, threshold: float = 60) -> typ.Tuple[np.ndarray, np.ndarray]:
+    """照度が閾値を超えていた時間帯を求める.
+
+    Args:
+        df: グラフ用のデータ
+        threshold: 照明が点いていると判断する照度
+
+    Returns:
+        時間帯の開始時刻の配列, 終了時刻(閾値を超えていた最後の時刻)の配列
+    """
+    on: np.ndarray = (df["illuminance"] > threshold).to_numpy()
+    prev_on: np.ndarray = np.concatenate(([False], on[:-1]))
+    next_on: np.ndarray = np.concatenate((on[1:], [False]))
+    time: np.ndarray = df["time"].to_numpy()
+    return time[on & ~prev_on], time[on & ~next_on]
 
 
 def make_temp_graph(
-    output_file: str, temp_data: typ.List, co2_data: typ.List, bme280_data: typ.List, tsl2572_data: typ.List
+    output_file: str,
+    df: pd.DataFrame,
+    max_points: typ.Optional[int] = None,
+    data_url: typ.Optional[str] = None,
+    gzip: bool = False,
 ) -> None:
     """グラフ作成.
 
     Args:
         output_file: 出力ファイル名
-        temp_data: 温度データ
-        co2_data: CO2データ
-        bme280_data: BME280のデータ
-        tsl2572_data: TSL2572のデータ
+        df: グラフ用のデータ(データファイルを読み込むときは、列名だけを使う)
+        max_points: 系列ごとの点数の上限(Noneのときは間引かない)
+        data_url: データファイルのURL(指定したときは、dfのデータを使わずにページからデータファイルを読み込む)
+        gzip: 圧縮済みのファイル(.gz)も作るか
     """
+    # Bokeh は読み込みに時間がかかるので、ページを作るときだけ import する
+    import bokeh.events
+    import bokeh.models as bm
+    import bokeh.plotting as bp
+
     tooltips: typ.List[typ.Tuple[str, str]] = [
         ("time", "@time{%F %T}"),
     ]
-    df: pd.DataFrame
     deg_max: int = 0
-    num_data: int = 0
     y_axis_label: str = "温度[℃]"
-    if len(temp_data) > 0:
-        num_data += 1
-    if len(co2_data) > 0:
-        num_data += 1
-    if len(bme280_data) > 0:
-        num_data += 1
-    if len(temp_data) > 0:
-        df1: pd.DataFrame = pd.DataFrame(temp_data, columns=list(temp_data[0].keys()))
-        df1 = df1.rename(columns={"created_at": "time"})
-        if num_data > 1:
-            df1["time"] = df1["time"].apply(lambda x: x.replace(second=0, microsecond=0))
-        df1["temp"] /= 1000
-        df1 = df1[["time", "temp"]].drop_duplicates(subset="time")
-        df = df1
+    has_temp: bool = "temp" in df.columns
+    has_co2: bool = "co2" in df.columns
+    has_bme280: bool = "temp3" in df.columns
+    has_tsl2572: bool = "illuminance" in df.columns
+    if data_url is not None:
+        df = pd.DataFrame({col: [] for col in df.columns})
+    has_data: bool = len(df) > 0
+    if has_temp:
         tooltips.append(("CPU温度", "@temp{0.0}"))
-        deg_max = int(df["temp"].max()) + 10
-    if len(co2_data) > 0:
-        df2: pd.DataFrame = pd.DataFrame(co2_data, columns=list(co2_data[0].keys()))
-        df2 = df2.rename(columns={"temp": "temp2", "created_at": "time"})
-        if num_data > 1:
-            df2["time"] = df2["time"].apply(lambda x: x.replace(second=0, microsecond=0))
-        df2 = df2[["time", "co2", "temp2"]].drop_duplicates(subset="time")
-        if len(temp_data) > 0:
-            df = pd.merge(df1, df2, on="time", how="outer").sort_values("time")
-        else:
-            df = df2
-        if len(bme280_data) == 0:
+        if has_data:
+            deg_max = int(df["temp"].max()) + 10
+    if has_co2:
+        if not has_bme280:
             tooltips.append(("気温", "@temp2"))
         tooltips.append(("CO₂", "@co2"))
-        deg_max = max(deg_max, int(df["temp2"].max()) + 10)
-    if len(bme280_data) > 0:
-        df3: pd.DataFrame = pd.DataFrame(bme280_data, columns=list(bme280_data[0].keys()))
-        df3 = df3.rename(columns={"temp": "temp3", "created_at": "time"})
-        if num_data > 1:
-            df3["time"] = df3["time"].apply(lambda x: x.replace(second=0, microsecond=0))
-        df3 = df3[["time", "temp3", "pressure", "humidity"]].drop_duplicates(subset="time")
-        if num_data > 1:
-            df = pd.merge(df, df3, on="time", how="outer").sort_values("time")
-        else:
-            df = df3
+        if has_data:
+            deg_max = max(deg_max, int(df["temp2"].max()) + 10)
+    if has_bme280:
         tooltips.append(("気温", "@temp3{0.0}"))
         tooltips.append(("湿度", "@humidity{0.0}"))
         tooltips.append(("気圧", "@pressure{0,0.0}"))
-        deg_max = max(deg_max, int(df["temp3"].max()) + 10, int(df["humidity"].max()) + 10)
+        if has_data:
+            deg_max = max(deg_max, int(df["temp3"].max()) + 10, int(df["humidity"].max()) + 10)
         y_axis_label += "/湿度[%]"
-    if len(tsl2572_data) > 0:
-        df4: pd.DataFrame = pd.DataFrame(tsl2572_data, columns=list(tsl2572_data[0].keys()))
-        df4 = df4.rename(columns={"created_at": "time"})
-        if num_data > 1:
-            df4["time"] = df4["time"].apply(lambda x: x.replace(second=0, microsecond=0))
-        df4 = df4[["time", "illuminance"]].drop_duplicates(subset="time")
-        if num_data > 1:
-            df = pd.merge(df, df4, on="time", how="outer").sort_values("time")
-        else:
-            df = df4
+    if has_tsl2572:
         tooltips.append(("照度", "@illuminance{0.0}"))
-        deg_max = max(deg_max, int(df["illuminance"].max()) + 10)
+        if has_data:
+            deg_max = max(deg_max, int(df["illuminance"].max()) + 10)
         y_axis_label += "/照度[lx]"
 
-    source: bp.ColumnDataSource = bp.ColumnDataSource(df)
+    # 照度の帯は間引く前のデータから作るので、dfはそのまま残しておく
+    source: bp.ColumnDataSource = bp.ColumnDataSource(
+        graph_output.to_column_data(downsample.downsample(df, [col for col in df.columns if col != "time"], max_points))
+    )
     hover_tool: bm.HoverTool = bm.HoverTool(tooltips=tooltips, formatters={"@time": "datetime"})
     hover_renderers: typ.List[bm.GlyphRenderer] = []
 
-    bp.output_file(output_file, title="Temperature")
-    fig: bp.figure = bp.figure(
-        title="Temperature",
-        x_axis_type="datetime",
+    fig: bp.figure = graph_output.make_time_figure(
+        "Temperature",
+        graph_output.TIME_OF_DAY_FORMATS,
         x_axis_label="時刻",
         y_axis_label=y_axis_label,
         sizing_mode="stretch_both",
     )
     fig.add_tools(hover_tool)
-    fmt: typ.List[str] = ["%H:%M"]
-    fig.xaxis.formatter = bm.DatetimeTickFormatter(hours=fmt, hourmin=fmt, minutes=fmt)
     fig.y_range = bm.Range1d(0, deg_max)
-    if len(temp_data) > 0:
+    renderers: typ.Dict[str, typ.List[bm.GlyphRenderer]] = {"default": [], "ppm": [], "pressure": []}
+    if has_temp:
         hover_renderers.append(fig.line("time", "temp", legend_label="CPU温度", line_color="red", source=source))
-    if len(co2_data) > 0:
-        if len(bme280_data) == 0:
+    if has_co2:
+        if not has_bme280:
             hover_renderers.append(fig.line("time", "temp2", legend_label="気温", line_color="darkorange", source=source))
-        fig.extra_y_ranges["ppm"] = bm.Range1d(0, max(2000, df["co2"].max() * 1.05))
+        fig.extra_y_ranges["ppm"] = bm.Range1d(0, max(2000, df["co2"].max() * 1.05) if has_data else 2000)
         fig.add_layout(bm.LinearAxis(y_range_name="ppm", axis_label="濃度[ppm]"), "right")
         hover_renderers.append(
             fig.line("time", "co2", legend_label="CO₂", line_color="green", y_range_name="ppm", source=source)
         )
-    if len(bme280_data) > 0:
+    if has_bme280:
         hover_renderers.append(fig.line("time", "temp3", legend_label="気温", line_color="darkorange", source=source))
         hover_renderers.append(fig.line("time", "humidity", legend_label="湿度", line_color="blue", source=source))
-        fig.extra_y_ranges["pressure"] = bm.Range1d(min(990, df["pressure"].min()), max(1020, df["pressure"].max()))
+        fig.extra_y_ranges["pressure"] = (
+            bm.Range1d(min(990, df["pressure"].min()), max(1020, df["pressure"].max()))
+            if has_data
+            else bm.Range1d(990, 1020)
+        )
         fig.add_layout(bm.LinearAxis(y_range_name="pressure", axis_label="気圧[hPa]"), "right")
         hover_renderers.append(
             fig.line(
                 "time", "pressure", legend_label="気圧", line_color="deeppink", y_range_name="pressure", source=source
             )
         )
-    if len(tsl2572_data) > 0:
+    if has_tsl2572:
         hover_renderers.append(
             fig.line("time", "illuminance", legend_label="照度", line_color="gold", source=source, visible=False)
         )
-        start_time: typ.Optional[datetime.datetime] = None
-        prev_time: typ.Optional[datetime.datetime] = None
-        left: typ.List = []
-        right: typ.List = []
-        for ctime, illuminance in zip(df["time"], df["illuminance"]):
-            if illuminance > 60:
-                if start_time is None:
-                    start_time = ctime
-            else:
-                if start_time is not None and prev_time is not None:
-                    left.append(start_time)
-                    right.append(prev_time)
-                    start_time = None
-            prev_time = ctime
-        if start_time is not None:
-            left.append(start_time)
-            right.append(ctime)
-        fig.quad(top=deg_max, bottom=0, left=left, right=right, color="gold", alpha=0.1)
+    if has_tsl2572 and data_url is None:
+        left: np.ndarray
+        right: np.ndarray
+        left, right = light_intervals(df)
+        fig.quad(
+            top=deg_max,
+            bottom=0,
+            left=graph_output.to_epoch_ms(left),
+            right=graph_output.to_epoch_ms(right),
+            color="gold",
+            alpha=0.1,
+        )
 
     hover_tool.renderers = hover_renderers
 
+    if data_url is not None:
+        # データはページを開いたときに読み込むので、軸の範囲はデータに合わせて自動で決める
+        postprocess: str = ""
+        for renderer in hover_renderers:
+            renderers[renderer.y_range_name].append(renderer)
+        fig.y_range = bm.DataRange1d(start=0, renderers=renderers["default"])
+        if has_co2:
+            fig.extra_y_ranges["ppm"] = bm.DataRange1d(start=0, renderers=renderers["ppm"])
+        if has_bme280:
+            fig.extra_y_ranges["pressure"] = bm.DataRange1d(renderers=renderers["pressure"])
+        light_source: bp.ColumnDataSource = bp.ColumnDataSource({"left": [], "right": [], "top": [], "bottom": []})
+        if has_tsl2572:
+            fig.quad(
+                top="top", bottom="bottom", left="left", right="right", color="gold", alpha=0.1, source=light_source
+            )
+            postprocess = LIGHT_JS
+        fig.js_on_event(
+            bokeh.events.DocumentReady,
+            bm.CustomJS(
+                args={"source": source, "url": data_url, "light": light_source},
+                code=incremental.LOADER_JS % postprocess,
+            ),
+        )
+
     fig.legend.click_policy = "hide"
     fig.legend.location = "top_left"
 
-    bp.save(fig)
+    graph_output.save_page(output_file, "Temperature", fig, gzip)
 
 
 def main() -> None:
@@ -162,6 +237,18 @@ def main() -> None:
     parser.add_argument("-s", "--start", help="start time")
     parser.add_argument("-e", "--end", help="end time")
     parser.add_argument("-d", "--days", type=int, help="before n days")
+    parser.add_argument(
+        "-m",
+        "--max-points",
+        type=downsample.max_points_arg,
+        help="max points per series (LTTB downsampling, >= 3; the page keeps the union of all series' points)",
+    )
+    parser.add_argument("-b", "--batch", action="store_true", help="generate daily graphs from start to end")
+    parser.add_argument("-j", "--jobs", type=int, help="number of parallel jobs in batch mode")
+    parser.add_argument("-f", "--force", action="store_true", help="regenerate up-to-date graphs in batch mode")
+    parser.add_argument("-z", "--gzip", action="store_true", help="also write gzip-compressed output")
+    parser.add_argument("-i", "--incremental", action="store_true", help="append new data to the data file of the page")
+    parser.add_argument("--bucket", type=int, help="bucket width in seconds", default=60)
 
     args: argparse.Namespace = parser.parse_args()
 
@@ -176,6 +263,31 @@ def main() -> None:
     if args.days:
         end_time = datetime.datetime.now()
         start_time = end_time - datetime.timedelta(args.days)
+
+    inifile: configparser.ConfigParser = configparser.ConfigParser()
+    inifile.read("power_consumption.ini", "utf-8")
+    db_url: str = inifile.get("routeB", "db_url")
+
+    store: db_store.DBStore = db_store.DBStore(db_url)
+
+    bucket: datetime.timedelta = datetime.timedelta(seconds=args.bucket)
+
+    if args.batch:
+        output_dir: str = args.output or "."
+        if not os.path.isdir(output_dir):
+            parser.error("OUTPUT must be a directory in batch mode")
+        start_time, end_time = graph_batch.day_range(start_time, end_time)
+        days: typ.Dict[datetime.date, typ.List[typ.Dict]] = graph_batch.split_by_day(
+            store.select_bucketed_log(start_time, end_time, bucket, SERIES), key="time"
+        )
+        tasks: typ.List[typ.Tuple[str, typ.Tuple]] = []
+        for day, rows in sorted(days.items()):
+            day_file: str = os.path.join(output_dir, f"temp_{day}.html")
+            if args.force or not graph_batch.is_up_to_date(day_file, rows[-1]["time"] + bucket):
+                tasks.append((day_file, (day_file, make_temp_dataframe(rows), args.max_points, None, args.gzip)))
+        graph_batch.run(tasks, make_temp_graph, args.jobs)
+        return
+
     output_file: str = f"temp_{start_time.date()}.html"
     if args.output:
         if os.path.isdir(args.output):
@@ -183,18 +295,31 @@ def main() -> None:
         else:
             output_file = args.output
 
-    inifile: configparser.ConfigParser = configparser.ConfigParser()
-    inifile.read("power_consumption.ini", "utf-8")
-    db_url: str = inifile.get("routeB", "db_url")
-
-    store: db_store.DBStore = db_store.DBStore(db_url)
-    temp_data: typ.List = store.select_temp_log(start_time, end_time)
-    co2_data: typ.List = store.select_co2_log(start_time, end_time)
-    bme280_data: typ.List = store.select_bme280_log(start_time, end_time)
-    tsl2572_data: typ.List = store.select_tsl2572_log(start_time, end_time)
+    if args.incremental:
+        data_file: str = incremental.data_file_path(output_file)
+        watermark: typ.Optional[datetime.datetime] = incremental.read_watermark(data_file)
+        if watermark is not None:
+            start_time = max(start_time, watermark + bucket)
+        # 書き込み途中かもしれない現在の区間は、次の実行で追記する
+        now: datetime.datetime = datetime.datetime.now()
+        end_time = min(end_time, now - (now - incremental.EPOCH) % bucket)
+        # データファイルのヘッダは最初に書いたときに決まるので、その時点でデータがない系列の列も残す
+        df: pd.DataFrame = make_temp_dataframe(
+            store.select_bucketed_log(start_time, end_time, bucket, SERIES), drop_empty=False
+        )
+        if len(df) > 0:
+            incremental.append_rows(data_file, df)
+        columns: typ.Optional[typ.List[str]] = incremental.read_header(data_file)
+        if columns is not None and not os.path.exists(output_file):
+            make_temp_graph(
+                output_file, pd.DataFrame(columns=columns), data_url=os.path.basename(data_file), gzip=args.gzip
+            )
+        print(output_file)
+        return
 
-    if len(temp_data) > 0 or len(co2_data) > 0 or len(bme280_data) > 0 or len(tsl2572_data) > 0:
-        make_temp_graph(output_file, temp_data, co2_data, bme280_data, tsl2572_data)
+    data: typ.List = store.select_bucketed_log(start_time, end_time, bucket, SERIES)
+    if len(data) > 0:
+        make_temp_graph(output_file, make_temp_dataframe(data), args.max_points, gzip=args.gzip)
         print(output_file)
     else:
         print("no data")
@@ -8,9 +8,14 @@
 //   double補正後の t_fine
 //   double 補正後の t p h
 //
+// --batch を付けると、標準入力の最初に calibration data(dig_T1〜dig_T3, dig_P1〜dig_P9, dig_H1〜dig_H6)を、
+// 続けて p t h を何組でも入れると、1組ごとに「t_fine t p h」(整数補正後)を1行ずつ出力する。
+// (bme280_recompensate.py の検算用。make check で実行する)
+//
 // コンパイルは、以下で行う(Makefileを用意したので、makeでも良い)
 // c++ -o bme280 bme280.cc
 
+#include <cstring>
 #include <iostream>
 
 typedef int BME280_S32_t;
@@ -142,8 +147,31 @@ double bme280_compensate_H_double(BME280_S32_t adc_H)
     return var_H;
 }
 
-int main()
+int batch()
+{
+    int *dig[] = {&dig_T1, &dig_T2, &dig_T3, &dig_P1, &dig_P2, &dig_P3, &dig_P4, &dig_P5, &dig_P6,
+                  &dig_P7, &dig_P8, &dig_P9, &dig_H1, &dig_H2, &dig_H3, &dig_H4, &dig_H5, &dig_H6};
+    for (int *d : dig)
+    {
+        std::cin >> *d;
+    }
+    BME280_S32_t raw_t, raw_p, raw_h;
+    while (std::cin >> raw_p >> raw_t >> raw_h)
+    {
+        int t = BME280_compensate_T_int32(raw_t);
+        unsigned int p = BME280_compensate_P_int64(raw_p);
+        unsigned int h = bme280_compensate_H_int32(raw_h);
+        std::cout << t_fine << " " << t << " " << p << " " << h << "\n";
+    }
+    return 0;
+}
+
+int main(int argc, char *argv[])
 {
+    if (argc > 1 && std::strcmp(argv[1], "--batch") == 0)
+    {
+        return batch();
+    }
     BME280_S32_t raw_t, raw_p, raw_h;
     std::cin >> raw_p >> raw_t >> raw_h;
     int t = BME280_compensate_T_int32((BME280_S32_t)raw_t);
@@ -0,0 +1,144 @@
+"""センサーのドライバを、i2c_bus の FakeSMBus で動かして確かめる.
+
+実機がなくても(普通の Linux でも)動く。`make check` から実行する。
+BME280 の期待値は、test/bme280.cc(データシートの補正式)に FakeBME280 の calibration data と生データを与えた結果。
+"""
+
+import math
+import os
+import sys
+import typing as typ
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bme280  # noqa: E402
+import i2c_bus  # noqa: E402
+import tsl2572  # noqa: E402
+
+# (生データ(気圧, 温度, 湿度), test/bme280.cc の結果(気温[0.01℃], 気圧[Pa/256], 湿度[%/1024]))
+BME280_CASES: typ.List[typ.Tuple[typ.Tuple[int, int, int], typ.Tuple[int, int, int]]] = [
+    ((415148, 519888, 30000), (1811, 22711331, 70106)),
+    ((400000, 530000, 25000), (2138, 23498659, 40825)),
+]
+
+
+def check_close(name: str, actual: typ.Sequence[float], expected: typ.Sequence[float]) -> bool:
+    """値を比べて、結果を表示する.
+
+    Args:
+        name: 確かめる内容
+        actual: 値
+        expected: 期待値
+
+    Returns:
+        一致したか
+    """
+    ok: bool = len(actual) == len(expected) and all(
+        math.isclose(a, e, rel_tol=1e-9, abs_tol=1e-9) for a, e in zip(actual, expected)
+    )
+    print(f"{'ok' if ok else 'NG'}: {name}: {tuple(actual)}" + ("" if ok else f" != {tuple(expected)}"))
+    return ok
+
+
+def check_bme280() -> bool:
+    """BME280 の読み込みと補正を確かめる.
+
+    Returns:
+        全て一致したか
+    """
+    device: i2c_bus.FakeBME280 = i2c_bus.FakeBME280()
+    bus: i2c_bus.I2CBus = i2c_bus.set_backend(0, i2c_bus.FakeSMBus({0x76: device}))
+    ok: bool = True
+    for mode in (3, 1):
+        sensor: bme280.BME280 = bme280.BME280(0, mode=mode)
+        for raw, (temp, pres, hum) in BME280_CASES:
+            device.set_raw(*raw)
+            expected: typ.Tuple[float, float, float] = (pres / 256 / 100, temp / 100, hum / 1024)
+            ok &= check_close(f"BME280 mode={mode} raw", sensor.read_raw(), raw)
+            ok &= check_close(f"BME280 mode={mode} read", sensor.read(), expected)
+            if mode == 1:
+                burst: typ.Dict[str, typ.Tuple] = sensor.read_burst(4)
+                ok &= check_close("BME280 burst mean", burst["mean"], expected)
+                ok &= check_close("BME280 burst min/max", burst["min"] + burst["max"], expected + expected)
+    # 転送は全てバスを通り、数えられている
+    ok &= check_close("BME280 bus stats", [bus.stats[0x76].transfers > 0, bus.stats[0x76].bytes > 0], [1, 1])
+    return ok
+
+
+def check_tsl2572() -> bool:
+    """TSL2572 の読み込みと照度の計算を確かめる.
+
+    Returns:
+        全て一致したか
+    """
+    device: i2c_bus.FakeTSL2572 = i2c_bus.FakeTSL2572()
+    i2c_bus.set_backend(0, i2c_bus.FakeSMBus({0x39: device}))
+    ok: bool = True
+    for continuous in (False, True):
+        sensor: tsl2572.TSL2572 = tsl2572.TSL2572(0, continuous=continuous)
+        sensor.start()
+        # atime=0xC0(175ms), 1x gain: CPL = 2.73 * 64 / 60
+        cpl: float = 2.73 * 64 / 60
+        for ch0, ch1 in ((1000, 100), (5000, 3000), (0, 0)):
+            device.set_counts(ch0, ch1)
+            lux1: float = (ch0 - 1.87 * ch1) / cpl
+            lux2: float = (0.63 * ch0 - ch1) / cpl
+            ok &= check_close(
+                f"TSL2572 continuous={continuous} counts=({ch0}, {ch1})",
+                sensor.read(),
+                (max(lux1, lux2, 0), lux1, lux2, ch0, ch1),
+            )
+    return ok
+
+
+def check_tsl2572_auto_range() -> bool:
+    """TSL2572 の自動調整(飽和したあとで暗くなったとき)を確かめる.
+
+    Returns:
+        全て一致したか
+    """
+    device: i2c_bus.FakeTSL2572 = i2c_bus.FakeTSL2572()
+    i2c_bus.set_backend(0, i2c_bus.FakeSMBus({0x39: device}))
+    sensor: tsl2572.TSL2572 = tsl2572.TSL2572(0, again=3, auto_range=True)
+    ok: bool = True
+    # (明るさ(CH0, CH1), 調整したあとの(ATIME, AGAIN))
+    cases: typ.List[typ.Tuple[typ.Tuple[float, float], typ.Tuple[int, int]]] = [
+        ((10, 1), (0xC0, 2)),  # 120x gain では飽和する → 一番感度の低い設定で測ってから 16x gain にする
+        ((1 / 16, 1 / 128), (0x00, 3)),  # 暗い → 一番感度の高い設定にする
+    ]
+    for (ch0, ch1), selected in cases:
+        device.set_light(ch0, ch1)
+        lux1: float = (ch0 - 1.87 * ch1) * 60 / 2.73
+        lux2: float = (0.63 * ch0 - ch1) * 60 / 2.73
+        ok &= check_close(
+            f"TSL2572 auto_range light=({ch0}, {ch1})", sensor.read()[:3], (max(lux1, lux2, 0), lux1, lux2)
+        )
+        ok &= check_close(f"TSL2572 auto_range range=({ch0}, {ch1})", (sensor.atime, sensor.again), selected)
+    return ok
+
+
+def check_read_blocks() -> bool:
+    """read_blocks でまとめて読んだ結果が、別々に読んだ結果と同じことを確かめる.
+
+    Returns:
+        一致したか
+    """
+    bus: i2c_bus.I2CBus = i2c_bus.set_backend(0, i2c_bus.FakeSMBus({0x76: i2c_bus.FakeBME280()}))
+    blocks: typ.List[typ.Tuple[int, int]] = [(0xF7, 8), (0x88, 24), (0xF3, 1), (0xA1, 1), (0xE1, 7)]
+    separate: typ.List[typ.List[int]] = [bus.read_i2c_block_data(0x76, r, n) for r, n in blocks]
+    bus.stats.clear()
+    coalesced: typ.List[typ.List[int]] = bus.read_blocks(0x76, blocks)
+    ok: bool = check_close("read_blocks", sum(coalesced, []), sum(separate, []))
+    ok &= check_close("read_blocks transfers", [bus.stats[0x76].transfers], [3])
+    return ok
+
+
+def main() -> None:
+    """メイン処理."""
+    results: typ.List[bool] = [check_bme280(), check_tsl2572(), check_tsl2572_auto_range(), check_read_blocks()]
+    if not all(results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
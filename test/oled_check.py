@@ -0,0 +1,88 @@
+"""OLED の差分送信を、oled_ssd1306 の FakeSSD1306 で確かめる.
+
+実機がなくても(普通の Linux でも)動く。`make check` から実行する。
+画面をランダムに描いて送るたびに、FakeSSD1306 の GDDRAM が描いた画面と一致することを確かめる。
+フォントは、oled_ssd1306.FONT_PATH があればそれを、なければ Pillow 内蔵のフォントを使う。
+"""
+
+import os
+import random
+import sys
+import typing as typ
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oled_ssd1306  # noqa: E402
+
+# 画面を描いて送る回数
+CYCLES: int = 300
+
+
+def random_value(rng: random.Random, low: float, high: float) -> typ.Optional[float]:
+    """値を選ぶ(ときどき None にする).
+
+    Args:
+        rng: 乱数
+        low: 最小値
+        high: 最大値
+
+    Returns:
+        値
+    """
+    return None if rng.random() < 0.1 else rng.uniform(low, high)
+
+
+def draw(display: oled_ssd1306.Display, rng: random.Random) -> None:
+    """画面の1つをランダムな値で描く.
+
+    Args:
+        display: ディスプレイ
+        rng: 乱数
+    """
+    screen: int = rng.randrange(3)
+    if screen == 0:
+        co2: typ.Optional[float] = random_value(rng, 400, 3000)
+        display.update(
+            None if co2 is None else int(co2),
+            random_value(rng, -10, 40),
+            random_value(rng, 0, 100),
+            random_value(rng, 950, 1050),
+        )
+    elif screen == 1:
+        display.update_power(random_value(rng, 0, 6000), random_value(rng, 0, 60), random_value(rng, 0, 6000))
+    else:
+        history: typ.List[typ.Optional[float]] = [random_value(rng, 0, 6000) for _ in range(60)]
+        display.update_graph("電力 ", history[-1], "6.0f", " W", history)
+
+
+def main() -> None:
+    """メイン処理."""
+    font_path: typ.Optional[str] = oled_ssd1306.FONT_PATH if os.path.exists(oled_ssd1306.FONT_PATH) else None
+    fake: oled_ssd1306.FakeSSD1306 = oled_ssd1306.FakeSSD1306()
+    display: oled_ssd1306.Display = oled_ssd1306.Display(0x3C, 1, oled=fake, font_path=font_path)
+    rng: random.Random = random.Random(0)
+    checked: int = 0
+    mismatches: int = 0
+    for i in range(CYCLES):
+        draw(display, rng)
+        if rng.random() < 0.1:  # 消えている間に描いたものは、次に点けたときに送る
+            display.clear()
+            continue
+        display.redraw()
+        checked += 1
+        if fake.ram != display.frame:
+            mismatches += 1
+            print(f"NG: cycle {i}: GDDRAM differs from the frame")
+    # 変わっていない画面を送り直しても、何も送らない
+    transfers: int = display.stats.transfers
+    display.redraw()
+    if display.stats.transfers != transfers:
+        mismatches += 1
+        print("NG: an unchanged frame was sent again")
+    print(f"{checked - mismatches}/{checked} redraws matched ({display.stats.bytes / checked:.1f} bytes per redraw)")
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 """access TSL2572 via I2C."""
+import asyncio
 import time
 import typing as typ
-import smbus
+import i2c_bus
 
 # TSL2572 Register Set
 
@@ -43,6 +44,18 @@ TSL2572_C1DATAH = 0x17
 
 AGAIN: typ.List[int] = [1, 8, 16, 120]
 
+# 自動調整で使う(ATIME, AGAIN)の組み合わせ(感度の低い順)
+RANGES: typ.List[typ.Tuple[int, int]] = [(0xF6, 0), (0xDB, 0), (0xC0, 0), (0xC0, 1), (0xC0, 2), (0xC0, 3), (0x00, 3)]
+# 自動調整で、感度を上げてもこの割合(フルスケールに対する割合)を超えないようにする
+RANGE_HEADROOM: float = 0.5
+# 自動調整で、フルスケールに対してこの割合を超えたら飽和したとみなす
+RANGE_SATURATION: float = 0.9
+# 待つときのポーリング間隔[秒]と回数(0.01秒×100回で1秒まで)
+POLL_INTERVAL: float = 0.01
+POLL_COUNT: int = 100
+
+T = typ.TypeVar("T")
+
 
 class TSL2572:
     """TSL2572."""
@@ -54,6 +67,9 @@ class TSL2572:
         *,
         atime: int = 0xC0,
         again: int = 0x0,
+        continuous: bool = False,
+        wtime: int = 0x00,
+        auto_range: bool = False,
     ) -> None:
         """初期化.
 
@@ -71,35 +87,70 @@ class TSL2572:
                 0x01: 8x gain
                 0x02: 16x gain
                 0x03: 120x gain
+            continuous: 連続測定モード(wait timer の間隔で測定し続け、読み込むときは最新の値を返す)
+            wtime: 連続測定モードの待ち時間(wait time register)
+                0xff: 2.73ms
+                0x00: 699ms(default)
+            auto_range: 値に合わせて ATIME と AGAIN を自動で調整する
         """
         assert atime & 0xFF == atime
         assert again & 0b11 == again
+        assert wtime & 0xFF == wtime
 
-        self.bus: smbus.SMBus = smbus.SMBus(bus)
+        self.bus: i2c_bus.I2CBus = i2c_bus.get_bus(bus)
         self.i2c_address: int = address
         self.atime: int = atime
+        self.again: int = again
+        self.continuous: bool = continuous
+        self.auto_range: bool = auto_range
+        self.running: bool = False
         self.initialized: bool = False
         self.retryout: bool = False
-        GA: int = 1  # glass attenuation
-        self.CPL: float = (2.73 * (256 - self.atime) * AGAIN[again]) / (GA * 60.0)
+        self.CPL: float = self.calc_cpl(atime, again)
 
         if self.read_reg(TSL2572_ID) != 0x34:
             # check TSL25721 ID
             return
 
-        # gain(0x00 = 1x)
-        self.write_reg(TSL2572_CONTROL, 0x00)
         # AGL(0 = AGAIN scaled by 1), WLONG(WTIME scaled by 1)
         self.write_reg(TSL2572_CONFIG, 0x00)
-        # ATIME
-        self.write_reg(TSL2572_ATIME, atime)
+        # WTIME
+        self.write_reg(TSL2572_WTIME, wtime)
         # Enable register(Power OFF)
         self.write_reg(TSL2572_ENABLE, 0)
+        # ATIME, gain
+        self.configure(atime, again)
 
         self.initialized = True
 
         self.t_fine: int = 0
 
+    @staticmethod
+    def calc_cpl(atime: int, again: int) -> float:
+        """1luxあたりのカウント数を求める.
+
+        Args:
+            atime: ALS timing register
+            again: ALS Gain
+
+        Returns:
+            CPL(counts per lux)
+        """
+        GA: int = 1  # glass attenuation
+        return (2.73 * (256 - atime) * AGAIN[again]) / (GA * 60.0)
+
+    @staticmethod
+    def full_scale(atime: int) -> int:
+        """ADCの最大値.
+
+        Args:
+            atime: ALS timing register
+
+        Returns:
+            最大値
+        """
+        return min(1024 * (256 - atime), 65535)
+
     def write_reg(self, reg_address: int, data: int) -> None:
         """レジスタの書き込み.
 
@@ -120,44 +171,199 @@ class TSL2572:
         """
         return self.bus.read_byte_data(self.i2c_address, TSL2572_COMMAND | TSL2572_TYPE_INC | reg_address)
 
-    def read_raw(self) -> typ.Tuple[int, int]:
-        """センサの生データを読み込む.
+    def configure(self, atime: int, again: int) -> None:
+        """ATIME と AGAIN を設定する(連続測定中なら、測定をやり直す).
+
+        Args:
+            atime: ALS timing register
+            again: ALS Gain
+        """
+        running: bool = self.running
+        if running:
+            self.write_reg(TSL2572_ENABLE, TSL2572_PON)
+            self.running = False
+        self.write_reg(TSL2572_ATIME, atime)
+        self.write_reg(TSL2572_CONTROL, again)
+        self.atime = atime
+        self.again = again
+        self.CPL = self.calc_cpl(atime, again)
+        if running:
+            self.start()
+
+    def start(self) -> None:
+        """測定を開始する."""
+        if self.continuous:
+            # Enable register(Wait enable, ALS Enable, Power ON)
+            self.write_reg(TSL2572_ENABLE, TSL2572_WEN | TSL2572_AEN | TSL2572_PON)
+            self.running = True
+        else:
+            # Enable register(Sleep after interrupt, ALS Enable, Power ON)
+            self.write_reg(TSL2572_ENABLE, TSL2572_SAI | TSL2572_AEN | TSL2572_PON)
+
+    def poll(self) -> typ.Tuple[bool, typ.Tuple[int, int]]:
+        """ステータスとデータレジスタを1回の転送で読み込む.
+
+        Returns:
+            測定値が読み込めたか, 生データのTuple(CH0、CH1)
+        """
+        command: int = TSL2572_COMMAND | TSL2572_TYPE_INC
+        status, dat = self.bus.read_blocks(
+            self.i2c_address, [(command | TSL2572_STATUS, 1), (command | TSL2572_C0DATA, 4)]
+        )
+        mask: int = TSL2572_AVALID if self.continuous else TSL2572_AINT | TSL2572_AVALID
+        adc0: int = (dat[1] << 8) | dat[0]
+        adc1: int = (dat[3] << 8) | dat[2]
+        return (status[0] & mask == mask, (adc0, adc1))
+
+    def measure_raw(self) -> typ.Generator[float, None, typ.Tuple[int, int]]:
+        """センサの生データを読み込む手順(read_raw と read_raw_async で共通).
+
+        連続測定モードでは、測定済みの最新の値をすぐに返す(測定を開始した直後だけは待つ)。
+
+        Yields:
+            測定を待つ時間[秒]
 
         Returns:
             生データのTuple(CH0、CH1)
         """
-        # Enable register(Sleep after interrupt, ALS Enable, Power ON)
-        self.write_reg(TSL2572_ENABLE, TSL2572_SAI | TSL2572_AEN | TSL2572_PON)
-        mask: int = TSL2572_AINT | TSL2572_AVALID
+        if not self.running:
+            self.start()
         retryout: bool = True
-        for i in range(100):  # 100回までリトライ。0.01秒sleepなので1秒まで
-            status: int = self.read_reg(TSL2572_STATUS)
-            if status & mask == mask:
+        for i in range(POLL_COUNT):
+            valid, adc = self.poll()
+            if valid:
                 retryout = False
                 break
-            time.sleep(0.01)
+            yield POLL_INTERVAL
         self.retryout = retryout
+        return adc
 
-        dat: typ.List[int] = self.bus.read_i2c_block_data(
-            self.i2c_address, TSL2572_COMMAND | TSL2572_TYPE_INC | TSL2572_C0DATA, 4
-        )
-        adc0: int = (dat[1] << 8) | dat[0]
-        adc1: int = (dat[3] << 8) | dat[2]
-        return (adc0, adc1)
+    def measure(self) -> typ.Generator[float, None, typ.Tuple[float, float, float, int, int]]:
+        """センサのデータを読み込む手順(read と read_async で共通).
 
-    def read(self) -> typ.Tuple[float, float, float, int, int]:
-        """センサのデータを読み込む.
+        自動調整のときは、範囲を外れていたら設定を変えて測り直す(連続測定モードでは次の測定から変える)。
+        飽和していたときは、一番感度の低い設定で測ってから合わせるので、2回まで測り直す。
+
+        Yields:
+            測定を待つ時間[秒]
 
         Returns:
             (照度, lux1, lux2, ch0, ch1)
         """
         if not self.initialized:
             return (-1, -1, -1, -1, -1)
-        adc: typ.Tuple[int, int] = self.read_raw()
-        lux1: float = ((adc[0] * 1.00) - (adc[1] * 1.87)) / self.CPL
-        lux2: float = ((adc[0] * 0.63) - (adc[1] * 1.00)) / self.CPL
+        cpl: float = self.CPL
+        adc: typ.Tuple[int, int] = yield from self.measure_raw()
+        for _ in range(2):
+            if not self.auto_range or not self.adjust_range(adc) or self.continuous:
+                break
+            cpl = self.CPL
+            adc = yield from self.measure_raw()
+        return self.to_lux(adc, cpl)
+
+    @staticmethod
+    def wait(steps: typ.Generator[float, None, T]) -> T:
+        """読み込む手順を、time.sleep で待ちながら進める.
+
+        Args:
+            steps: 読み込む手順
+
+        Returns:
+            手順の結果
+        """
+        while True:
+            try:
+                time.sleep(next(steps))
+            except StopIteration as e:
+                return e.value
+
+    @staticmethod
+    async def wait_async(steps: typ.Generator[float, None, T]) -> T:
+        """読み込む手順を、asyncio.sleep で待ちながら(他の処理に譲りながら)進める.
+
+        Args:
+            steps: 読み込む手順
+
+        Returns:
+            手順の結果
+        """
+        while True:
+            try:
+                await asyncio.sleep(next(steps))
+            except StopIteration as e:
+                return e.value
+
+    def read_raw(self) -> typ.Tuple[int, int]:
+        """センサの生データを読み込む.
+
+        Returns:
+            生データのTuple(CH0、CH1)
+        """
+        return self.wait(self.measure_raw())
+
+    async def read_raw_async(self) -> typ.Tuple[int, int]:
+        """センサの生データを読み込む(測定を待つ間は、他の処理に譲る).
+
+        Returns:
+            生データのTuple(CH0、CH1)
+        """
+        return await self.wait_async(self.measure_raw())
+
+    def adjust_range(self, adc: typ.Tuple[int, int]) -> bool:
+        """測定値に合わせて、次の測定の ATIME と AGAIN を決める.
+
+        今の感度での測定値から、RANGE_HEADROOM を超えない範囲で一番感度の高い組み合わせを選ぶ。
+        飽和していたときは本当の値がわからないので、一番感度の低い組み合わせにする。
+
+        Args:
+            adc: 今の設定で測定した生データ
+
+        Returns:
+            設定を変えたか
+        """
+        counts: int = max(adc)
+        current: float = (256 - self.atime) * AGAIN[self.again]
+        selected: typ.Tuple[int, int] = RANGES[0]
+        if counts < self.full_scale(self.atime) * RANGE_SATURATION:
+            for atime, again in RANGES[1:]:
+                if counts * (256 - atime) * AGAIN[again] / current > self.full_scale(atime) * RANGE_HEADROOM:
+                    break
+                selected = (atime, again)
+        if selected == (self.atime, self.again):
+            return False
+        self.configure(*selected)
+        return True
+
+    def to_lux(self, adc: typ.Tuple[int, int], cpl: float) -> typ.Tuple[float, float, float, int, int]:
+        """生データを照度にする.
+
+        Args:
+            adc: 生データ
+            cpl: 測定したときの CPL
+
+        Returns:
+            (照度, lux1, lux2, ch0, ch1)
+        """
+        lux1: float = ((adc[0] * 1.00) - (adc[1] * 1.87)) / cpl
+        lux2: float = ((adc[0] * 0.63) - (adc[1] * 1.00)) / cpl
         return (max(lux1, lux2, 0), lux1, lux2, adc[0], adc[1])
 
+    def read(self) -> typ.Tuple[float, float, float, int, int]:
+        """センサのデータを読み込む.
+
+        Returns:
+            (照度, lux1, lux2, ch0, ch1)
+        """
+        return self.wait(self.measure())
+
+    async def read_async(self) -> typ.Tuple[float, float, float, int, int]:
+        """センサのデータを読み込む(測定を待つ間は、他の処理に譲る).
+
+        Returns:
+            (照度, lux1, lux2, ch0, ch1)
+        """
+        return await self.wait_async(self.measure())
+
 
 if __name__ == "__main__":
     tsl2572: TSL2572 = TSL2572()